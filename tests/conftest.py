@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# the modules of trec import each other by their flat names
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),"..","trec"))
+
+@pytest.fixture(scope="session")
+def app():
+    """
+    The Qt application of the tests that need one, shown nowhere.
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+    QtGui = pytest.importorskip("PyQt5.QtGui")
+    return (QtGui.QGuiApplication.instance()
+            or QtGui.QGuiApplication(["tests"]))
@@ -0,0 +1,61 @@
+import numpy as np
+
+from analysis import Analyzer
+from queues import FrameQueue
+from stage import parseROI
+
+def test_parse_roi():
+    assert parseROI("10,20,30,40") == (10,20,30,40)
+    assert parseROI("") is None
+    assert parseROI("Analysis ROI x,y,w,h") is None
+    assert parseROI("10,20,0,40") is None
+
+def test_view_roi():
+    analyzer = Analyzer(FrameQueue(2),step=2)
+    image = np.arange(100*200,dtype=np.uint16).reshape(100,200)
+    analyzer.setROI("40,20,100,50")
+    view,step,origin = analyzer.view(image)
+    assert origin == (40,20)
+    assert view.shape == (25,50)
+    assert view[0,0] == image[20,40]
+    # outside the frame the whole frame is analyzed
+    analyzer.setROI("400,20,100,50")
+    view,step,origin = analyzer.view(image)
+    assert origin == (0,0)
+    assert view.shape == (50,100)
+
+def readLog(name):
+    with open(name) as f:
+        return [float(line.split(",")[0]) for line in f.readlines()[1:]]
+
+def test_logs_of_switched_files(tmp_path):
+    analyzer = Analyzer(FrameQueue(2))
+    values = [0.0] * len(analyzer.keys)
+    analyzer.handle(0.5,values)
+    first = analyzer.startLog(str(tmp_path / "first"),1.0)
+    analyzer.handle(1.0,values)
+    # the format switches after frame 2.0, analysis lags behind
+    analyzer.stopLog(2.0)
+    second = analyzer.startLog(str(tmp_path / "second"),3.0)
+    for ta in [2.0,3.0,4.0]:
+        analyzer.handle(ta,values)
+    analyzer.stopLog(4.0)
+    analyzer.closeIdleLog()
+    assert analyzer.logs == []
+    assert readLog(first) == [1.0,2.0]
+    assert readLog(second) == [3.0,4.0]
+
+def test_log_ahead_of_recorder(tmp_path):
+    analyzer = Analyzer(FrameQueue(2))
+    values = [0.0] * len(analyzer.keys)
+    first = analyzer.startLog(str(tmp_path / "first"),1.0)
+    # frames of the switched format are analyzed before they are written
+    for ta in [1.0,2.0,3.0,4.0]:
+        analyzer.handle(ta,values)
+    analyzer.stopLog(2.0)
+    second = analyzer.startLog(str(tmp_path / "second"),3.0)
+    analyzer.handle(5.0,values)
+    analyzer.stopLog(5.0)
+    analyzer.closeIdleLog()
+    assert readLog(first) == [1.0,2.0]
+    assert readLog(second) == [3.0,4.0,5.0]
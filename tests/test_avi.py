@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+
+from avi import AviWriter, FrameIndex
+from encoder import OpenCVWriter
+from recording import countFrames
+
+def writeAvi(filename,payloads):
+    writer = AviWriter(filename,30,(32,40))
+    for data in payloads:
+        writer.writeFrame(data)
+    writer.release()
+
+def test_index_of_written_file(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    # odd sizes are padded in the file
+    payloads = [bytes([i])*(i+1) for i in range(7)]
+    writeAvi(filename,payloads)
+    index = FrameIndex.build(filename)
+    assert len(index) == 7
+    assert index.isIntra()
+    with open(filename,"rb") as f:
+        assert [index.readFrame(f,nr) for nr in range(7)] == payloads
+    assert index.getKeyframe(5) == 5
+
+def test_index_of_opencv_file(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    writer = OpenCVWriter(filename,"MJPG",30,(32,40))
+    for i in range(5):
+        writer.write(np.full((32,40),i*40,np.uint8))
+    writer.release()
+    index = FrameIndex.build(filename)
+    assert len(index) == countFrames(filename) == 5
+    with open(filename,"rb") as f:
+        assert index.readFrame(f,3)[:2] == b"\xff\xd8"
+
+def test_index_is_cached(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    cache_dir = os.path.join(str(tmp_path),"cache")
+    writeAvi(filename,[b"ab",b"cde"])
+    index = FrameIndex.load(filename,cache_dir)
+    assert os.path.exists(os.path.join(cache_dir,"test.avi.npz"))
+    cached = FrameIndex.load(filename,cache_dir)
+    assert np.array_equal(cached.offsets,index.offsets)
+    assert cached.fourcc == "MJPG"
+    # a changed file is indexed again
+    writeAvi(filename,[b"ab",b"cde",b"f"])
+    assert len(FrameIndex.load(filename,cache_dir)) == 3
+
+def test_not_an_avi(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    with open(filename,"wb") as f:
+        f.write(b"RIFF\0\0\0\0WAVE")
+    assert FrameIndex.build(filename) is None
+
+def test_keyframes_and_repeated_frames(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    writeAvi(filename,[b"a",b"b"])
+    index = FrameIndex(np.array([0,1,0,1]),np.array([1,1,0,1]),
+                       np.array([True,False,False,True]),"H264")
+    assert not index.isIntra()
+    assert [index.getKeyframe(nr) for nr in range(4)] == [0,0,0,3]
+    with open(filename,"rb") as f:
+        # an empty frame repeats the last one with data
+        assert index.readFrame(f,2) == index.readFrame(f,1)
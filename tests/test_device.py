@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from device import SourceDiscovery
+
+def makeSource(directory):
+    class Source:
+        @classmethod
+        def getPaths(cls):
+            return [[name,directory] for name in sorted(os.listdir(directory))]
+
+        @classmethod
+        def getWatchPaths(cls):
+            return [directory]
+    return Source
+
+def discover(classes):
+    discovery = SourceDiscovery(classes)
+    events = []
+    discovery.sourceAdded.connect(
+        lambda cls,name,path: events.append(["added",cls,name]))
+    discovery.sourceRemoved.connect(
+        lambda cls,name,path: events.append(["removed",cls,name]))
+    return discovery,events
+
+def test_scan_reports_changes_only(tmp_path):
+    Source = makeSource(str(tmp_path))
+    discovery,events = discover([Source])
+    open(os.path.join(str(tmp_path),"a.avi"),"w").close()
+    discovery.scan(Source)
+    assert events == [["added",Source,"a.avi"]]
+    del events[:]
+    discovery.scan(Source)
+    assert events == []
+    open(os.path.join(str(tmp_path),"b.avi"),"w").close()
+    os.remove(os.path.join(str(tmp_path),"a.avi"))
+    discovery.scan(Source)
+    assert events == [["added",Source,"b.avi"],["removed",Source,"a.avi"]]
+
+def test_scan_of_failing_class():
+    class Broken:
+        @classmethod
+        def getPaths(cls):
+            raise OSError("no devices")
+    discovery,events = discover([Broken])
+    discovery.scan(Broken)
+    assert events == []
+    assert discovery.sources[Broken] == set()
+
+def test_change_rescans_the_watching_class(tmp_path,app):
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    First = makeSource(str(first))
+    Second = makeSource(str(second))
+    discovery,events = discover([First,Second])
+    discovery.start()
+    (first / "a.avi").touch()
+    (second / "b.avi").touch()
+    discovery.onChanged(str(first) + os.sep)
+    discovery.rescan()
+    assert events == [["added",First,"a.avi"]]
+    discovery.timer.stop()
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PyQt5")
+from display import Display
+from pool import FramePool
+from queues import FrameQueue
+
+def pixels(q_image):
+    bits = q_image.constBits()
+    bits.setsize(q_image.sizeInBytes())
+    return np.frombuffer(bits,np.uint8).reshape(q_image.height(),
+                                                q_image.width(),4)
+
+@pytest.mark.parametrize("shape",[(4,6),(4,6,1),(4,6,3),(4,6,4)])
+def test_to_qimage_is_bgrx(shape):
+    display = Display(FrameQueue(1))
+    im = np.random.default_rng(0).integers(0,256,shape,np.uint8)
+    q_image = display.toQImage(im)
+    assert (q_image.width(),q_image.height()) == (6,4)
+    expected = im.reshape(4,6,-1)
+    channels = expected.shape[2]
+    if channels == 1:
+        expected = np.repeat(expected,3,axis=2)
+    assert np.array_equal(pixels(q_image)[...,:3],expected[...,:3])
+
+def test_screen_images_rotate():
+    display = Display(FrameQueue(1))
+    im = np.zeros((4,6,3),np.uint8)
+    first = display.toQImage(im)
+    # the image just painted is not overwritten by the next frames
+    im[:] = 255
+    for i in range(Display.IMAGES - 1):
+        assert display.toQImage(im) is not first
+    assert pixels(first)[...,:3].max() == 0
+    assert display.toQImage(im) is first
+
+def test_window_uint16():
+    display = Display(FrameQueue(1))
+    im = np.array([[0,512,1023,4095]],np.uint16)
+    display.setLevels(3)
+    assert display.window(im).tolist() == [[0,128,255,255]]
+    display.setWindow("512,1023")
+    assert display.window(im).tolist() == [[0,0,255,255]]
+    # an invalid window goes back to the selected levels
+    display.setWindow("x")
+    assert display.window(im).tolist() == [[0,128,255,255]]
+
+def test_window_uint8_full_range_is_unchanged():
+    display = Display(FrameQueue(1))
+    im = np.arange(8,dtype=np.uint8).reshape(2,4)
+    assert display.window(im) is im
+
+def test_unsupported_images():
+    display = Display(FrameQueue(1))
+    with pytest.raises(TypeError):
+        display.toQImage([[0]])
+    with pytest.raises(NotImplementedError):
+        display.toQImage(np.zeros((4,6,2),np.uint8))
+
+def test_resize_keeps_the_aspect_ratio():
+    display = Display(FrameQueue(1))
+    im = np.zeros((480,640,3),np.uint8)
+    assert display.resize(im) is im
+    display.setSize(200,200)
+    small = display.resize(im)
+    assert small.shape == (150,200,3)
+    # the output buffers are reused for the next frames
+    assert display.resize(im) is small
+    display.setSize(640,480)
+    assert display.resize(im) is im
+
+def test_resize_area_averages_large_downscales():
+    display = Display(FrameQueue(1))
+    # a line pattern that interpolation alone would alias
+    im = np.zeros((400,400),np.uint8)
+    im[::2] = 255
+    display.setSize(50,50)
+    small = display.resize(im)
+    assert small.shape == (50,50)
+    assert abs(int(small.mean()) - 127) <= 2
+    assert small.max() - small.min() <= 4
+
+def test_paints_at_the_refresh_rate(app):
+    data_queue = FrameQueue(10,"Block")
+    display = Display(data_queue,refresh=10)
+    painted = []
+    display.updateImage.connect(
+        lambda slot,pixmap,stamps: painted.append(pixmap.width()))
+    pool = FramePool(0)
+    for i in range(5):
+        frame = pool.wrap(np.zeros((4,i+1),np.uint8))
+        data_queue.offer(["30 fps",frame],float(i))
+    thread = threading.Thread(target=display.loop)
+    thread.start()
+    time.sleep(0.3)
+    display.QUIT()
+    thread.join(1)
+    # the images are queued to the thread of the receiver
+    app.processEvents()
+    # the first frame at once, the last one after the period
+    assert painted == [1,5]
+    assert display.skipped == 3
@@ -0,0 +1,119 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from encoder import (EncoderPool, EncoderProcess, OpenCVWriter, ProcessWriter,
+                     SegmentWriter)
+from recording import countFrames
+from synthetic import makeFrames
+
+@pytest.mark.parametrize("shape",[(120,160),(120,160,3),(120,160,4)])
+def test_opencv_writer_stores_every_frame(tmp_path,shape):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    writer = OpenCVWriter(filename,"MJPG",30,shape)
+    assert writer.isOpened()
+    for image in makeFrames(shape,5,dtype=np.uint8):
+        writer.write(image)
+    writer.release()
+    assert countFrames(filename) == 5
+
+def deepFrame(shape):
+    # two flat halves of values far apart in the high byte
+    image = np.full(shape,16000,np.uint16)
+    image[:shape[0]//2] = 40000
+    return image
+
+def readFrame(filename):
+    reader = cv2.VideoCapture(filename)
+    retval,image = reader.read()
+    reader.release()
+    assert retval
+    return image
+
+@pytest.mark.parametrize("codec,shape",[("MJPG",(64,80)),
+                                        ("MJPG",(64,80,3)),
+                                        ("HFYU",(64,80)),
+                                        ("HFYU",(64,80,3))])
+def test_opencv_writer_stores_16_bit_frames_as_8_bits(tmp_path,codec,shape):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    writer = OpenCVWriter(filename,codec,30,shape,np.uint16)
+    assert writer.write(deepFrame(shape))
+    writer.release()
+    image = readFrame(filename).astype(int)
+    # most significant bytes of 40000 and 16000
+    assert abs(image[:16] - (40000 >> 8)).max() <= 2
+    assert abs(image[-16:] - (16000 >> 8)).max() <= 2
+
+def test_segment_writer_stores_16_bit_frames_as_8_bits(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    pool = EncoderPool(1)
+    try:
+        writer = SegmentWriter(pool,filename,30,(64,80,3),np.uint16,chunk=2)
+        for i in range(3):
+            assert writer.write(deepFrame((64,80,3)))
+        writer.release()
+    finally:
+        pool.quit()
+    assert countFrames(filename) == 3
+    image = readFrame(filename).astype(int)
+    assert abs(image[:16] - (40000 >> 8)).max() <= 2
+    assert abs(image[-16:] - (16000 >> 8)).max() <= 2
+
+def test_writers_refuse_other_dtypes(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    writer = OpenCVWriter(filename,"MJPG",30,(64,80))
+    assert not writer.write(np.zeros((64,80),np.uint16))
+    assert writer.write(np.zeros((64,80),np.uint8))
+    writer.release()
+
+def test_process_writer_stops_when_encoder_dies(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    encoder = EncoderProcess()
+    try:
+        writer = ProcessWriter(encoder,filename,"MJPG",30,(64,80,3),slots=2)
+        assert writer.isOpened()
+        encoder.process.kill()
+        encoder.process.join()
+        image = np.zeros((64,80,3),np.uint8)
+        # the free slots are filled, then the dead encoder is noticed
+        assert [writer.write(image) for i in range(4)] == [True,True,
+                                                           False,False]
+        assert not writer.isOpened()
+        writer.release()
+    finally:
+        encoder.quit()
+
+def test_process_writer_stores_every_frame(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    encoder = EncoderProcess()
+    try:
+        writer = ProcessWriter(encoder,filename,"MJPG",30,(64,80,3),slots=2)
+        for image in makeFrames((64,80,3),5,dtype=np.uint8):
+            assert writer.write(image)
+        writer.release()
+    finally:
+        encoder.quit()
+    assert countFrames(filename) == 5
+
+def test_segment_writer_keeps_frame_order(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    pool = EncoderPool(3)
+    try:
+        writer = SegmentWriter(pool,filename,30,(32,40),chunk=2)
+        # an odd last chunk is flushed on release
+        for i in range(13):
+            assert writer.write(np.full((32,40),i*16,np.uint8))
+        writer.release()
+    finally:
+        pool.quit()
+    reader = cv2.VideoCapture(filename)
+    levels = []
+    while True:
+        retval,image = reader.read()
+        if not retval:
+            break
+        levels.append(int(round(image.mean() / 16)))
+    reader.release()
+    assert levels == list(range(13))
@@ -0,0 +1,51 @@
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import numpy as np
+
+import headless
+from encoder import OpenCVWriter
+from recording import countFrames
+
+def writeSource(filename,n):
+    # OpenCV reads a file like a camera that stops delivering at the end
+    writer = OpenCVWriter(filename,"MJPG",30,(48,64,3))
+    for i in range(n):
+        writer.write(np.full((48,64,3),i*8,np.uint8))
+    writer.release()
+
+def test_record_file_source(tmp_path,capsys):
+    source = os.path.join(str(tmp_path),"source.avi")
+    output = os.path.join(str(tmp_path),"recordings")
+    writeSource(source,20)
+    # the recorder stops on Ctrl-C, the tests should as well
+    handler = signal.getsignal(signal.SIGINT)
+    try:
+        assert headless.main(["record","--device",source,"--duration","1",
+                              "--output",output,"--name","cam",
+                              "--policy","Block","--interval","10"]) == 0
+    finally:
+        signal.signal(signal.SIGINT,handler)
+    [filename] = glob.glob(os.path.join(output,"cam_*.avi"))
+    with open(filename+".json") as f:
+        meta = json.load(f)
+    assert meta["frames"] == countFrames(filename) == 20
+    assert meta["record_queue"]["dropped"] == 0
+    assert "Saved 20 frames" in capsys.readouterr().out
+
+def test_missing_device(tmp_path,capsys):
+    source = os.path.join(str(tmp_path),"missing.avi")
+    assert headless.main(["record","--device",source,
+                          "--output",str(tmp_path)]) == 1
+    assert "Cannot open" in capsys.readouterr().out
+
+def test_no_qt():
+    trec = os.path.join(os.path.dirname(__file__),"..","trec")
+    code = ("import sys; sys.path.insert(0,%r); import headless; "
+            "print('PyQt5' in sys.modules)" % trec)
+    out = subprocess.check_output([sys.executable,"-c",code])
+    assert out.strip() == b"False"
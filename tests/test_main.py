@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from device import SyntheticDevice
+from main import DEPTHS, POOL_SIZE, Pipeline, poolSize
+
+class Gui:
+    # the slots a pipeline connects to
+    def updateImage(self,slot,pixmap,stamps):
+        pass
+
+    def updateStat(self,slot,stat):
+        pass
+
+    def setItems(self,slot,title,items,index):
+        pass
+
+@pytest.fixture
+def pipelines(app):
+    pipelines = [Pipeline(slot,Gui(),SyntheticDevice,"Synthetic","synthetic",
+                          "Synthetic_%d" % slot,[SyntheticDevice])
+                 for slot in range(2)]
+    yield pipelines
+    for pipeline in pipelines:
+        pipeline.quit()
+
+def test_pipelines_run_side_by_side(pipelines):
+    first,second = pipelines
+    assert first.frame_pool is not second.frame_pool
+    assert first.display_q is not second.display_q
+    for pipeline in pipelines:
+        pipeline.device_h.device.START(True)
+    time.sleep(0.5)
+    for pipeline in pipelines:
+        pipeline.device_h.device.STOP(True)
+    for pipeline in pipelines:
+        assert pipeline.display_q.getStats()["produced"] > 0
+        assert pipeline.frame_pool.getStats()["hits"] > 0
+
+def test_set_depth_sizes_the_pool(pipelines):
+    pipeline = pipelines[0]
+    assert pipeline.frame_pool.size == POOL_SIZE
+    index = DEPTHS["Record"].index(64)
+    pipeline.setDepth("Record",index)
+    assert pipeline.record_q.maxsize == 64
+    assert pipeline.record_stage.pool.size == 66
+    assert pipeline.frame_pool.size == poolSize(
+        [DEPTHS["Display"][0],64,DEPTHS["Analysis"][0]])
+    # the other pipeline keeps its depths
+    assert pipelines[1].record_q.maxsize == DEPTHS["Record"][0]
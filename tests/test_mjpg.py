@@ -0,0 +1,55 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import mjpg
+from encoder import PassthroughWriter
+from recording import countFrames
+
+def jpeg(image):
+    # a frame as an MJPG camera delivers it with CAP_PROP_CONVERT_RGB off
+    return cv2.imencode(".jpg",image)[1].reshape(1,-1)
+
+@pytest.mark.parametrize("shape",[(48,64),(48,64,3)])
+def test_image_shape(shape):
+    data = jpeg(np.zeros(shape,np.uint8))
+    assert mjpg.isCompressed(data)
+    assert mjpg.imageShape(data) == shape
+
+def test_not_compressed():
+    assert not mjpg.isCompressed(None)
+    assert not mjpg.isCompressed(np.zeros((48,64,3),np.uint8))
+    data = np.frombuffer(b"\xff\xd8 no markers",np.uint8)
+    assert mjpg.imageShape(data) is None
+
+@pytest.mark.parametrize("step,scale",[[1,1],[3,2],[4,4],[7,4],[16,8]])
+def test_reduced_decoding(step,scale):
+    data = jpeg(np.full((64,128,3),80,np.uint8))
+    image,s = mjpg.decode(data,step)
+    assert s == scale
+    assert image.shape == (64 // scale,128 // scale,3)
+    assert abs(image.astype(int) - 80).max() <= 2
+    gray = mjpg.decode(data,step,gray=True)[0]
+    assert gray.shape == image.shape[:2]
+
+def test_corrupt_frame():
+    image,scale = mjpg.decode(np.frombuffer(b"\xff\xd8\xff",np.uint8))
+    assert image is None
+
+def test_passthrough_writer_stores_frames_as_they_are(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    frames = [jpeg(np.full((48,64,3),i*40,np.uint8)) for i in range(5)]
+    writer = PassthroughWriter(filename,30,(48,64,3))
+    for data in frames:
+        assert writer.write(data)
+    writer.release()
+    assert countFrames(filename) == 5
+    reader = cv2.VideoCapture(filename)
+    for i in range(5):
+        retval,image = reader.read()
+        assert retval
+        assert np.array_equal(image,cv2.imdecode(frames[i].reshape(-1),
+                                                 cv2.IMREAD_COLOR))
+    reader.release()
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import mono
+
+@pytest.mark.parametrize("fourcc,top",[["Y10 ",1023],["Y16 ",65535]])
+def test_unpack_words(fourcc,top):
+    image = np.linspace(0,top,4*6).astype(np.uint16).reshape(4,6)
+    # the buffer as OpenCV returns it, little-endian bytes in one row
+    raw = np.frombuffer(image.astype("<u2").tobytes(),np.uint8)
+    unpacked = mono.unpack(raw.reshape(1,-1),fourcc,6,4)
+    assert unpacked.dtype == np.uint16
+    assert np.array_equal(unpacked,image)
+    assert unpacked.max() == top
+
+def test_unpack_into_buffer():
+    image = np.arange(4*6,dtype=np.uint16).reshape(4,6)
+    raw = np.frombuffer(image.tobytes(),np.uint8).reshape(1,-1)
+    out = np.empty((4,6),np.uint16)
+    assert mono.unpack(raw,"Y16 ",6,4,out) is out
+    assert np.array_equal(out,image)
+    # a buffer of another format is not used
+    assert mono.unpack(raw,"Y16 ",6,4,np.empty((4,6),np.uint8)) is not out
+
+def test_unpack_short_buffer():
+    raw = np.zeros((1,4*6*2-1),np.uint8)
+    assert mono.unpack(raw,"Y10 ",6,4) is None
+
+def test_unpack_grey():
+    image = np.arange(4*6,dtype=np.uint8).reshape(4,6)
+    assert mono.unpack(image,"GREY",6,4) is image
+    # expanded to BGR by a backend that ignores CONVERT_RGB
+    bgr = np.dstack([image]*3)
+    assert np.array_equal(mono.unpack(bgr,"GREY",6,4),image)
+
+def test_formats():
+    assert mono.isMono("Y10 ") and not mono.isMono("MJPG")
+    assert [mono.getBits(f) for f in ("GREY","Y10 ","Y16 ")] == [8,10,16]
+
+class Reader:
+    # cv2.VideoCapture of a camera delivering raw Y16 buffers
+    def __init__(self,frames):
+        self.frames = list(frames)
+
+    def read(self,out=None):
+        if not self.frames:
+            return False,None
+        return True,self.frames.pop(0)
+
+def test_read():
+    image = np.full((4,6),40000,np.uint16)
+    raw = np.frombuffer(image.tobytes(),np.uint8).reshape(1,-1)
+    reader = Reader([raw,raw[:,:10]])
+    retval,frame = mono.read(reader,"Y16 ",6,4)
+    assert retval and np.array_equal(frame,image)
+    # a truncated frame is a failed read
+    assert mono.read(reader,"Y16 ",6,4)[0] is False
+    assert mono.read(reader,"Y16 ",6,4) == (False,None)
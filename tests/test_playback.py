@@ -0,0 +1,91 @@
+import threading
+import time
+
+import numpy as np
+
+from playback import Pacer, ReadAhead
+from pool import FramePool
+
+def paced(pacer,n,interval=None):
+    t = time.monotonic()
+    for i in range(n):
+        pacer.wait(interval)
+    return time.monotonic() - t
+
+def test_pacer_keeps_the_frame_rate():
+    pacer = Pacer(50)
+    # the first frame is due at once
+    assert paced(pacer,1) < 0.01
+    assert abs(paced(pacer,10) - 0.2) < 0.05
+
+def test_pacer_speed_and_intervals():
+    pacer = Pacer(50)
+    pacer.setSpeed(Pacer.getSpeedNames().index("2x"))
+    paced(pacer,1)
+    assert abs(paced(pacer,10) - 0.1) < 0.05
+    # recorded intervals take the place of the nominal period
+    assert abs(paced(pacer,5,0.04) - 0.1) < 0.05
+    pacer.setSpeed(Pacer.getSpeedNames().index("Unthrottled"))
+    assert paced(pacer,100) < 0.01
+
+def test_pacer_resynchronises_after_a_stall():
+    pacer = Pacer(100)
+    paced(pacer,1)
+    time.sleep(0.1)
+    # no burst of catch-up frames, the next ones are paced again
+    paced(pacer,1)
+    assert abs(paced(pacer,5) - 0.05) < 0.03
+
+def test_pacer_default_rate():
+    assert Pacer(0).fps == 30.0
+    assert Pacer.SPEEDS[0][1] == 1.0
+
+def reader(pool,n):
+    # returns frames numbered 0..n-1, then None at the end
+    frames = []
+    def read():
+        if len(frames) == n:
+            return None
+        frame = pool.wrap(np.zeros((2,2),np.uint8))
+        frame.seq = len(frames)
+        frames.append(frame)
+        return frame
+    return read,frames
+
+def test_first_depth_is_the_default():
+    names = ReadAhead.getDepthNames()
+    assert len(names) == len(ReadAhead.DEPTHS)
+    assert ReadAhead.DEPTHS[0][1] > 0
+    # the inline choice is labelled as such
+    inline = [depth for name,depth in ReadAhead.DEPTHS].index(0)
+    assert "off" in names[inline]
+
+def test_frames_in_order():
+    pool = FramePool(0)
+    read,frames = reader(pool,10)
+    ahead = ReadAhead(read,4,threading.Lock())
+    ahead.start()
+    got = [ahead.get(1).seq for i in range(10)]
+    assert ahead.get(0.2) is None
+    ahead.stop()
+    assert got == list(range(10))
+    # the buffer never holds more than depth frames
+    assert ahead.buffer.maxsize == 4
+
+def test_flush_drops_frames_decoded_before():
+    pool = FramePool(0)
+    lock = threading.Lock()
+    read,frames = reader(pool,100)
+    ahead = ReadAhead(read,4,lock)
+    ahead.start()
+    assert ahead.get(1).seq == 0
+    with lock:
+        ahead.flush()
+        flushed = len(frames)
+    frame = ahead.get(1)
+    assert frame.seq >= flushed
+    ahead.stop()
+    # frames dropped by the flush and stop are released
+    assert all(f.refs == 0 for f in frames[1:flushed])
+    assert all(f.refs == 0 for f in frames if f is not frame
+               and f.seq > frame.seq)
@@ -0,0 +1,81 @@
+import numpy as np
+
+from pool import FramePool
+
+def read(pool,shape,dtype=np.uint8):
+    # a reader filling the acquired buffer, or allocating when it has none
+    frame = pool.acquire()
+    image = frame.image
+    if image is None or image.shape != shape or image.dtype != dtype:
+        image = np.zeros(shape,dtype)
+    return pool.adopt(frame,image)
+
+def test_steady_state_is_allocation_free():
+    pool = FramePool(2)
+    read(pool,(4,6)).release()
+    allocs = pool.getStats()["allocs"]
+    for i in range(10):
+        read(pool,(4,6)).release()
+    stats = pool.getStats()
+    assert stats["allocs"] == allocs
+    assert stats["hits"] == 10
+    assert stats["free"] == 2
+
+def test_references():
+    pool = FramePool(1)
+    read(pool,(4,6)).release()
+    frame = read(pool,(4,6))
+    image = frame.image
+    frame.retain()
+    frame.release()
+    assert pool.getStats()["free"] == 0
+    frame.release()
+    assert frame.image is None
+    assert pool.getStats()["free"] == 1
+    assert pool.acquire().image is image
+
+def test_miss_when_empty():
+    pool = FramePool(1)
+    read(pool,(4,6)).release()
+    held = read(pool,(4,6))
+    frame = pool.acquire()
+    assert frame.image is None
+    assert pool.getStats()["misses"] == 2
+    held.release()
+
+def test_format_switch_keeps_spare_buffers():
+    pool = FramePool(2)
+    read(pool,(4,6)).release()
+    read(pool,(8,6,3)).release()
+    allocs = pool.getStats()["allocs"]
+    # switching back reuses the buffers of the previous format, only the
+    # first frame after each switch is allocated by the reader
+    read(pool,(4,6)).release()
+    read(pool,(8,6,3)).release()
+    assert pool.getStats()["allocs"] == allocs + 2
+    # a frame released after the switch goes back to the spares
+    frame = read(pool,(4,6))
+    read(pool,(8,6,3)).release()
+    frame.release()
+    assert len(pool.spare[2]) == 2
+
+def test_set_size():
+    pool = FramePool(2)
+    read(pool,(4,6)).release()
+    pool.setSize(4)
+    assert pool.getStats()["free"] == 4
+    frames = [read(pool,(4,6)) for i in range(4)]
+    assert pool.getStats()["misses"] == 1
+    pool.setSize(1)
+    for frame in frames:
+        frame.release()
+    # surplus buffers are not kept
+    assert pool.getStats()["free"] == 1
+
+def test_wrapped_frames_are_not_pooled():
+    pool = FramePool(1)
+    read(pool,(4,6)).release()
+    frame = pool.wrap(np.frombuffer(b"jpeg",np.uint8),"MJPG")
+    assert frame.codec == "MJPG"
+    frame.release()
+    assert pool.getStats()["free"] == 1
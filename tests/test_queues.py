@@ -0,0 +1,102 @@
+import queue
+import threading
+
+import numpy as np
+import pytest
+
+from pool import FramePool
+from queues import FrameQueue
+
+def offer(data_queue,pool,n,start=0):
+    frames = []
+    for nr in range(start,start + n):
+        frame = pool.wrap(np.zeros((2,2),np.uint8))
+        frame.seq = nr
+        frames.append(frame)
+        data_queue.offer([nr,frame],float(nr))
+    return frames
+
+def taken(data_queue):
+    items = []
+    while not data_queue.empty():
+        items.append(data_queue.get()[0])
+    return items
+
+# the drop times are those of the offers that caused the drops
+@pytest.mark.parametrize("policy,kept,drop_times",[
+    ["Drop newest",[0,1,2],[3.0,4.0]],
+    ["Drop oldest",[2,3,4],[3.0,4.0]],
+    ["Latest only",[4],[1.0,2.0,3.0,4.0]]])
+def test_policies(policy,kept,drop_times):
+    data_queue = FrameQueue(3,policy)
+    pool = FramePool(0)
+    frames = offer(data_queue,pool,5)
+    assert taken(data_queue) == kept
+    stats = data_queue.getStats()
+    assert stats["produced"] == 5
+    assert stats["delivered"] == len(kept)
+    assert stats["dropped"] == 5 - len(kept)
+    assert stats["drop_times"] == drop_times
+    # dropped frames are released
+    assert sorted(f.seq for f in frames if f.refs == 0) == sorted(
+        set(range(5)) - set(kept))
+
+def test_block_waits_for_consumer():
+    data_queue = FrameQueue(1,"Block")
+    pool = FramePool(0)
+    offer(data_queue,pool,1)
+    producer = threading.Thread(target=offer,args=(data_queue,pool,1,1))
+    producer.start()
+    producer.join(0.3)
+    assert producer.is_alive()
+    assert data_queue.get()[0] == 0
+    producer.join(1)
+    assert not producer.is_alive()
+    assert taken(data_queue) == [1]
+    assert data_queue.getStats()["dropped"] == 0
+
+def test_inactive_queue_discards_without_counting():
+    data_queue = FrameQueue(3,active=False)
+    pool = FramePool(0)
+    frames = offer(data_queue,pool,2)
+    assert data_queue.empty()
+    assert all(f.refs == 0 for f in frames)
+    assert data_queue.getStats()["produced"] == 0
+
+def test_control_items_are_not_evicted():
+    data_queue = FrameQueue(2,"Latest only")
+    pool = FramePool(0)
+    offer(data_queue,pool,1)
+    data_queue.put([0,None,0])
+    offer(data_queue,pool,1,1)
+    assert [item[1] is None for item in list(data_queue.queue)] == [True,
+                                                                    False]
+
+def test_stats_since():
+    data_queue = FrameQueue(2)
+    pool = FramePool(0)
+    offer(data_queue,pool,3)
+    since = data_queue.getStats()
+    taken(data_queue)
+    offer(data_queue,pool,4,3)
+    stats = data_queue.getStats(since)
+    assert [stats["produced"],stats["delivered"],stats["dropped"]] == [4,2,2]
+    assert stats["drop_times"] == [5.0,6.0]
+
+def test_set_depth():
+    data_queue = FrameQueue(2)
+    pool = FramePool(0)
+    offer(data_queue,pool,3)
+    assert data_queue.getStats()["dropped"] == 1
+    data_queue.setDepth(4)
+    offer(data_queue,pool,2,3)
+    assert taken(data_queue) == [0,1,3,4]
+    assert data_queue.getStats()["depth"] == 4
+    # a put blocked on the full queue goes on when it grows
+    data_queue.setDepth(1)
+    data_queue.put(["x"])
+    putter = threading.Thread(target=data_queue.put,args=(["y"],))
+    putter.start()
+    data_queue.setDepth(2)
+    putter.join(1)
+    assert not putter.is_alive()
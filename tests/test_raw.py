@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+from raw import RawReader, RawWriter, readHeader
+from sidecar import TimedWriter, TimeIndex
+from synthetic import makeFrames
+
+@pytest.mark.parametrize("shape,dtype",[((48,64,3),np.uint8),
+                                        ((48,64),np.uint16)])
+def test_round_trip(tmp_path,shape,dtype):
+    filename = os.path.join(str(tmp_path),"test.raw")
+    frames = makeFrames(shape,7,dtype=dtype)
+    # blocks of 3 frames, the file grows twice
+    writer = TimedWriter(RawWriter(filename,25,shape,dtype,block=3),filename)
+    for nr,image in enumerate(frames):
+        assert writer.write(image,0.04*nr,nr)
+    writer.release()
+
+    assert readHeader(filename)["count"] == 7
+    reader = RawReader(filename)
+    assert len(reader) == 7
+    assert reader.shape == shape and reader.dtype == dtype
+    assert reader.fps == 25
+    # random access, backwards and across blocks
+    for nr in [6,0,4,3,1]:
+        assert np.array_equal(reader.read(nr),frames[nr])
+    assert reader.times.find(0.13) == 3
+    reader.release()
+
+def test_unclosed_recording(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.raw")
+    shape = (8,8)
+    writer = TimedWriter(RawWriter(filename,30,shape,block=4),filename)
+    for nr in range(3):
+        writer.write(np.full(shape,nr,np.uint8),float(nr),nr)
+    writer.writer.maps[-1].flush()
+    writer.times.file.flush()
+    # the header still counts 0 frames and the file holds a whole block,
+    # the frames are counted by the timestamps
+    reader = RawReader(filename)
+    assert len(reader) == 3
+    assert reader.read(2)[0,0] == 2
+    reader.release()
+    writer.release()
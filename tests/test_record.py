@@ -0,0 +1,153 @@
+import glob
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PyQt5")
+from PyQt5.QtCore import QMutex, QWaitCondition
+
+from pool import FramePool
+from queues import FrameQueue
+from record import Recorder
+from recording import countFrames, PreRoll
+from sidecar import TimeIndex
+from state import RUNNING
+from synthetic import makeFrames
+
+def recorder(tmp_path,encoder):
+    rec = Recorder("test",FrameQueue(64),queue.Queue(1000),QMutex(),
+                   QWaitCondition())
+    rec.dir = str(tmp_path)
+    rec.encoder = encoder
+    return rec
+
+def files(tmp_path):
+    return sorted(name[:-len(".json")]
+                  for name in glob.glob(os.path.join(str(tmp_path),"*.json")))
+
+def check(filename,shape,frames):
+    with open(filename + ".json") as f:
+        meta = json.load(f)
+    assert meta["shape"] == list(shape)
+    assert meta["frames"] == frames
+    assert meta["unwritten"] == 0
+    assert countFrames(filename) == frames
+    assert len(TimeIndex(filename)) == frames
+
+@pytest.mark.parametrize("encoder",[0,1,3])
+def test_format_switch_starts_new_file(tmp_path,encoder):
+    rec = recorder(tmp_path,encoder)
+    small,large = (120,160,3),(240,320,3)
+    # the recording catches up with a ring of the first format, the frames
+    # of the switched format are still queued
+    rec.pre_roll.seconds = 5
+    for nr,image in enumerate(makeFrames(small,6,dtype=np.uint8)):
+        rec.pre_roll.add(nr,image,30,seq=nr)
+    pool = FramePool(4)
+    for nr,image in enumerate(makeFrames(large,4,dtype=np.uint8)):
+        frame = pool.wrap(image)
+        frame.seq = 6 + nr
+        rec.record_queue.put([6 + nr,frame,30])
+    rec.record_queue.put([0,None,0])
+    rec.recordContinuous()
+    rec.quitEncoder()
+
+    first,second = files(tmp_path)
+    if "_P02" in first:
+        first,second = second,first
+    assert "_P02" in second
+    check(first,small,6)
+    check(second,large,4)
+    assert list(TimeIndex(second).seq) == [6,7,8,9]
+
+def test_pre_roll_keeps_formats_while_recording():
+    pre_roll = PreRoll(5)
+    pre_roll.add(0.0,np.zeros((4,6),np.uint8),30)
+    pre_roll.add(0.1,np.zeros((8,12),np.uint8),30,evict=False)
+    assert len(pre_roll) == 2
+    assert pre_roll.getFormat()[1] == (4,6)
+    # before a recording frames of the previous format are dropped
+    pre_roll.add(0.2,np.zeros((8,12),np.uint16),30)
+    assert len(pre_roll) == 1
+    assert pre_roll.getFormat()[2] == np.uint16
+
+def test_pre_roll_evicts_old_frames():
+    pre_roll = PreRoll(1)
+    for i in range(30):
+        pre_roll.add(i/8,np.full((4,6),i,np.uint8),8,seq=i)
+    # frames up to a second before the last one are kept
+    assert len(pre_roll) == 9
+    t,image,fps,seq,codec = pre_roll.pop()
+    assert [t,image[0,0],fps,seq,codec] == [21/8,21,8,21,None]
+
+def test_pre_roll_budget():
+    image = np.zeros((100,100),np.uint8)
+    pre_roll = PreRoll(10,budget=5*image.nbytes)
+    for i in range(10):
+        pre_roll.add(i*0.1,image,10)
+    assert len(pre_roll) == 4
+    assert pre_roll.getStats()["bytes"] == 4*image.nbytes
+    # while a recording catches up nothing is evicted
+    assert pre_roll.add(1.0,image,10,evict=False)
+    assert not pre_roll.add(1.1,image,10,evict=False)
+    assert len(pre_roll) == 5
+
+def test_pre_roll_compression():
+    pre_roll = PreRoll(10,compress=True)
+    image = np.full((48,64,3),100,np.uint8)
+    deep = np.full((48,64),1000,np.uint16)
+    jpeg = np.frombuffer(b"\xff\xd8jpeg",np.uint8)
+    pre_roll.add(0.0,image,30)
+    pre_roll.add(0.1,deep,30,evict=False)
+    pre_roll.add(0.2,jpeg,30,evict=False,codec="MJPG")
+    # JPEG holds 8 bits of 1 or 3 channels only, the others are copied
+    assert pre_roll.getStats()["bytes"] < image.nbytes + deep.nbytes + 8
+    decoded = pre_roll.pop()[1]
+    assert decoded.shape == image.shape
+    assert abs(decoded.astype(int) - 100).max() <= 2
+    assert np.array_equal(pre_roll.pop()[1],deep)
+    t,data,fps,seq,codec = pre_roll.pop()
+    assert codec == "MJPG" and data.tobytes() == jpeg.tobytes()
+
+def test_stop_does_not_block_on_full_queue(tmp_path):
+    rec = Recorder("test",FrameQueue(2),queue.Queue(1000),QMutex(),
+                   QWaitCondition())
+    rec.dir = str(tmp_path)
+    rec.pre_roll.seconds = 5
+    shape = (120,160,3)
+    images = makeFrames(shape,5,dtype=np.uint8)
+    for nr,image in enumerate(images[:3]):
+        rec.pre_roll.add(nr,image,30,seq=nr)
+    pool = FramePool(4)
+    for nr,image in enumerate(images[3:]):
+        frame = pool.wrap(image)
+        frame.seq = 3 + nr
+        rec.record_queue.put([3 + nr,frame,30])
+    rec.state.request(RUNNING)
+    stop = threading.Thread(target=rec.STOP,args=(0,))
+    stop.start()
+    stop.join(1)
+    assert not stop.is_alive()
+    # the frames queued before STOP are recorded
+    rec.recordContinuous()
+    rec.quitEncoder()
+    filename, = files(tmp_path)
+    check(filename,shape,5)
+
+def test_stop_requested_before_end_is_queued(tmp_path):
+    # the recorder takes the end of the recording and waits for the next
+    # state at once, it must not find RUNNING still requested
+    targets = []
+    class Queue(FrameQueue):
+        def put(self,item,block=True,timeout=None):
+            targets.append(rec.state.target)
+            super().put(item,block,timeout)
+    rec = Recorder("test",Queue(2),queue.Queue(1000),QMutex(),
+                   QWaitCondition())
+    rec.state.request(RUNNING)
+    rec.STOP(0)
+    assert targets == ["Stopped"]
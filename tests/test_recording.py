@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+from encoder import PipeWriter
+import recording
+from recording import (ENCODER_NAMES, PRESETS, countFrames, keepsDepth,
+                       openWriter, recordingName, startEncoder)
+from synthetic import makeFrames
+
+def encoder(name):
+    return ENCODER_NAMES.index(name)
+
+@pytest.mark.parametrize("name,shape,dtype,kept",[
+    ["thread",(48,64,3),np.uint8,True],
+    ["thread",(48,64),np.uint16,False],
+    ["huffyuv",(48,64,3),np.uint16,False],
+    ["ffv1",(48,64),np.uint16,True],
+    ["ffv1",(48,64,3),np.uint16,False],
+    ["ffv1-pipe",(48,64,3),np.uint16,True],
+    ["png",(48,64),np.uint16,True],
+    ["raw",(48,64,3),np.uint16,True]])
+def test_keeps_depth(name,shape,dtype,kept):
+    assert keepsDepth(encoder(name),shape,dtype) == kept
+
+def test_recording_names(tmp_path):
+    for nr,preset in enumerate(PRESETS):
+        filename = recordingName(str(tmp_path),"cam",(48,64),30,"_x",nr)
+        assert "_R64x48_F30_x" in filename
+        if preset[2] == "images":
+            assert os.path.splitext(filename)[1] == ""
+        else:
+            assert filename.endswith(preset[4])
+
+@pytest.mark.parametrize("name",["thread","process","segments","raw",
+                                 "mpeg4","huffyuv","png"])
+def test_presets_store_every_frame(tmp_path,name):
+    nr = encoder(name)
+    process = startEncoder(nr)
+    filename = recordingName(str(tmp_path),"cam",(48,64,3),30,encoder=nr)
+    try:
+        writer = openWriter(nr,process,filename,None,30,(48,64,3),np.uint8)
+        for i,image in enumerate(makeFrames((48,64,3),6,dtype=np.uint8)):
+            assert writer.write(image,float(i),i)
+        writer.release()
+    finally:
+        if process is not None:
+            process.quit()
+    assert countFrames(filename) == 6
+
+def test_images_keep_16_bits(tmp_path):
+    nr = encoder("png")
+    filename = recordingName(str(tmp_path),"cam",(48,64),30,encoder=nr)
+    image = np.arange(48*64,dtype=np.uint16).reshape(48,64) * 20
+    writer = openWriter(nr,None,filename,None,30,(48,64),np.uint16)
+    writer.write(image,0.0,0)
+    writer.release()
+    stored = cv2.imread(os.path.join(filename,"000000.png"),
+                        cv2.IMREAD_UNCHANGED)
+    assert np.array_equal(stored,image)
+
+def test_pipe_without_ffmpeg(tmp_path,monkeypatch):
+    monkeypatch.setattr(PipeWriter,"COMMAND","no-such-ffmpeg")
+    nr = encoder("x264-fast")
+    filename = recordingName(str(tmp_path),"cam",(48,64,3),30,encoder=nr)
+    assert openWriter(nr,None,filename,None,30,(48,64,3),np.uint8) is None
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None,reason="needs ffmpeg")
+def test_pipe_stores_every_frame(tmp_path):
+    nr = encoder("ffv1-pipe")
+    filename = recordingName(str(tmp_path),"cam",(48,64,3),30,encoder=nr)
+    writer = openWriter(nr,None,filename,None,30,(48,64,3),np.uint8)
+    for i,image in enumerate(makeFrames((48,64,3),6,dtype=np.uint8)):
+        assert writer.write(image,float(i),i)
+    writer.release()
+    assert countFrames(filename) == 6
+
+def test_self_benchmark():
+    result = recording.testEncoder(encoder("thread"),(48,64,3),np.uint8,
+                                   0.1)
+    assert result["fps"] > 0
+    assert result["bytes"] > 0
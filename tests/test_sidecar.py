@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+
+from encoder import OpenCVWriter
+from raw import RawWriter
+from recording import countFrames
+from sidecar import TimedWriter, TimeIndex
+
+def test_times_only_for_stored_frames(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.avi")
+    writer = TimedWriter(OpenCVWriter(filename,"MJPG",30,(120,160,3)),
+                         filename)
+    written = [writer.write(np.zeros(shape,np.uint8),t,t)
+               for t,shape in enumerate([(120,160,3),(240,320,3),
+                                         (120,160,3),(120,160)])]
+    writer.release()
+    assert written == [True,False,True,False]
+    assert countFrames(filename) == 2
+    times = TimeIndex(filename)
+    assert list(times.seq) == [0,2]
+
+def test_raw_writer_refuses_other_formats(tmp_path):
+    filename = os.path.join(str(tmp_path),"test.raw")
+    writer = TimedWriter(RawWriter(filename,30,(4,6),np.uint16,block=2),
+                         filename)
+    assert writer.write(np.ones((4,6),np.uint16),1.0)
+    assert not writer.write(np.ones((6,4),np.uint16),2.0)
+    # same shape, Y16 to GREY
+    assert not writer.write(np.ones((4,6),np.uint8),3.0)
+    assert writer.write(np.ones((4,6),np.uint16),4.0)
+    writer.release()
+    assert countFrames(filename) == len(TimeIndex(filename)) == 2
+    assert list(TimeIndex(filename).t) == [1.0,4.0]
@@ -0,0 +1,81 @@
+import numpy as np
+
+from pool import FramePool
+from queues import FrameQueue
+from stage import FrameStage
+
+def source(pool,image,seq=0):
+    frame = pool.wrap(image)
+    frame.seq = seq
+    return frame
+
+def test_pass_through():
+    pool = FramePool(0)
+    stage = FrameStage(pool)
+    frame = source(pool,np.zeros((8,10,3),np.uint8))
+    assert stage.apply(frame) is frame
+    assert stage.shape == (8,10,3)
+
+def test_crop_and_binning():
+    pool = FramePool(0)
+    stage = FrameStage(pool)
+    image = np.arange(8*10,dtype=np.uint16).reshape(8,10)
+    stage.setROI("2,1,5,6")
+    frame = source(pool,image,7)
+    frame.stamps["capture"] = 1.0
+    out = stage.apply(frame)
+    assert np.array_equal(out.image,image[1:7,2:7])
+    assert [out.seq,out.stamps] == [7,{"capture":1.0}]
+    # the source frame goes back to its pool right away
+    assert frame.refs == 0
+    out.release()
+    stage.setBinning(FrameStage.BINNINGS.index(2))
+    out = stage.apply(source(pool,image))
+    # whole bins only, each the mean of 2x2 pixels
+    assert out.image.shape == stage.shape == (3,2)
+    assert abs(out.image[0,0] - image[1:3,2:4].mean()) <= 0.5
+
+def test_region_beyond_the_frame():
+    pool = FramePool(0)
+    stage = FrameStage(pool)
+    image = np.zeros((8,10),np.uint8)
+    stage.setROI("6,4,100,100")
+    assert stage.apply(source(pool,image)).image.shape == (4,4)
+    stage.setROI("20,20,4,4")
+    frame = source(pool,image)
+    assert stage.apply(frame) is frame
+    stage.setROI("")
+    assert stage.roi is None
+
+def test_decimation():
+    pool = FramePool(0)
+    stage = FrameStage(pool)
+    stage.setDecimation(FrameStage.DECIMATIONS.index(3))
+    frames = [source(pool,np.zeros((2,2),np.uint8),seq) for seq in range(7)]
+    kept = [stage.apply(frame) for frame in frames]
+    assert [f.seq for f in kept if f is not None] == [0,3,6]
+    assert all(f.refs == 0 for f in frames if f.seq % 3)
+    assert stage.getRate(30) == 10
+    assert stage.getRate(10) == 10 / 3
+
+def test_output_buffers_are_pooled():
+    pool = FramePool(0)
+    stage = FrameStage(pool,size=2)
+    stage.setROI("0,0,4,4")
+    image = np.zeros((8,10),np.uint8)
+    stage.apply(source(pool,image)).release()
+    for i in range(5):
+        stage.apply(source(pool,image)).release()
+    assert stage.pool.getStats()["hits"] == 5
+
+def test_inactive_path_is_not_processed():
+    pool = FramePool(0)
+    stage = FrameStage(pool)
+    stage.setBinning(FrameStage.BINNINGS.index(2))
+    data_queue = FrameQueue(2,active=False)
+    frame = source(pool,np.zeros((8,10),np.uint8))
+    stage.offer(data_queue,[0.0,frame,30],0.0)
+    # the format of the frames is known without binning them
+    assert stage.shape == (4,5)
+    assert stage.pool.getStats()["misses"] == 0
+    assert frame.refs == 0
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from pool import FramePool
+from stats import Histogram, Latency
+
+@pytest.mark.parametrize("p",[50,95,99])
+def test_histogram_percentiles(p):
+    values = np.random.default_rng(0).lognormal(-6,1,10000)
+    histogram = Histogram()
+    for value in values:
+        histogram.add(value)
+    # buckets are 1/8 of a factor of two wide
+    assert histogram.percentile(p) == pytest.approx(np.percentile(values,p),
+                                                    rel=0.05)
+    assert histogram.max == values.max()
+    assert histogram.count == len(values)
+
+def test_histogram_range():
+    histogram = Histogram()
+    assert histogram.getStats()["p50"] == 0.0
+    histogram.add(0.0)
+    histogram.add(1e6)
+    assert histogram.counts[0] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.percentile(100) == 1e6
+    histogram.clear()
+    assert histogram.getStats() == {"count":0,"p50":0.0,"p95":0.0,
+                                    "p99":0.0,"max":0.0}
+
+def test_latency_spans():
+    latency = Latency()
+    stamps = {}
+    latency.stamp(stamps,"read",1.0)
+    latency.stamp(stamps,"capture",1.002)
+    latency.stamp(stamps,"display_enqueue",1.003)
+    latency.stamp(stamps,"display_dequeue",1.013)
+    latency.stamp(stamps,"convert",1.015)
+    latency.stamp(stamps,"paint",1.02)
+    stats = latency.getStats()
+    assert stats["Capture"]["max"] == pytest.approx(0.002)
+    assert stats["Display queue"]["max"] == pytest.approx(0.01)
+    assert stats["Screen"]["max"] == pytest.approx(0.018)
+    # spans the frame did not pass are empty
+    assert stats["Disk"]["count"] == 0
+    text = latency.getStatString()
+    assert "Screen 18.0" in text and "Disk" not in text
+
+def test_frames_stamp_their_pool():
+    pool = FramePool(1)
+    frame = pool.wrap(np.zeros((2,2),np.uint8))
+    frame.stamp("capture",2.0)
+    frame.stamp("analyzed",2.5)
+    assert pool.latency.getStats()["Analysis"]["max"] == 0.5
+    pool.clear()
+    assert pool.latency.getStats()["Analysis"]["count"] == 0
@@ -0,0 +1,33 @@
+import numpy as np
+
+from analysis import Analyzer
+from queues import FrameQueue
+from trigger import MeltPoolArea,Trigger
+
+def spot(size):
+    image = np.zeros((240,320,3),np.uint8)
+    image[100:100+size,100:100+size] = 255
+    return image
+
+def test_metric_detector_measures_the_frame():
+    detector = MeltPoolArea()
+    assert detector.measure(spot(0)) == 0
+    assert detector.measure(spot(40)) == 40 * 40
+    assert detector.measure(spot(80)) == 80 * 80
+
+def test_metric_detector_roi():
+    analyzer = Analyzer(FrameQueue(2))
+    detector = MeltPoolArea(analyzer)
+    analyzer.setROI("0,0,120,120")
+    # the 40x40 spot at 100,100 is cut to 20x20
+    assert detector.measure(spot(40)) == 20 * 20
+
+def test_metric_trigger_without_analysis():
+    trigger = Trigger(Analyzer(FrameQueue(2)))
+    trigger.setDetector(Trigger.NAMES.index("Trigger: Melt pool"))
+    trigger.setPostRoll(1)
+    assert not trigger.update(0.0,spot(0))
+    assert trigger.update(0.1,spot(40))
+    # within the post-roll, then off
+    assert trigger.update(1.0,spot(0))
+    assert not trigger.update(1.2,spot(0))
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import v4l2
+
+DATA = os.path.join(os.path.dirname(__file__),"data")
+
+def read(name):
+    with open(os.path.join(DATA,name)) as f:
+        return f.read()
+
+def test_formats_ext():
+    fffs = v4l2.parseFormatsExt(read("c920_formats_ext.txt"))
+    assert len(fffs) == 7 + 1 + 6
+    assert fffs[v4l2.formatKey("YUYV",640,480,30)] == ["YUYV",640,480,30]
+    assert fffs[v4l2.formatKey("MJPG",1920,1080,24)] == ["MJPG",1920,1080,24]
+    # frame rates are truncated to whole frames per second
+    assert fffs[v4l2.formatKey("YUYV",640,480,7)] == ["YUYV",640,480,7]
+    # sizes belong to the format above them
+    assert v4l2.formatKey("YUYV",1280,720,30) not in fffs
+
+def test_formats_ext_legacy():
+    fffs = v4l2.parseFormatsExt(read("legacy_formats_ext.txt"))
+    assert sorted(fffs.values()) == [["MJPG",1280,720,30],
+                                     ["MJPG",1280,720,60],
+                                     ["YUYV",320,240,30],
+                                     ["YUYV",640,480,15],
+                                     ["YUYV",640,480,30]]
+
+def test_formats_ext_mono():
+    fffs = v4l2.parseFormatsExt(read("mono_formats_ext.txt"))
+    # continuous intervals and stepwise sizes are left out
+    assert sorted(fffs.values()) == [["GREY",1280,1024,60],
+                                     ["Y10 ",1280,1024,60],
+                                     ["Y16 ",1280,1024,60]]
+
+def test_formats_ext_empty():
+    assert v4l2.parseFormatsExt("") == {}
+    text = "Cannot open device /dev/video9, exiting.\n"
+    assert v4l2.parseFormatsExt(text) == {}
+
+def test_devices():
+    assert v4l2.parseDevices(read("list_devices.txt")) == [
+        ["HD Pro Webcam C920","/dev/video0"],
+        ["bcm2835-codec-decode","/dev/video10"],
+        ["Integrated Camera: Integrated C","/dev/video2"]]
+
+def test_devices_empty():
+    assert v4l2.parseDevices("") == []
+
+@pytest.mark.parametrize("text,fff",[
+    ["MJPG:1280x720@30",["MJPG",1280,720,30]],
+    ["Y16:1280x1024@60",["Y16 ",1280,1024,60]],
+    ["Y10 :640x480@15",["Y10 ",640,480,15]]])
+def test_format(text,fff):
+    assert v4l2.parseFormat(text) == fff
+
+def test_format_invalid():
+    with pytest.raises(ValueError):
+        v4l2.parseFormat("1280x720")
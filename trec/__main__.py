@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The modules of TREC import each other by name
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+from headless import main
+
+if __name__ == '__main__':
+    sys.exit(main())
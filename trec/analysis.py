@@ -0,0 +1,350 @@
+"""
+Per-frame analysis of a source, off the capture and display threads.
+
+Metrics are plugins: a Metric subclass names its columns and computes them
+from an image. The Analyzer takes every frame the device offers to its queue,
+copies a downsampled (and optionally cropped) view, releases the frame and
+runs the metrics on a thread pool. numpy and OpenCV release the GIL, so the
+workers run in parallel without copying frames to other processes.
+
+Results are collected in capture order, shown live through getStatString()
+and, while a recording runs, written to <recording>.metrics.csv with the
+capture timestamps of the frames, on the clock of the recording .json.
+"""
+import collections
+import concurrent.futures
+import csv
+import math
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import mjpg
+from stage import parseROI
+from stats import RateMeter
+
+class Metric:
+    """
+    Base class of the metric plugins.
+
+    Subclasses set NAME and KEYS, the columns they add to the results, and
+    implement compute().
+    """
+    NAME = ""
+    KEYS = []
+
+    def compute(self,image,step,origin):
+        """
+        Returns one value per key.
+
+        Args:
+            image: (np.ndarray) Downsampled view, 2D or BGR(A).
+            step: (int) Frame pixels per view pixel along each axis.
+            origin: (tuple) Frame x,y of the top left view pixel.
+        """
+        raise NotImplementedError
+
+    def getStatString(self,values):
+        return "%s %s" % (self.NAME,"/".join("%.1f" % v for v in values))
+
+def toGray(image):
+    """
+    Returns the luminance of BGR(A) images, 2D images as they are.
+    """
+    if image.ndim == 3 and image.shape[2] == 3:
+        return cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        return cv2.cvtColor(image,cv2.COLOR_BGRA2GRAY)
+    return image
+
+class Focus(Metric):
+    """
+    Variance of the horizontal gradient along 20 columns, higher is sharper.
+    """
+    NAME = "Focus"
+    KEYS = ["focus"]
+    COLUMNS = 20
+
+    def compute(self,image,step,origin):
+        cols = np.linspace(0,image.shape[1]-1,num=self.COLUMNS,dtype=int)
+        sample = image[:,cols].astype(np.float32)
+        return [float(np.mean(np.var(np.diff(sample,axis=1),axis=1)))]
+
+    def getStatString(self,values):
+        return "Focus %.0f" % values[0]
+
+class Intensity(Metric):
+    """
+    Mean and maximum over all pixels and channels.
+    """
+    NAME = "Intensity"
+    KEYS = ["mean","max"]
+
+    def compute(self,image,step,origin):
+        return [float(image.mean()),float(image.max())]
+
+    def getStatString(self,values):
+        return "Mean %.1f, Max %.0f" % tuple(values)
+
+class MeltPool(Metric):
+    """
+    Area (in frame pixels) and centroid of the pixels with a luminance above
+    THRESHOLD of the full range of the dtype, the melt pool in DED footage.
+    """
+    NAME = "Melt pool"
+    KEYS = ["melt_area","melt_x","melt_y"]
+    THRESHOLD = 0.8
+
+    def compute(self,image,step,origin):
+        gray = toGray(image)
+        if np.issubdtype(gray.dtype,np.integer):
+            limit = np.iinfo(gray.dtype).max * self.THRESHOLD
+        else:
+            limit = self.THRESHOLD
+        moments = cv2.moments(cv2.compare(gray,limit,cv2.CMP_GT),True)
+        area = moments["m00"]
+        if area == 0:
+            return [0.0,math.nan,math.nan]
+        return [area * step * step,
+                origin[0] + moments["m10"] / area * step,
+                origin[1] + moments["m01"] / area * step]
+
+    def getStatString(self,values):
+        if not values[0]:
+            return "Melt pool -"
+        return "Melt pool %.0f px at %.0f,%.0f" % tuple(values)
+
+# Metrics run on every analyzed frame
+METRICS = [Focus,Intensity,MeltPool]
+
+class Analyzer(threading.Thread):
+    """
+    Analysis stage of one source.
+
+    Frames arrive through a FrameQueue, so a slow analysis drops frames by
+    the queue policy and never blocks the capture. At most workers frames
+    are analyzed at the same time.
+
+    Args:
+        data_queue: (FrameQueue) [capture time, frame] items.
+        step: (int) Downsampling of the analyzed view.
+        workers: (int) Threads computing metrics.
+        metrics: (list) Metric classes, METRICS by default.
+    """
+    # Selectable downsampling, the first is the default, 0 disables analysis
+    STEPS = [4,8,2,1,0]
+    STEP_NAMES = ["Analysis: 1/4","Analysis: 1/8","Analysis: 1/2",
+                  "Analysis: Full","Analysis: Off"]
+    # Results kept for recordings that start in the past
+    HISTORY = 20000
+    # Rows of a log that can be taken back when it ends
+    RECENT = 1000
+
+    def __init__(self,data_queue,step=4,workers=2,metrics=None):
+        super().__init__(daemon=True)
+        self.queue = data_queue
+        self.step = step
+        self.roi = None
+        self.workers = workers
+        self.metrics = [cls() for cls in (metrics or METRICS)]
+        self.keys = [key for metric in self.metrics for key in metric.KEYS]
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers,thread_name_prefix="analysis")
+        # [capture time, latency, stamps, future] in capture order
+        self.pending = collections.deque()
+        self.fps = RateMeter("Analysis")
+        self.latest = None
+        # Recent results, the pre-roll of a recording was analyzed before
+        self.history = collections.deque(maxlen=self.HISTORY)
+        self.log_lock = threading.Lock()
+        # [file, csv writer, start, until, recent rows] of the open logs,
+        # the one of a recording and the ending one of the file before it
+        self.logs = []
+
+    def setStep(self,index):
+        self.step = self.STEPS[index]
+        self.queue.setActive(self.step > 0)
+        if self.step == 0:
+            self.latest = None
+
+    def setROI(self,text):
+        """
+        Analyzes only the region of text, "x,y,width,height" in frame pixels,
+        or the whole frame if text is no such region, see stage.parseROI().
+        A region beyond the frame is clipped to it.
+        """
+        self.roi = parseROI(text)
+
+    def view(self,image,codec=None):
+        """
+        Returns a downsampled copy of the region of interest and its origin,
+        so the frame can go back to the pool right away. Compressed frames
+        (codec, see mjpg.py) are decoded at up to the downsampled scale.
+        The view is None if a compressed frame is corrupt.
+        """
+        step = max(self.step,1)
+        scale = 1
+        if codec is not None:
+            image,scale = mjpg.decode(image,step)
+            if image is None:
+                return None,step,(0,0)
+        x,y = 0,0
+        # may be changed from the GUI thread meanwhile
+        roi = self.roi
+        if roi is not None:
+            crop = image[roi[1]//scale:(roi[1]+roi[3])//scale,
+                         roi[0]//scale:(roi[0]+roi[2])//scale]
+            # a region outside the frame analyzes the whole frame
+            if crop.size:
+                image = crop
+                x,y = roi[0],roi[1]
+        rest = step // scale
+        if rest == 1:
+            # a decoded frame is a copy already
+            return image if codec else image.copy(),step,(x,y)
+        size = (max(image.shape[1]//rest,1),max(image.shape[0]//rest,1))
+        # nearest neighbour takes every step-th pixel, like slicing but faster
+        view = cv2.resize(image,size,interpolation=cv2.INTER_NEAREST)
+        return view,step,(x,y)
+
+    def analyze(self,image,step,origin):
+        values = []
+        for metric in self.metrics:
+            values += metric.compute(image,step,origin)
+        return values
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                self.collect()
+                self.closeIdleLog()
+                continue
+            if item is None:
+                break
+            ta,frame = item
+            image,step,origin = self.view(frame.image,frame.codec)
+            latency = frame.pool.latency
+            stamps = frame.stamps
+            frame.release()
+            if image is None:
+                continue
+            future = self.pool.submit(self.analyze,image,step,origin)
+            self.pending.append([ta,latency,stamps,future])
+            self.collect()
+
+        self.collect(wait=True)
+        self.pool.shutdown()
+        with self.log_lock:
+            for log in list(self.logs):
+                self.closeLog(log)
+
+    def collect(self,wait=False):
+        """
+        Handles the results of the analyzed frames in capture order, waiting
+        for the oldest while all workers are busy.
+        """
+        while self.pending:
+            ta,latency,stamps,future = self.pending[0]
+            if not (wait or future.done() or len(self.pending) > self.workers):
+                break
+            values = future.result()
+            self.pending.popleft()
+            self.handle(ta,values)
+            latency.stamp(stamps,"analyzed")
+
+    def handle(self,ta,values):
+        now = time.monotonic()
+        self.fps.add(now,now)
+        self.latest = values
+        with self.log_lock:
+            self.history.append([ta] + values)
+            for log in list(self.logs):
+                file,writer,start,until,rows = log
+                if until is not None and ta > until:
+                    self.closeLog(log)
+                elif ta >= start:
+                    rows.append([ta,file.tell()])
+                    writer.writerow([repr(ta)] + values)
+
+    def startLog(self,filename,start):
+        """
+        Writes the results of frames captured from start on next to a
+        recording, returns the name of the file. Results of frames before
+        the call (a pre-roll) are taken from the history. The log of the
+        previous file of a recording, ended by stopLog(), is written on up
+        to its end.
+
+        Args:
+            filename: (str) Recording filename.
+            start: (float) Capture time of the first recorded frame.
+        """
+        with self.log_lock:
+            # a log that was not stopped ends here
+            for log in self.logs:
+                if log[3] is None:
+                    log[3] = start
+            name = filename + ".metrics.csv"
+            file = open(name,"w",newline="")
+            writer = csv.writer(file)
+            writer.writerow(["time"] + self.keys)
+            for row in self.history:
+                if row[0] >= start:
+                    writer.writerow([repr(row[0])] + row[1:])
+            self.logs.append([file,writer,start,None,
+                              collections.deque(maxlen=self.RECENT)])
+        return name
+
+    def stopLog(self,until):
+        """
+        Ends the log after the results of the frames captured up to until,
+        when the recording stopped. Frames still queued or being analyzed are
+        written before the file is closed, results of later frames written
+        already (analysis runs ahead of the recorder) are removed.
+        """
+        if until is None:
+            until = -math.inf
+        with self.log_lock:
+            for log in self.logs:
+                if log[3] is not None:
+                    continue
+                log[3] = until
+                rows = log[4]
+                while rows and rows[-1][0] > until:
+                    log[0].seek(rows.pop()[1])
+                    log[0].truncate()
+
+    def closeIdleLog(self):
+        with self.log_lock:
+            if self.pending or not self.queue.empty():
+                return
+            for log in list(self.logs):
+                if log[3] is not None:
+                    self.closeLog(log)
+
+    def closeLog(self,log):
+        # called with log_lock held
+        log[0].close()
+        self.logs.remove(log)
+
+    def getStatString(self):
+        values = self.latest
+        if values is None:
+            return "Analysis: -"
+        texts = []
+        i = 0
+        for metric in self.metrics:
+            n = len(metric.KEYS)
+            texts.append(metric.getStatString(values[i:i+n]))
+            i += n
+        return "Analysis %05.1f fps: %s" % (self.fps.getRate()[0],
+                                              ", ".join(texts))
+
+    def quit(self):
+        self.queue.setActive(False)
+        self.queue.put(None)
+        self.join()
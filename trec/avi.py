@@ -0,0 +1,239 @@
+import os
+import struct
+
+import numpy as np
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+# RIFF sizes are 32 bit. Start a new segment well before they overflow.
+MAX_SEGMENT = 0xF0000000
+
+class AviWriter:
+    """
+    Minimal RIFF AVI muxer for already compressed MJPG frames.
+
+    Frames are appended as '00dc' chunks and indexed in an 'idx1' chunk when
+    the file is closed. A recording that outgrows a RIFF file is continued in
+    numbered segments (name_S001.avi, ...), each a complete AVI on its own.
+
+    Args:
+        filename: (str) Output filename, ending in .avi.
+        fps: (float) Frame rate stored in the header.
+        shape: (tuple) Frame shape, height and width are used.
+        fourcc: (str) Codec of the stored frames.
+    """
+    def __init__(self,filename,fps,shape,fourcc="MJPG"):
+        self.filename = filename
+        self.fps = fps
+        self.height = shape[0]
+        self.width = shape[1]
+        self.fourcc = fourcc.encode()
+        self.segment = 0
+        self.file = None
+        self._open(filename)
+
+    def _open(self,filename):
+        self.file = open(filename,"wb")
+        self.index = []
+        self.max_size = 0
+        self.file.write(self._header(0,0))
+        self.movi = self.file.tell() - 4
+
+    def _header(self,frames,riff_size):
+        scale = 1000
+        rate = int(round(self.fps * scale))
+        usec = int(round(1e6 / self.fps)) if self.fps else 0
+        avih = struct.pack("<14I",usec,0,0,AVIF_HASINDEX,frames,0,1,
+                           self.max_size,self.width,self.height,0,0,0,0)
+        strh = struct.pack("<4s4sIHHIIIIIIIIhhhh",b"vids",self.fourcc,0,0,0,
+                           0,scale,rate,0,frames,self.max_size,0xFFFFFFFF,0,
+                           0,0,self.width,self.height)
+        strf = struct.pack("<IiiHH4sIiiII",40,self.width,self.height,1,24,
+                           self.fourcc,self.width*self.height*3,0,0,0,0)
+        strl = (b"strl" + self._chunk(b"strh",strh)
+                + self._chunk(b"strf",strf))
+        hdrl = (b"hdrl" + self._chunk(b"avih",avih)
+                + self._chunk(b"LIST",strl))
+        return (struct.pack("<4sI4s",b"RIFF",riff_size,b"AVI ")
+                + self._chunk(b"LIST",hdrl)
+                + struct.pack("<4sI4s",b"LIST",0,b"movi"))
+
+    def _chunk(self,fourcc,data):
+        pad = b"\0" if len(data) % 2 else b""
+        return struct.pack("<4sI",fourcc,len(data)) + data + pad
+
+    def isOpened(self):
+        return self.file is not None
+
+    def getFilenames(self):
+        names = [self.filename]
+        for i in range(1,self.segment+1):
+            names.append(self.segmentName(i))
+        return names
+
+    def segmentName(self,nr):
+        return "%s_S%03d.avi" % (self.filename[:-4],nr)
+
+    def writeFrame(self,data):
+        """
+        Appends one compressed frame.
+
+        Args:
+            data: (bytes) Compressed frame, e.g. a complete JPEG image.
+        """
+        size = len(data)
+        if self.file.tell() + size + 16*(len(self.index)+2) > MAX_SEGMENT:
+            self._close()
+            self.segment += 1
+            self._open(self.segmentName(self.segment))
+
+        offset = self.file.tell() - self.movi
+        self.file.write(self._chunk(b"00dc",data))
+        self.index.append((offset,size))
+        self.max_size = max(self.max_size,size)
+
+    def _close(self):
+        movi_end = self.file.tell()
+        idx = bytearray()
+        for offset,size in self.index:
+            idx += struct.pack("<4sIII",b"00dc",AVIIF_KEYFRAME,offset,size)
+        self.file.write(self._chunk(b"idx1",bytes(idx)))
+        riff_size = self.file.tell() - 8
+        # rewrite the header now that frame count and sizes are known
+        self.file.seek(0)
+        self.file.write(self._header(len(self.index),riff_size))
+        self.file.seek(self.movi - 4)
+        self.file.write(struct.pack("<I",movi_end - self.movi))
+        self.file.close()
+        self.file = None
+
+    def release(self):
+        if self.file is not None:
+            self._close()
+
+class FrameIndex:
+    """
+    Frame number to byte offset/size/keyframe index of an AVI file.
+
+    The index is built once by walking the RIFF chunks (including OpenDML
+    AVIX continuations) and cached, so seeking in long recordings does not
+    require decoding everything before the requested frame.
+
+    Args:
+        offsets: (ndarray) File offset of the data of each frame.
+        sizes: (ndarray) Size in bytes of each frame.
+        keyframes: (ndarray) True for frames that can be decoded on their own.
+        fourcc: (str) Codec of the video stream.
+    """
+    # Codecs where every frame is a complete image
+    INTRA = ("MJPG","mjpg","JPEG","jpeg")
+
+    def __init__(self,offsets,sizes,keyframes,fourcc):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.keyframes = keyframes
+        self.fourcc = fourcc
+        self.keys = np.flatnonzero(keyframes)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def isIntra(self):
+        return self.fourcc in self.INTRA
+
+    def getKeyframe(self,nr):
+        """
+        Returns the last keyframe at or before frame nr.
+        """
+        i = np.searchsorted(self.keys,nr,side="right") - 1
+        return int(self.keys[max(i,0)]) if len(self.keys) else 0
+
+    def readFrame(self,file,nr):
+        """
+        Returns the stored bytes of frame nr. Empty (repeated) frames resolve
+        to the last frame with data before them.
+        """
+        while nr > 0 and self.sizes[nr] == 0:
+            nr -= 1
+        file.seek(int(self.offsets[nr]))
+        return file.read(int(self.sizes[nr]))
+
+    @classmethod
+    def load(cls,filename,cache_dir):
+        """
+        Loads the cached index of filename or builds and caches it. Returns
+        None if the file is not an AVI.
+        """
+        stat = os.stat(filename)
+        ident = np.array([stat.st_size,stat.st_mtime_ns],np.int64)
+        cache = os.path.join(cache_dir,os.path.basename(filename)+".npz")
+        if os.path.exists(cache):
+            try:
+                with np.load(cache) as c:
+                    if np.array_equal(c["ident"],ident):
+                        return cls(c["offsets"],c["sizes"],c["keyframes"],
+                                   str(c["fourcc"]))
+            except (OSError,ValueError,KeyError):
+                pass
+
+        index = cls.build(filename)
+        if index is not None:
+            os.makedirs(cache_dir,exist_ok=True)
+            np.savez(cache,ident=ident,offsets=index.offsets,
+                     sizes=index.sizes,keyframes=index.keyframes,
+                     fourcc=index.fourcc)
+        return index
+
+    @classmethod
+    def build(cls,filename):
+        with open(filename,"rb") as f:
+            if f.read(12)[8:] != b"AVI ":
+                return None
+            f.seek(0)
+            state = {"streams":[],"fourcc":"","chunks":[],"idx1":None}
+            cls._scan(f,os.path.getsize(filename),state)
+
+        video = [i for i,s in enumerate(state["streams"]) if s == b"vids"]
+        if not video:
+            return None
+        sid = b"%02d" % video[0]
+        chunks = [(p,s) for c,p,s in state["chunks"] if c[:2] == sid]
+        offsets = np.array([p for p,s in chunks],np.int64)
+        sizes = np.array([s for p,s in chunks],np.int64)
+        intra = state["fourcc"] in cls.INTRA
+        keyframes = np.full(len(chunks),intra,bool)
+        if len(chunks):
+            keyframes[0] = True
+        idx1 = state["idx1"]
+        if idx1 is not None and not intra:
+            flags = idx1["flags"][[c[:2] == sid for c in idx1["id"]]]
+            n = min(len(flags),len(keyframes))
+            keyframes[:n] |= (flags[:n] & AVIIF_KEYFRAME) > 0
+        return cls(offsets,sizes,keyframes,state["fourcc"])
+
+    @classmethod
+    def _scan(cls,f,end,state):
+        while f.tell() + 8 <= end:
+            fourcc,size = struct.unpack("<4sI",f.read(8))
+            pos = f.tell()
+            stop = min(pos + size,end) if size else end
+            if fourcc in (b"RIFF",b"LIST"):
+                # skip the list type, the chunks inside follow it
+                f.seek(pos+4)
+                cls._scan(f,stop,state)
+                f.seek(stop)
+                continue
+            elif fourcc == b"strh":
+                state["streams"].append(f.read(4))
+            elif fourcc == b"strf" and state["streams"][-1:] == [b"vids"]:
+                if not state["fourcc"]:
+                    f.seek(pos+16)
+                    state["fourcc"] = f.read(4).decode("ascii","replace")
+            elif fourcc == b"idx1":
+                dtype = np.dtype([("id","S4"),("flags","<u4"),
+                                  ("offset","<u4"),("size","<u4")])
+                data = f.read(size - size % dtype.itemsize)
+                state["idx1"] = np.frombuffer(data,dtype)
+            elif fourcc[2:] in (b"dc",b"db"):
+                state["chunks"].append((fourcc,pos,size))
+            f.seek(pos + size + (size & 1))
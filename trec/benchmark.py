@@ -0,0 +1,490 @@
+"""
+Throughput benchmarks for TREC pipeline stages.
+
+Run from the trec directory, e.g.:
+
+    python benchmark.py segments --size 1920x1080 --workers 1 2 4 8
+    python benchmark.py latency
+    python benchmark.py pipeline --size 1920x1080 --fps 60 --json result.json
+    python benchmark.py convert
+    python benchmark.py passthrough
+    python benchmark.py encoders --size 1920x1080
+    python benchmark.py switch --formats 0 1
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from encoder import EncoderPool,SegmentWriter,OpenCVWriter,PassthroughWriter
+from pool import FramePool
+from queues import FrameQueue
+from synthetic import FORMATS,SyntheticCapture,formatName,makeFrames
+from recording import (
+    ENCODER_NAMES,
+    startEncoder,
+    recordingName,
+    openWriter,
+    countFrames,
+    testEncoder
+)
+
+# Queue depths of the GUI pipeline
+DISPLAY_Q = 3
+RECORD_Q = 8
+
+def benchSegments(shape,workers,frames=300,chunk=8):
+    """
+    Encodes the same frames with a SegmentWriter for every worker count.
+
+    Returns:
+        (list) Dicts with workers, frames, seconds and fps.
+    """
+    images = makeFrames(shape)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for nr in workers:
+            pool = EncoderPool(nr)
+            filename = os.path.join(tmp,"bench_%d.avi" % nr)
+            writer = SegmentWriter(pool,filename,30,shape,chunk=chunk)
+            t = time.perf_counter()
+            for i in range(frames):
+                writer.write(images[i % len(images)])
+            writer.release()
+            t = time.perf_counter() - t
+            pool.quit()
+            results.append({"workers":nr,"frames":frames,"seconds":t,
+                            "fps":frames / t})
+    return results
+
+def benchLatency(frames=100000,fps=120):
+    """
+    Measures the cost of the latency instrumentation of one frame: stamping
+    every stage of the display and record path, as a pipeline does.
+
+    Returns:
+        (dict) Seconds per frame and share of the frame budget at fps.
+    """
+    pool = FramePool(1)
+    stages = ["read","capture","display_enqueue","record_enqueue",
+              "display_dequeue","convert","paint","record_dequeue","write"]
+    t = time.perf_counter()
+    for i in range(frames):
+        frame = pool.acquire()
+        for stage in stages:
+            frame.stamp(stage)
+        frame.release()
+    t = time.perf_counter() - t
+    # acquiring and releasing the frame is not instrumentation
+    t0 = time.perf_counter()
+    for i in range(frames):
+        pool.acquire().release()
+    t -= time.perf_counter() - t0
+    per_frame = t / frames
+    return {"frames":frames,"seconds":per_frame,
+            "budget":per_frame * fps * 100}
+
+def legacyToQImage(im):
+    """
+    Display conversion before the copy-free path: float64 min/max
+    normalization of non-uint8 images and a channel swapping copy, for
+    comparison. Single channel images were not supported.
+    """
+    from PyQt5.QtGui import QImage
+
+    if im.dtype != np.uint8:
+        im = im.astype(np.float64)
+        im = (im - np.amin(im) ) / (np.amax(im) - np.amin(im) )*255
+        im = im.astype(np.uint8)
+    fmt = QImage.Format_RGB888 if im.shape[2] == 3 else QImage.Format_ARGB32
+    qim = QImage(im.data,im.shape[1],im.shape[0],im.strides[0],fmt)
+    return qim.rgbSwapped()
+
+def benchConvert(sizes,frames=20,repeat=5):
+    """
+    Measures the conversion of a full resolution frame to a QPixmap, before
+    (legacyToQImage) and after (Display.toQImage), for 3 channel uint8,
+    3 channel uint16 and mono uint8 frames.
+
+    Returns:
+        (list) Dicts with size, type and milliseconds per frame before and
+            after, before is None where the old path did not work.
+    """
+    from PyQt5.QtGui import QGuiApplication,QPixmap
+    from display import Display
+
+    app = QGuiApplication.instance() or QGuiApplication(["benchmark"])
+    display = Display(FrameQueue(1))
+    paths = [["before",legacyToQImage],["after",display.toQImage]]
+    results = []
+    for width,height in sizes:
+        for channels,dtype in [[3,"uint8"],[3,"uint16"],[1,"uint8"]]:
+            shape = (height,width,channels) if channels > 1 else (height,width)
+            images = makeFrames(shape,4,dtype=dtype)
+            result = {"size":"%dx%d" % (width,height),
+                      "type":"%d ch %s" % (channels,dtype)}
+            for name,toQImage in paths:
+                if channels == 1 and toQImage is legacyToQImage:
+                    result[name] = None
+                    continue
+                best = None
+                # the fastest of a few runs, the others were disturbed
+                for run in range(repeat):
+                    t = time.perf_counter()
+                    for i in range(frames):
+                        QPixmap.fromImage(toQImage(images[i % len(images)]))
+                    t = time.perf_counter() - t
+                    best = t if best is None else min(best,t)
+                result[name] = best / frames * 1e3
+            results.append(result)
+    return results
+
+def benchPassthrough(sizes,frames=60,repeat=3):
+    """
+    Measures the CPU time of recording an MJPG camera per frame: decoding
+    the JPEG frames and encoding them again with cv2.VideoWriter, as
+    without passthrough, versus muxing them as they are (PassthroughWriter).
+
+    Returns:
+        (list) Dicts with size and CPU milliseconds per frame of both paths.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for width,height in sizes:
+            shape = (height,width,3)
+            data = [cv2.imencode(".jpg",image)[1].reshape(1,-1)
+                    for image in makeFrames(shape)]
+            filename = os.path.join(tmp,"bench.avi")
+
+            def reencode():
+                writer = OpenCVWriter(filename,"MJPG",30,shape)
+                for i in range(frames):
+                    image = cv2.imdecode(data[i % len(data)],cv2.IMREAD_COLOR)
+                    writer.write(image)
+                writer.release()
+
+            def passthrough():
+                writer = PassthroughWriter(filename,30,shape)
+                for i in range(frames):
+                    writer.write(data[i % len(data)])
+                writer.release()
+
+            result = {"size":"%dx%d" % (width,height)}
+            for name,run in [["reencode",reencode],
+                             ["passthrough",passthrough]]:
+                best = None
+                # the fastest of a few runs, the others were disturbed
+                for i in range(repeat):
+                    t = time.process_time()
+                    run()
+                    t = time.process_time() - t
+                    best = t if best is None else min(best,t)
+                result[name] = best / frames * 1e3
+            results.append(result)
+    return results
+
+def benchSwitch(indexes,rounds=3,settle=0.3):
+    """
+    Switches a running SyntheticDevice round the formats of indexes and
+    measures the time from the request to the first frame of the new format,
+    see device.SyntheticDevice.switchFormat(). The first switch between two
+    formats sets them up, the repeats reuse their configuration.
+
+    Returns:
+        (list) Dicts with the formats, the first and the median repeated
+        switch in milliseconds, and the pool allocations per round.
+    """
+    from PyQt5.QtCore import QMutex,QWaitCondition
+    from device import SyntheticDevice
+    from state import RUNNING
+
+    # frames are released right away, only capture is measured
+    queues = [FrameQueue(size,active=False)
+              for size in (DISPLAY_Q,RECORD_Q,DISPLAY_Q)]
+    frame_pool = FramePool(DISPLAY_Q + RECORD_Q + 4)
+    device = SyntheticDevice("Synthetic","synthetic",*queues,frame_pool,
+                             QMutex(),QWaitCondition())
+    device.setReader(indexes[0])
+    thread = threading.Thread(target=device.loop)
+    thread.start()
+    device.START(0)
+    device.state.waitFor(RUNNING)
+    time.sleep(settle)
+    allocs = []
+    for i in range(rounds):
+        before = frame_pool.getStats()["allocs"]
+        for index in indexes[1:] + indexes[:1]:
+            device.setFFF(index)
+            time.sleep(settle)
+        allocs.append(frame_pool.getStats()["allocs"] - before)
+    device.QUIT()
+    thread.join()
+
+    results = []
+    for (old,new),(first,repeat,nr) in device.switches.getStats().items():
+        results.append({"from":old,"to":new,"first":first * 1e3,
+                        "repeat":None if repeat is None else repeat * 1e3,
+                        "allocs":allocs})
+    return results
+
+class Stage(threading.Thread):
+    """
+    Consumer thread of one pipeline stage, counting frames and the CPU time
+    of its own thread.
+    """
+    def __init__(self,data_queue,process):
+        super().__init__(daemon=True)
+        self.queue = data_queue
+        self.process = process
+        self.frames = 0
+        self.cpu = 0.0
+
+    def run(self):
+        cpu = time.thread_time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.process(item[1])
+            item[1].release()
+            self.frames += 1
+        self.cpu = time.thread_time() - cpu
+
+def runPipeline(shape,dtype,fps,seconds,encoder,policy,directory):
+    """
+    Runs synthetic capture -> display conversion (Display.toQImage) ->
+    recording for a number of seconds, with the queues and
+    writers of the GUI pipeline, each stage on its own thread.
+
+    Returns:
+        (dict) Capture rate, frames, CPU per frame and queue accounting of
+            each stage, and latency percentiles.
+    """
+    from display import Display
+
+    channels = shape[2] if len(shape) == 3 else 1
+    capture = SyntheticCapture(shape[1],shape[0],channels,dtype,fps)
+    frame_pool = FramePool(DISPLAY_Q + RECORD_Q + 3)
+    display_q = FrameQueue(DISPLAY_Q,policy,name="display")
+    record_q = FrameQueue(RECORD_Q,policy,name="record")
+    display = Display(display_q)
+
+    def convert(frame):
+        display.toQImage(frame.image)
+        frame.stamp("convert")
+
+    process = startEncoder(encoder)
+    filename = recordingName(directory,"bench",shape,fps or 30,
+                             encoder=encoder)
+    writer = openWriter(encoder,process,filename,None,fps or 30,shape,dtype)
+
+    def write(frame):
+        writer.write(frame.image,frame.stamps["capture"])
+        frame.stamp("write")
+
+    stages = {"display":Stage(display_q,convert),"record":Stage(record_q,write)}
+    for stage in stages.values():
+        stage.start()
+
+    frames = 0
+    cpu = time.thread_time()
+    start = time.monotonic()
+    deadline = start + seconds
+    while time.monotonic() < deadline:
+        tb = time.monotonic()
+        frame = frame_pool.acquire()
+        retval,image = capture.read(frame.image)
+        ta = time.monotonic()
+        frame = frame_pool.adopt(frame,image).retain()
+        frame.stamp("read",tb)
+        frame.stamp("capture",ta)
+        display_q.offer(["",frame],ta)
+        record_q.offer([ta,frame,fps],ta)
+        frames += 1
+    elapsed = time.monotonic() - start
+    cpu = time.thread_time() - cpu
+
+    for data_queue,stage in zip((display_q,record_q),stages.values()):
+        data_queue.put(None)
+        stage.join()
+    done = time.monotonic() - start
+    writer.release()
+    if process is not None:
+        process.quit()
+
+    result = {"fps":frames / elapsed,
+              "seconds":done,
+              "stages":{"capture":{"frames":frames,
+                                   "cpu_per_frame":cpu / max(frames,1)}}}
+    for name,stage in stages.items():
+        stats = (display_q if name == "display" else record_q).getStats()
+        result["stages"][name] = {
+            "frames":stage.frames,
+            "fps":stage.frames / done,
+            "cpu_per_frame":stage.cpu / max(stage.frames,1),
+            "produced":stats["produced"],
+            "delivered":stats["delivered"],
+            "dropped":stats["dropped"]}
+    # frames handed to a writer that it did not store do not count
+    record = result["stages"]["record"]
+    record["written"] = countFrames(filename)
+    record["fps"] = record["written"] / done
+    latency = frame_pool.latency.getStats()
+    result["latency"] = {name:latency[name] for name in ("Screen","Disk")}
+    # Paint happens in the GUI, measured up to the conversion here
+    result["latency"]["Convert"] = latency["Convert"]
+    return result
+
+def benchPipeline(shape,dtype,fps,seconds,encoder,policy):
+    """
+    Measures the pipeline twice: unthrottled with blocking queues, where the
+    slowest stage sets the rate (max sustainable fps), and at the requested
+    frame rate and policy, which shows the drops per stage.
+
+    Returns:
+        (dict) Machine-readable results with the configuration and versions.
+    """
+    encoder = ENCODER_NAMES.index(encoder)
+    with tempfile.TemporaryDirectory() as tmp:
+        maximum = runPipeline(shape,dtype,0,seconds,encoder,"Block",tmp)
+        rate = runPipeline(shape,dtype,fps,seconds,encoder,policy,tmp)
+    record = maximum["stages"]["record"]
+    warnings = []
+    for name,run in (("max",maximum),("rate",rate)):
+        stage = run["stages"]["record"]
+        if stage["written"] < stage["frames"]:
+            warnings.append("%s run: %d of %d frames written" % (
+                name,stage["written"],stage["frames"]))
+    return {"benchmark":"pipeline",
+            "config":{"shape":list(shape),"dtype":np.dtype(dtype).str,
+                      "fps":fps,"seconds":seconds,
+                      "encoder":ENCODER_NAMES[encoder],"policy":policy},
+            "versions":{"python":platform.python_version(),
+                        "numpy":np.__version__,"opencv":cv2.__version__},
+            "machine":{"platform":platform.platform(),
+                       "cpus":os.cpu_count()},
+            "max_fps":record["fps"],
+            "warnings":warnings,
+            "max":maximum,
+            "rate":rate}
+
+def parseSize(text):
+    width,height = text.lower().split("x")
+    return (int(height),int(width),3)
+
+def parseShape(text,channels):
+    height,width,_ = parseSize(text)
+    return (height,width,channels)
+
+def main():
+    parser = argparse.ArgumentParser(description="TREC benchmarks")
+    sub = parser.add_subparsers(dest="bench",required=True)
+    seg = sub.add_parser("segments",help="segmented encoding fps vs workers")
+    seg.add_argument("--size",default="1920x1080",type=parseSize)
+    seg.add_argument("--workers",default=[1,2,4],type=int,nargs="+")
+    seg.add_argument("--frames",default=300,type=int)
+    seg.add_argument("--chunk",default=8,type=int)
+    lat = sub.add_parser("latency",help="latency instrumentation cost")
+    lat.add_argument("--frames",default=100000,type=int)
+    lat.add_argument("--fps",default=120,type=float)
+    pipe = sub.add_parser("pipeline",
+                          help="synthetic capture, display and recording")
+    pipe.add_argument("--size",default="1280x720")
+    pipe.add_argument("--channels",default=3,type=int,choices=[3,4])
+    pipe.add_argument("--dtype",default="uint8",choices=["uint8","uint16"])
+    pipe.add_argument("--fps",default=60,type=float)
+    pipe.add_argument("--seconds",default=5,type=float)
+    pipe.add_argument("--encoder",default="thread",choices=ENCODER_NAMES)
+    pipe.add_argument("--policy",default=FrameQueue.POLICIES[0],
+                      choices=FrameQueue.POLICIES)
+    pipe.add_argument("--json",default=None,help="write results to file")
+    conv = sub.add_parser("convert",help="frame to pixmap conversion cost")
+    conv.add_argument("--sizes",default=["640x480","1280x720","1920x1080",
+                                         "3840x2160"],nargs="+")
+    conv.add_argument("--frames",default=20,type=int)
+    conv.add_argument("--repeat",default=5,type=int)
+    enc = sub.add_parser("encoders",
+                         help="sustained fps and size of every encoder preset")
+    enc.add_argument("--size",default="1920x1080")
+    enc.add_argument("--channels",default=3,type=int,choices=[1,3,4])
+    enc.add_argument("--dtype",default="uint8",choices=["uint8","uint16"])
+    enc.add_argument("--seconds",default=2.0,type=float)
+    enc.add_argument("--encoders",default=ENCODER_NAMES,nargs="+",
+                     choices=ENCODER_NAMES)
+    mjpg = sub.add_parser("passthrough",
+                          help="MJPG recording, re-encoded vs passthrough")
+    mjpg.add_argument("--sizes",default=["640x480","1280x720","1920x1080",
+                                         "3840x2160"],nargs="+")
+    mjpg.add_argument("--frames",default=60,type=int)
+    mjpg.add_argument("--repeat",default=3,type=int)
+    switch = sub.add_parser("switch",
+                            help="format switch latency, first vs repeated")
+    switch.add_argument("--formats",default=[0,1],type=int,nargs="+",
+                        choices=range(len(FORMATS)),
+                        help="synthetic formats: " + ", ".join(
+                            "%d %s" % (i,formatName(*f))
+                            for i,f in enumerate(FORMATS)))
+    switch.add_argument("--rounds",default=3,type=int)
+    args = parser.parse_args()
+
+    if args.bench == "segments":
+        print("%8s %10s" % ("workers","fps"))
+        for r in benchSegments(args.size,args.workers,args.frames,args.chunk):
+            print("%8d %10.1f" % (r["workers"],r["fps"]))
+    elif args.bench == "latency":
+        r = benchLatency(args.frames,args.fps)
+        print("%.2f us per frame, %.3f %% of the frame budget at %g fps" % (
+            r["seconds"]*1e6,r["budget"],args.fps))
+    elif args.bench == "pipeline":
+        shape = parseShape(args.size,args.channels)
+        r = benchPipeline(shape,args.dtype,args.fps,args.seconds,
+                          args.encoder,args.policy)
+        text = json.dumps(r,indent=1)
+        if args.json:
+            with open(args.json,"w") as f:
+                f.write(text)
+        print(text)
+        for warning in r["warnings"]:
+            print("Warning: %s, max fps is of the written frames" % warning)
+    elif args.bench == "convert":
+        sizes = [parseSize(size)[1::-1] for size in args.sizes]
+        print("%10s %10s %12s %12s" % ("size","type","before ms","after ms"))
+        for r in benchConvert(sizes,args.frames,args.repeat):
+            before = "-" if r["before"] is None else "%.2f" % r["before"]
+            print("%10s %10s %12s %12.2f" % (r["size"],r["type"],before,
+                                             r["after"]))
+    elif args.bench == "encoders":
+        height,width,_ = parseSize(args.size)
+        shape = (height,width,args.channels) if args.channels > 1 else (
+            height,width)
+        print("%-32s %10s %12s" % ("encoder","fps","MB/frame"))
+        for name in args.encoders:
+            r = testEncoder(ENCODER_NAMES.index(name),shape,args.dtype,
+                            args.seconds)
+            fps = "%.1f" % r["fps"] if r["fps"] else "n/a"
+            print("%-32s %10s %12.3f" % (r["encoder"],fps,r["bytes"]/2**20))
+    elif args.bench == "passthrough":
+        sizes = [parseSize(size)[1::-1] for size in args.sizes]
+        print("%10s %15s %15s" % ("size","re-encode ms","passthrough ms"))
+        for r in benchPassthrough(sizes,args.frames,args.repeat):
+            print("%10s %15.2f %15.2f" % (r["size"],r["reencode"],
+                                          r["passthrough"]))
+    elif args.bench == "switch":
+        results = benchSwitch(args.formats,args.rounds)
+        print("%-36s %-36s %10s %10s" % ("from","to","first ms",
+                                         "repeat ms"))
+        for r in results:
+            repeat = "-" if r["repeat"] is None else "%.1f" % r["repeat"]
+            print("%-36s %-36s %10.1f %10s" % (r["from"],r["to"],r["first"],
+                                               repeat))
+        if results:
+            print("pool allocations per round: %s" % results[0]["allocs"])
+
+if __name__ == '__main__':
+    main()
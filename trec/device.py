@@ -1,18 +1,49 @@
 import numpy as np       
 import cv2                     
 import time
-import subprocess
-import re
+import collections
+import json
 import os
-
-from PyQt5.QtCore import QObject,QMutex,QWaitCondition,QThread,pyqtSignal
+import threading
+
+from PyQt5.QtCore import (
+    QObject,
+    QMutex,
+    QWaitCondition,
+    QThread,
+    QTimer,
+    QFileSystemWatcher,
+    pyqtSignal
+)
+
+import mjpg
+import mono
+from raw import RawReader
+from sidecar import TimeIndex
+from stage import FrameStage
+from avi import FrameIndex
+from playback import Pacer,ReadAhead
+from state import StateMachine,STOPPED,RUNNING,QUIT
+from stats import RateMeter,SwitchTimer
+from synthetic import FORMATS,formatName,SyntheticCapture
+import v4l2
+
+# Capture modes of cameras: MJPG frames are decoded by the driver, or passed
+# through as compressed and decoded only where they are shown or analyzed
+CAPTURES = ["Capture: Decode","Capture: MJPG passthrough"]
 
 class DeviceHandler(QObject):
-    def __init__(self,display_queue,record_queue,device_classes):
+    def __init__(self,display_queue,record_queue,analysis_queue,frame_pool,
+                 device_classes,stages=None):
         super(self.__class__, self).__init__()
     
         self.display_queue = display_queue
         self.record_queue = record_queue        
+        self.analysis_queue = analysis_queue
+        self.frame_pool = frame_pool
+        # Display and record FrameStage of capture devices
+        self.stages = stages
+        self.pool_size = frame_pool.size
         self.device_classes = device_classes   
         self.device = None 
         self.mutex = QMutex()
@@ -23,13 +54,19 @@ class DeviceHandler(QObject):
         return self.device_classes
 
     def setDevice(self,dev_cls,name,path):
-
+        # pool statistics are reported per opened device
+        self.frame_pool.clear()
+        self.frame_pool.setSize(self.pool_size)
+        kwargs = {} if self.stages is None else {"stages":self.stages}
         self.device = dev_cls(
             name,path,
             self.display_queue,
             self.record_queue,
+            self.analysis_queue,
+            self.frame_pool,
             self.mutex,
-            self.wait
+            self.wait,
+            **kwargs
         )
         
         self.thread = QThread()
@@ -49,30 +86,176 @@ class DeviceHandler(QObject):
         else:
             return None
 
+class DiscoveryHandler(QObject):
+    """
+    Runs source discovery in its own thread and feeds the GUI menu.
+    """
+    def __init__(self,gui,device_classes):
+        super(self.__class__, self).__init__()
+
+        self.discovery = SourceDiscovery(device_classes)
+        self.discovery.sourceAdded.connect(gui.addSource)
+        self.discovery.sourceRemoved.connect(gui.removeSource)
+        self.thread = QThread()
+        self.discovery.moveToThread(self.thread)
+        self.thread.started.connect(self.discovery.start)
+        self.thread.start()
+
+    def quitDiscovery(self):
+        self.thread.quit()
+        self.thread.wait()
+
+class SourceDiscovery(QObject):
+    """
+    Lists the sources of every device class off the GUI thread and keeps the
+    list up to date. The directories a class reports through getWatchPaths()
+    are watched, and a change rescans that class and reports only the sources
+    that were added or removed.
+    """
+    sourceAdded = pyqtSignal(object,str,str)
+    sourceRemoved = pyqtSignal(object,str,str)
+
+    # Bursts of directory changes are handled in one rescan
+    DEBOUNCE_MS = 250
+
+    def __init__(self,device_classes):
+        super(self.__class__, self).__init__()
+
+        self.device_classes = device_classes
+        self.sources = {cls:set() for cls in device_classes}
+        self.changed = set()
+
+    def start(self):
+        # created here so they live in the discovery thread
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.onChanged)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.rescan)
+
+        for cls in self.device_classes:
+            self.scan(cls)
+            paths = [p for p in cls.getWatchPaths() if os.path.isdir(p)]
+            if paths:
+                self.watcher.addPaths(paths)
+
+    def onChanged(self,path):
+        watched = os.path.normpath(path)
+        for cls in self.device_classes:
+            paths = [os.path.normpath(p) for p in cls.getWatchPaths()]
+            if watched in paths:
+                self.changed.add(cls)
+        self.timer.start(self.DEBOUNCE_MS)
+
+    def rescan(self):
+        changed,self.changed = self.changed,set()
+        for cls in self.device_classes:
+            if cls in changed:
+                self.scan(cls)
+
+    def scan(self,cls):
+        try:
+            found = {(name,path) for name,path in cls.getPaths()}
+        except (OSError,ValueError):
+            found = set()
+
+        for name,path in sorted(found - self.sources[cls]):
+            self.sourceAdded.emit(cls,name,path)
+        for name,path in sorted(self.sources[cls] - found):
+            self.sourceRemoved.emit(cls,name,path)
+        self.sources[cls] = found
+
+def loadTimes(filename):
+    """
+    Returns the timestamp sidecar of a recording (sidecar.TimeIndex), None if
+    it has none.
+    """
+    if not TimeIndex.exists(filename):
+        return None
+    try:
+        return TimeIndex(filename)
+    except (OSError,ValueError):
+        return None
+
+def isDeep(filename):
+    """
+    Returns whether a recording holds 16-bit single channel frames, by its
+    .json (recording.RecordingMeta).
+    """
+    try:
+        with open(filename+".json") as f:
+            meta = json.load(f)
+    except (OSError,ValueError):
+        return False
+    return (meta.get("stored_dtype") == "<u2"
+            and len(meta.get("shape",())) == 2)
+
+def seekNumber(times,seconds,fps):
+    """
+    Returns the number of the frame captured seconds after the first frame,
+    by binary search in the timestamps, or at the nominal fps without them.
+    """
+    if times is not None and len(times):
+        return times.find(times.t[0] + seconds)
+    return int(round(seconds * fps))
+
+def recordedInterval(times,nr):
+    """
+    Returns the recorded time from frame nr to the next one, None (the
+    nominal frame period) without timestamps.
+    """
+    if times is None or nr is None:
+        return None
+    return times.interval(nr)
+
+def getTimeString(times,nr):
+    if times is None or nr is None or nr >= len(times):
+        return ""
+    return ", t %.3f s" % (times.t[nr] - times.t[0])
+
 class VideoRecord(QObject):
     
     __NAME__ = "Video"
     __ICON__ = "video.svg"
     __DIR__ = "../recordings/"
+    # Files in the recordings directory that are not played by OpenCV
+    __SKIP__ = (".raw",".times",".json",".csv")
     
     finished = pyqtSignal()
     
     def __init__(self,filename,filepath,display_queue,record_queue,
-                 mutex,wait,parent=None):
+                 analysis_queue,frame_pool,mutex,wait,parent=None):
         super(self.__class__, self).__init__(parent)        
         
         self.display_queue = display_queue
         self.record_queue = record_queue     
+        self.analysis_queue = analysis_queue
+        self.frame_pool = frame_pool
 
-        self.mutex = mutex
-        self.wait = wait
+        # Started, stopped and reconfigured without blocking the caller
+        self.state = StateMachine(mutex,wait)
         
         self.name = filename
         self.path = filepath
-        self.reader = cv2.VideoCapture(filepath+filename)  
+        self.reader = self.openReader()
+        self.frames = int(self.reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.pacer = Pacer(self.reader.get(cv2.CAP_PROP_FPS))
+        # Capture timestamps of the frames, played at the recorded cadence
+        self.times = loadTimes(filepath+filename)
+        # Frame offset index, built in the device thread when it starts
+        self.index = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.pos = 0
+        self.seek_pos = None
+        self.resync = False
+        # Frames decoded ahead on its own thread, a depth of 0 decodes inline.
+        # Starts with the default choice of ReadAhead.DEPTHS.
+        self.ahead = None
+        self.pool_size = frame_pool.size
+        self.setDepth(0)
         
-        nr = 20
-        self.fps = np.zeros((2,nr))
+        self.fps = RateMeter(self.__NAME__,20)
         
 
     @classmethod
@@ -81,8 +264,9 @@ class VideoRecord(QObject):
         if not os.path.exists(path):
             os.mkdir(path)
             
-        files = os.listdir(path)
-        return [[file,path] for file in files]
+        files = sorted(os.listdir(path))
+        return [[file,path] for file in files 
+                if os.path.isfile(path+file) and not file.endswith(cls.__SKIP__)]
 
     @classmethod
     def getClassName(self):
@@ -91,116 +275,241 @@ class VideoRecord(QObject):
     @classmethod        
     def getClassIcon(self):
         return self.__ICON__
+
+    @classmethod
+    def getWatchPaths(cls):
+        return [cls.__DIR__]
     
     def getGuiSpecs(self):
         c = [["Start Device",self.START,"A",0,0,1,1,"play.svg"],
              ["Stop Device",self.STOP,"A",0,1,1,1,"stop.svg"],
+             ["Seek",self.seek,"S",0,2,1,1,self.frames],
+             ["Speed",self.pacer.setSpeed,"C",0,3,1,1,Pacer.getSpeedNames()],
+             ["Read-ahead",self.setDepth,"C",0,4,1,1,ReadAhead.getDepthNames()],
+             ["Seek Time",self.seekTime,"T",0,5,1,1,"Seek to time (s)"],
              ]
 
         return c
         
     def START(self,state):
-        if not self.run:
-            self.wait.wakeOne()
-            while not self.run:
-                time.sleep(0.01)
+        self.state.request(RUNNING)
         
     def STOP(self,state):
-        if self.run:
-            self.stop = True
-            while self.run:
-                time.sleep(0.01)
+        self.state.request(STOPPED)
 
     def QUIT(self):
-        self.quit = True
-        self.START(0)
-        self.STOP(0)
+        self.state.request(QUIT)
+
+    def seek(self,nr):
+        """
+        Jumps to frame nr. While stopped the frame is shown right away.
+        """
+        with self.lock:
+            self.seek_pos = nr
+            if self.ahead is not None:
+                self.ahead.flush()
+        self.pacer.reset()
+        if self.state.state != RUNNING:
+            self.state.post(self.showFrame)
+
+    def showFrame(self):
+        """
+        Shows the frame sought while stopped, run in the device thread.
+        """
+        if self.state.state == RUNNING:
+            return
+        with self.lock:
+            frame = self.readFrame()
+        if frame is not None:
+            self.display_queue.offer([self.__NAME__,frame],time.monotonic())
+
+    def seekTime(self,text):
+        """
+        Jumps to the frame captured text seconds after the first one, see
+        seekNumber().
+        """
+        try:
+            self.seek(seekNumber(self.times,float(text),self.pacer.fps))
+        except ValueError:
+            pass
+
+    def setDepth(self,index):
+        self.depth = ReadAhead.DEPTHS[index][1]
+        # buffered frames come from the pool as well
+        self.frame_pool.setSize(self.pool_size + self.depth)
+
+    def nextFrame(self):
+        """
+        Returns the next frame from the read-ahead buffer, or decodes it inline
+        when the read-ahead depth is 0.
+        """
+        if self.ahead is not None and self.ahead.depth != self.depth:
+            self.stopAhead()
+        if self.ahead is None and self.depth:
+            self.ahead = ReadAhead(self.readFrame,self.depth,self.lock)
+            self.ahead.start()
+
+        if self.ahead is not None:
+            return self.ahead.get()
+        with self.lock:
+            return self.readFrame()
+
+    def stopAhead(self):
+        if self.ahead is not None:
+            self.ahead.stop()
+            self.ahead = None
+
+    def openReader(self):
+        """
+        Opens the file. Recordings of 16-bit mono frames (see mono.py) are
+        read at their depth instead of as 8-bit BGR.
+        """
+        filename = self.path+self.name
+        if isDeep(filename):
+            return cv2.VideoCapture(filename,cv2.CAP_FFMPEG,
+                                    [cv2.CAP_PROP_CONVERT_RGB,0])
+        return cv2.VideoCapture(filename)
+
+    def loadIndex(self):
+        try:
+            self.index = FrameIndex.load(self.path+self.name,
+                                         self.__DIR__+".index/")
+        except OSError:
+            self.index = None
+        # intra-only codecs are decoded straight from the file when seeking
+        if self.index is not None and self.index.isIntra():
+            self.file = open(self.path+self.name,"rb")
+
+    def seekFrame(self,nr):
+        nr = min(max(nr,0),max(self.frames-1,0))
+        if self.file is not None:
+            data = self.index.readFrame(self.file,nr)
+            image = cv2.imdecode(np.frombuffer(data,np.uint8),cv2.IMREAD_COLOR)
+            self.pos = nr + 1
+            self.resync = True
+            if image is None:
+                return None
+            frame = self.frame_pool.adopt(self.frame_pool.acquire(),image)
+            frame.seq = nr
+            return frame
+
+        key = self.index.getKeyframe(nr) if self.index is not None else nr
+        self.reader.set(cv2.CAP_PROP_POS_FRAMES,key)
+        for i in range(nr-key):
+            self.reader.grab()
+        self.pos = nr
+        self.resync = False
+        return self.readFrame()
+
+    def readFrame(self):
+        """
+        Returns the next frame, or the requested one after a seek. Returns
+        None at the end of the file, after which playback restarts.
+        """
+        if self.seek_pos is not None:
+            nr,self.seek_pos = self.seek_pos,None
+            return self.seekFrame(nr)
+
+        if self.resync:
+            self.reader.set(cv2.CAP_PROP_POS_FRAMES,self.pos)
+            self.resync = False
+
+        frame = self.frame_pool.acquire()
+        retval,image = self.reader.read(frame.image)
+        if retval:
+            frame.seq = self.pos
+            self.pos += 1
+            return self.frame_pool.adopt(frame,image)
+
+        frame.release()
+        self.reader.release()
+        self.reader = self.openReader()
+        self.pos = 0
+        return None
    
     def loop(self):
         self.clear()
-        self.quit = False
-        self.run = False
-        while not self.quit:
-            self.mutex.lock()
-            self.wait.wait(self.mutex)
-            self.mutex.unlock()
-            self.run = True
-            self.stop = False
-            while not self.stop:
-                tb = time.time()
-                retval,image = self.reader.read()  
-                ta = time.time()
-                if retval:   
-                    fps_str = self.updateFPS(self.__NAME__,self.fps,tb,ta)
+        self.loadIndex()
+        while True:
+            state = self.state.next()
+            if state == QUIT:
+                break
+            if state != RUNNING:
+                continue
+            self.pacer.reset()
+            while not self.state.stopping():
+                tb = time.monotonic()
+                frame = self.nextFrame()
+                ta = time.monotonic()
+                if frame is not None:   
+                    self.pacer.wait(recordedInterval(self.times,frame.seq))
+                    # shown when due, pacing is not pipeline latency
+                    frame.stamp("read",tb)
+                    frame.stamp("capture")
+                    fps_str = self.fps.update(tb,ta)
+                    if self.ahead is not None:
+                        fps_str += " (%s)" % self.ahead.getStatString()
+                    fps_str += getTimeString(self.times,frame.seq)
                     
-                    if not self.display_queue.full():
-                        self.display_queue.put([fps_str,image])  
-
-                else:
-                    self.reader.release()
-                    self.reader = cv2.VideoCapture(self.path+self.name)  
+                    # one reference for the display and one for analysis
+                    self.display_queue.offer([fps_str,frame.retain()],ta)
+                    self.analysis_queue.offer([ta,frame],ta)
                         
-            self.run = False
+            self.stopAhead()
 
         self.reader.release()
-
-    def updateFPS(self,name,avg_list, time_before, time_after):
-        mean_total = np.mean(np.diff(avg_list[0,:]))
-        mean_max = np.mean(avg_list[0,1:]-avg_list[1,:-1])
-        cur_fps = 1.0 / mean_total
-        max_fps = 1.0 / mean_max
-        percent = cur_fps / max_fps * 100
-        avg_list[:,:-1] = avg_list[:,1:]
-        avg_list[1,-1] = time_after
-        avg_list[0,-1] = time_before
-
-        return "%s: %05.1f fps (%05.1f %%)" % (name,cur_fps,percent)
+        if self.file is not None:
+            self.file.close()
 
     def clear(self):
-        l = len(self.fps[0,:])
-        self.fps[0,:] = range(l)
-        self.fps[1,:].fill(0)
+        self.fps.clear()
         
         
-class CameraDevice(QObject):
+class RawRecord(QObject):
     
-    __NAME__ = "Camera"
-    __ICON__ = "camera.svg"
+    __NAME__ = "Raw"
+    __ICON__ = "video.svg"
+    __DIR__ = "../recordings/"
+    __EXT__ = ".raw"
     
     finished = pyqtSignal()
     
-    def __init__(self,dev_name, dev_path,display_queue, record_queue,
-                 mutex,wait,parent=None):
+    def __init__(self,filename,filepath,display_queue,record_queue,
+                 analysis_queue,frame_pool,mutex,wait,parent=None):
         super(self.__class__, self).__init__(parent)        
         
         self.display_queue = display_queue
         self.record_queue = record_queue     
+        self.analysis_queue = analysis_queue
+        self.frame_pool = frame_pool
 
-        self.mutex = mutex
-        self.wait = wait
-
-        self.dev_name = dev_name
-        self.dev_path = dev_path
-        self.reader = cv2.VideoCapture(dev_path)         
-        self.cap_fmts = self.getFFF(dev_path)
-        self.list_fmts = sorted(list(self.cap_fmts.keys()))
-        self.setReader(0)
-        nr = 20
-        self.fps = np.zeros((2,nr))
+        # Started, stopped and reconfigured without blocking the caller
+        self.state = StateMachine(mutex,wait)
+        
+        self.name = filename
+        self.path = filepath
+        self.reader = RawReader(filepath+filename)  
+        self.pacer = Pacer(self.reader.fps)
+        # Capture timestamps of the frames, played at the recorded cadence
+        self.times = self.reader.times
+        self.pos = 0
+        self.lock = threading.Lock()
+        # Frames read ahead on its own thread, a depth of 0 reads inline.
+        # Starts with the default choice of ReadAhead.DEPTHS.
+        self.ahead = None
+        self.pool_size = frame_pool.size
+        self.setDepth(0)
         
+        self.fps = RateMeter(self.__NAME__,20)
 
     @classmethod
     def getPaths(cls):
-        paths = []
-        command = "v4l2-ctl --list-devices"
-        df = subprocess.check_output(command,shell=True).decode()
-        for device in df.split("\n\n")[:-1]:
-            spl = re.split("\(|\n\t|\n\n",device)
-            name = spl[0].strip()
-            path = spl[2].strip()
-            paths.append([name,path])
-
-        return paths
+        path = cls.__DIR__
+        if not os.path.exists(path):
+            os.mkdir(path)
+            
+        files = sorted(os.listdir(path))
+        return [[file,path] for file in files if file.endswith(cls.__EXT__)]
 
     @classmethod
     def getClassName(self):
@@ -209,123 +518,451 @@ class CameraDevice(QObject):
     @classmethod        
     def getClassIcon(self):
         return self.__ICON__
+
+    @classmethod
+    def getWatchPaths(cls):
+        return [cls.__DIR__]
     
     def getGuiSpecs(self):
         c = [["Start Device",self.START,"A",0,0,1,1,"play.svg"],
              ["Stop Device",self.STOP,"A",0,1,1,1,"stop.svg"],
-             ["Format - Size - FPS",self.setFFF,"C",0,3,1,1,self.list_fmts],
+             ["Seek",self.seek,"S",0,2,1,1,len(self.reader)],
+             ["Speed",self.pacer.setSpeed,"C",0,3,1,1,Pacer.getSpeedNames()],
+             ["Read-ahead",self.setDepth,"C",0,4,1,1,ReadAhead.getDepthNames()],
+             ["Seek Time",self.seekTime,"T",0,5,1,1,"Seek to time (s)"],
              ]
+
         return c
-            
+        
     def START(self,state):
-        if not self.run:
-            self.wait.wakeOne()
-            while not self.run:
-                time.sleep(0.01)
+        self.state.request(RUNNING)
         
     def STOP(self,state):
-        if self.run:
-            self.stop = True
-            while self.run:
-                time.sleep(0.01)
+        self.state.request(STOPPED)
 
     def QUIT(self):
-        self.quit = True
-        self.START(0)
-        self.STOP(0)
-        
-    def setReader(self,index):
-        key = self.list_fmts[index]
-        fourcc,width,height,fps = self.cap_fmts[key]
-        self.reader.set(3,width) 
-        self.reader.set(4,height) 
-        fourcc = cv2.VideoWriter.fourcc(*fourcc)
-        self.reader.set(cv2.CAP_PROP_FOURCC,fourcc) 
-        self.reader.set(cv2.CAP_PROP_FPS,fps)
-        self.FPS = fps        
+        self.state.request(QUIT)
+
+    def seek(self,nr):
+        """
+        Jumps to frame nr. While stopped the frame is shown right away.
+        """
+        with self.lock:
+            self.pos = min(max(nr,0),max(len(self.reader)-1,0))
+            if self.ahead is not None:
+                self.ahead.flush()
+        self.pacer.reset()
+        if self.state.state != RUNNING:
+            self.state.post(self.showFrame)
+
+    def showFrame(self):
+        """
+        Shows the frame sought while stopped, run in the device thread.
+        """
+        if self.state.state == RUNNING or not len(self.reader):
+            return
+        frame = self.readFrame(self.pos)
+        self.display_queue.offer([self.__NAME__,frame],time.monotonic())
+
+    def seekTime(self,text):
+        """
+        Jumps to the frame captured text seconds after the first one, see
+        seekNumber().
+        """
+        try:
+            self.seek(seekNumber(self.times,float(text),self.pacer.fps))
+        except ValueError:
+            pass
+
+    def setDepth(self,index):
+        self.depth = ReadAhead.DEPTHS[index][1]
+        # buffered frames come from the pool as well
+        self.frame_pool.setSize(self.pool_size + self.depth)
+
+    def readNext(self):
+        nr = self.pos
+        self.pos = (nr + 1) % len(self.reader)
+        return self.readFrame(nr)
+
+    def nextFrame(self):
+        """
+        Returns the next frame from the read-ahead buffer, or reads it inline
+        when the read-ahead depth is 0.
+        """
+        if self.ahead is not None and self.ahead.depth != self.depth:
+            self.stopAhead()
+        if self.ahead is None and self.depth:
+            self.ahead = ReadAhead(self.readNext,self.depth,self.lock)
+            self.ahead.start()
+
+        if self.ahead is not None:
+            return self.ahead.get()
+        with self.lock:
+            return self.readNext()
+
+    def stopAhead(self):
+        if self.ahead is not None:
+            self.ahead.stop()
+            self.ahead = None
+
+    def readFrame(self,nr):
+        """
+        Copies frame nr from the memory-mapped file into a pooled frame.
+        """
+        raw = self.reader.read(nr)
+        frame = self.frame_pool.acquire()
+        image = frame.image
+        if image is None or image.shape != raw.shape or image.dtype != raw.dtype:
+            image = np.empty(raw.shape,raw.dtype)
+        np.copyto(image,raw)
+        frame = self.frame_pool.adopt(frame,image)
+        frame.seq = nr
+        return frame
+   
+    def loop(self):
+        self.clear()
+        while True:
+            state = self.state.next()
+            if state == QUIT:
+                break
+            if state != RUNNING:
+                continue
+            if not len(self.reader):
+                # nothing to play
+                self.state.request(STOPPED)
+                continue
+            self.pacer.reset()
+            while not self.state.stopping():
+                tb = time.monotonic()
+                frame = self.nextFrame()
+                ta = time.monotonic()
+                if frame is None:
+                    continue
+                self.pacer.wait(recordedInterval(self.times,frame.seq))
+                # shown when due, pacing is not pipeline latency
+                frame.stamp("read",tb)
+                frame.stamp("capture")
+                fps_str = self.fps.update(tb,ta)
+                if self.ahead is not None:
+                    fps_str += " (%s)" % self.ahead.getStatString()
+                fps_str += getTimeString(self.times,frame.seq)
+                
+                # one reference for the display and one for analysis
+                self.display_queue.offer([fps_str,frame.retain()],ta)
+                self.analysis_queue.offer([ta,frame],ta)
+                        
+            self.stopAhead()
+
+        self.reader.release()
+
+    def clear(self):
+        self.fps.clear()
         
-    def setFFF(self,index):   
-        self.STOP(0)
-        # change settings           
-        self.setReader(index)
-        # start again
-        self.START(0)
         
-    def getFFF(self,path):
-        FFFS = {}
+class CaptureDevice(QObject):
+    """
+    Live source, a camera or the synthetic source, that can be recorded.
+
+    Frames are read in the device thread and offered to the display, record
+    and analysis queues. Start, stop and format changes go through the state
+    machine and return at once, formats are switched between two frames.
+    Subclasses set list_fmts and implement setReader(), readFrame() and
+    releaseReader().
+    """
+    __NAME__ = "Capture"
+    __ICON__ = "camera.svg"
+
+    FORMAT_SPEC = "Format - Size - FPS"
+
+    finished = pyqtSignal()
+
+    def __init__(self,dev_name, dev_path,display_queue, record_queue,
+                 analysis_queue,frame_pool,mutex,wait,stages=None,parent=None):
+        super(CaptureDevice, self).__init__(parent)
+
+        self.display_queue = display_queue
+        self.record_queue = record_queue     
+        self.analysis_queue = analysis_queue
+        self.frame_pool = frame_pool
+        # Crop, binning and decimation of the display and record path
+        if stages is None:
+            stages = (FrameStage(frame_pool),FrameStage(frame_pool))
+        self.display_stage,self.record_stage = stages
+
+        # Started, stopped and reconfigured without blocking the caller
+        self.state = StateMachine(mutex,wait)
+
+        self.dev_name = dev_name
+        self.dev_path = dev_path
+        self.passthrough = False
+        self.fps = RateMeter(self.__NAME__,20)
+        self.switches = SwitchTimer()
+
+    @classmethod
+    def getClassName(self):
+        return self.__NAME__
+
+    @classmethod        
+    def getClassIcon(self):
+        return self.__ICON__
+
+    def getGuiSpecs(self):
+        c = [["Start Device",self.START,"A",0,0,1,1,"play.svg"],
+             ["Stop Device",self.STOP,"A",0,1,1,1,"stop.svg"],
+             [self.FORMAT_SPEC,self.setFFF,"C",0,3,1,1,self.list_fmts],
+             ["Capture",self.setCapture,"C",0,4,1,1,CAPTURES],
+             ]
+        return c
+            
+    def START(self,state):
+        self.state.request(RUNNING)
         
-        formats = self.getFormats(path)
+    def STOP(self,state):
+        self.state.request(STOPPED)
+
+    def QUIT(self):
+        self.state.request(QUIT)
+
+    def setReader(self,index):
+        raise NotImplementedError
+
+    def readFrame(self):
+        """
+        Returns whether a frame was read, and the frame.
+        """
+        raise NotImplementedError
+
+    def releaseReader(self):
+        raise NotImplementedError
         
-        for fourcc in formats:
-            sizes = self.getFramesizes(path,fourcc)
-            
-            for width,height in sizes:
-                fpss = self.getFPS(width,height,path,fourcc)
-                
-                for fps in fpss:
-                    string = "%4s - %4s x %4s - %4s" % (fourcc,width,height,fps)
-                    FFFS[string] = [fourcc,int(width),int(height),int(fps)]
-                    
-        return FFFS
-
-    def getFormats(self, path):
-        command = "v4l2-ctl --device="+path+" --list-formats"
-        fs = subprocess.check_output(command,shell=True).decode()     
-        return [f for f in fs.split("'") if len(f) == 4]
-
-    def getFramesizes(self, path, fourcc):
-        command = "v4l2-ctl --device="+path+" --list-framesizes="+fourcc
-        fs = subprocess.check_output(command,shell=True).decode()
-        sizes = [x.split("\n")[0] for x in fs.split("\tSize: Discrete ")[1:]]
-        return [x.split("x") for x in sizes]
-
-    def getFPS(self, width, height, path, fourcc):
-        command1 = "v4l2-ctl --device="+path+" --list-frameintervals="
-        command2 = "width="+width+",height="+height+",pixelformat="+fourcc         
-        fs = subprocess.check_output(command1+command2,shell=True).decode()
-        return [x.split(".")[0] for x in fs.split("(")[1:]]
+    def setFFF(self,index):
+        self.state.post(self.switchFormat,index,None,time.monotonic())
+
+    def setCapture(self,index):
+        self.state.post(self.switchFormat,None,index == 1,time.monotonic())
+
+    def switchFormat(self,index,passthrough,t):
+        """
+        Changes format and capture mode in the device thread, between two
+        frames if it runs, without stopping it. The time to the first frame
+        of the new format is measured.
+
+        Args:
+            index: (int) Format, None keeps the current one.
+            passthrough: (bool) Capture mode, None keeps the current one.
+            t: (float) Time of the request.
+        """
+        old = self.getFormatName()
+        if passthrough is not None:
+            self.passthrough = passthrough
+        self.setReader(self.fff_index if index is None else index)
+        if self.state.state == RUNNING:
+            self.switches.start(old,self.getFormatName(),t)
+
+    def getFormatName(self):
+        return "%s, %s" % (self.list_fmts[self.fff_index],
+                           CAPTURES[int(self.passthrough)])
    
     def loop(self):
         self.clear()
-        self.quit = False
-        self.run = False
-        while not self.quit:
-            self.mutex.lock()
-            self.wait.wait(self.mutex)
-            self.mutex.unlock()
-            self.run = True
-            self.stop = False
-            while not self.stop:
-                tb = time.time()
-                retval,image = self.reader.read()  
-                ta = time.time()
+        while True:
+            state = self.state.next()
+            if state == QUIT:
+                break
+            if state != RUNNING:
+                continue
+            # frames are numbered from Start on
+            self.seq = 0
+            while not self.state.stopping():
+                # monotonic timestamps are comparable between devices
+                tb = time.monotonic()
+                retval,frame = self.readFrame()
+                ta = time.monotonic()
                 if retval:   
-                    fps_str = self.updateFPS(self.__NAME__,self.fps,tb,ta)
+                    # one reference each for display, recorder and analysis
+                    frame.retain(2)
+                    frame.seq = self.seq
+                    self.seq += 1
+                    frame.stamp("read",tb)
+                    frame.stamp("capture",ta)
+                    fps_str = self.fps.update(tb,ta)
+                    self.switches.done(ta)
+                    fps_str += self.switches.getStatString()
                     
-                    if not self.display_queue.full():
-                        self.display_queue.put([fps_str,image])  
-                        
-                    if not self.record_queue.full():
-                        self.record_queue.put([ta,image,self.FPS])
-                        
-            self.run = False
+                    self.display_stage.offer(self.display_queue,
+                                             [fps_str,frame],ta)
+                    self.record_stage.offer(self.record_queue,
+                        [ta,frame,self.record_stage.getRate(self.FPS)],ta)
+                    self.analysis_queue.offer([ta,frame],ta)
+                else:
+                    frame.release()
 
-        self.reader.release()
+        self.releaseReader()
 
-    def updateFPS(self,name,avg_list, time_before, time_after):
-        mean_total = np.mean(np.diff(avg_list[0,:]))
-        mean_max = np.mean(avg_list[0,1:]-avg_list[1,:-1])
-        cur_fps = 1.0 / mean_total
-        max_fps = 1.0 / mean_max
-        percent = cur_fps / max_fps * 100
-        avg_list[:,:-1] = avg_list[:,1:]
-        avg_list[1,-1] = time_after
-        avg_list[0,-1] = time_before
+    def clear(self):
+        self.fps.clear()
 
-        return "%s: %05.1f fps (%05.1f %%)" % (name,cur_fps,percent)
+class CameraDevice(CaptureDevice):
+    
+    __NAME__ = "Camera"
+    __ICON__ = "camera.svg"
 
-    def clear(self):
-        l = len(self.fps[0,:])
-        self.fps[0,:] = range(l)
-        self.fps[1,:].fill(0)
+    # title of a GUI spec, its new items and the selected index
+    updateItems = pyqtSignal(str,list,int)
+    
+    def __init__(self,dev_name, dev_path,display_queue, record_queue,
+                 analysis_queue,frame_pool,mutex,wait,stages=None,parent=None):
+        super(self.__class__, self).__init__(dev_name,dev_path,display_queue,
+                                             record_queue,analysis_queue,
+                                             frame_pool,mutex,wait,stages,
+                                             parent)
+
+        self.reader = cv2.VideoCapture(dev_path)         
+        self.cap_fmts = self.getFFF(dev_path)
+        self.list_fmts = sorted(list(self.cap_fmts.keys()))
+        # Format the driver is configured to, only changes are set
+        self.current = None
+        self.setReader(0)
+
+    @classmethod
+    def getPaths(cls):
+        return v4l2.listDevices()
+
+    @classmethod
+    def getWatchPaths(cls):
+        # device nodes appear and disappear on hotplug
+        return ["/dev"]
         
+    def setReader(self,index):
+        self.fff_index = index
+        key = self.list_fmts[index]
+        fourcc,width,height,fps = self.cap_fmts[key]
+        v4l2.setFormat(self.reader,fourcc,width,height,fps,self.current)
+        self.current = [fourcc,width,height,fps]
+        self.FPS = fps        
+        self.width,self.height = width,height
+        # compressed frames are read as they are
+        if self.passthrough and fourcc in mjpg.CODECS:
+            self.codec = fourcc
+        else:
+            self.codec = None
+        # mono frames are kept at their depth, not expanded to BGR
+        self.mono = fourcc if mono.isMono(fourcc) else None
+        self.reader.set(cv2.CAP_PROP_CONVERT_RGB,
+                        int(self.codec is None and self.mono is None))
+
+    def readFrame(self):
+        """
+        Returns whether a frame was read, and the frame. Compressed frames
+        are not pooled, their size varies.
+        """
+        if self.mono is not None:
+            frame = self.frame_pool.acquire()
+            retval,image = mono.read(self.reader,self.mono,self.width,
+                                     self.height,frame.image)
+            if retval:
+                frame = self.frame_pool.adopt(frame,image)
+            return retval,frame
+        if self.codec is None:
+            frame = self.frame_pool.acquire()
+            retval,image = self.reader.read(frame.image)
+            if retval:
+                frame = self.frame_pool.adopt(frame,image)
+            return retval,frame
+        retval,image = self.reader.read()
+        codec = self.codec if retval and mjpg.isCompressed(image) else None
+        return retval,self.frame_pool.wrap(image,codec)
+
+    def releaseReader(self):
+        self.reader.release()
+        
+    def getFFF(self,path):
+        # cached per physical device, refreshed in the background
+        return v4l2.getFormats(path,self.formatsChanged)
+
+    def formatsChanged(self,fffs):
+        # called by the background refresh, applied in the device thread
+        self.state.post(self.setFormats,fffs)
+
+    def setFormats(self,fffs):
+        """
+        Replaces the formats of the device, keeping the current one if the
+        device still has it, and updates the GUI list.
+        """
+        key = self.list_fmts[self.fff_index] if self.list_fmts else None
+        self.cap_fmts = fffs
+        self.list_fmts = sorted(list(fffs.keys()))
+        if key in self.cap_fmts:
+            self.fff_index = self.list_fmts.index(key)
+        else:
+            self.switchFormat(0,None,time.monotonic())
+        self.updateItems.emit(self.FORMAT_SPEC,self.list_fmts,self.fff_index)
+
+class SyntheticDevice(CaptureDevice):
+    """
+    Generated frames at a selectable resolution, channel count, dtype and
+    frame rate. Behaves like a CameraDevice, including recording, so the
+    pipeline can be measured without a physical camera.
+    """
+    __NAME__ = "Synthetic"
+    __ICON__ = "camera.svg"
+    # Formats the generated frames of which are kept
+    READERS = 2
+    
+    def __init__(self,dev_name, dev_path,display_queue, record_queue,
+                 analysis_queue,frame_pool,mutex,wait,stages=None,parent=None):
+        super(self.__class__, self).__init__(dev_name,dev_path,display_queue,
+                                             record_queue,analysis_queue,
+                                             frame_pool,mutex,wait,stages,
+                                             parent)
+
+        self.list_fmts = [formatName(*f) for f in FORMATS]
+        self.reader = None
+        # Generators of the last formats, reused when switching back
+        self.readers = collections.OrderedDict()
+        self.setReader(0)
+
+    @classmethod
+    def getPaths(cls):
+        return [[cls.__NAME__,"synthetic"]]
+
+    @classmethod
+    def getWatchPaths(cls):
+        return []
+        
+    def setReader(self,index):
+        self.fff_index = index
+        width,height,channels,dtype,fps = FORMATS[index]
+        # compressed like an MJPG camera, uint8 formats only
+        codec = mjpg.CODECS[0] if self.passthrough else None
+        key = (index,codec)
+        self.reader = self.readers.pop(key,None)
+        if self.reader is None:
+            self.reader = SyntheticCapture(width,height,channels,dtype,fps,
+                                           codec)
+        else:
+            self.reader.pacer.reset()
+        self.readers[key] = self.reader
+        while len(self.readers) > self.READERS:
+            self.readers.popitem(last=False)[1].release()
+        self.codec = self.reader.codec
+        # nominal rate of recordings when unthrottled
+        self.FPS = fps or 30
+
+    def readFrame(self):
+        """
+        Returns whether a frame was read, and the frame. Compressed frames
+        are not pooled, their size varies.
+        """
+        if self.codec is None:
+            frame = self.frame_pool.acquire()
+            retval,image = self.reader.read(frame.image)
+            if retval:
+                frame = self.frame_pool.adopt(frame,image)
+            return retval,frame
+        retval,image = self.reader.read()
+        return retval,self.frame_pool.wrap(image,self.codec)
+
+    def releaseReader(self):
+        for reader in self.readers.values():
+            reader.release()
@@ -0,0 +1,522 @@
+import concurrent.futures
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from avi import AviWriter
+
+def toDepth8(image):
+    """
+    Returns a frame as uint8, deeper frames by their most significant byte.
+    Encoders without 16-bit support get frames converted this way, OpenCV
+    would reinterpret the bytes of deeper ones.
+    """
+    if image.dtype == np.uint8:
+        return image
+    return (image >> 8 * (image.dtype.itemsize - 1)).astype(np.uint8)
+
+class OpenCVWriter:
+    """
+    Encodes frames with cv2.VideoWriter in the calling thread.
+
+    All writers share the cv2.VideoWriter interface (isOpened, write,
+    release) so the Recorder does not care where encoding actually happens.
+    write() additionally accepts the capture timestamp of the frame and
+    returns whether the frame was stored: frames of another shape or dtype
+    than the writer was opened with are refused.
+
+    OpenCV writes 3 channel frames only, 4 channel (BGRA) frames are
+    stored without their alpha channel. 16-bit frames are stored as 8 bits
+    (see toDepth8()), except by DEPTH_16 codecs if single channel.
+    """
+    # Codecs OpenCV writes 16-bit single channel frames with
+    DEPTH_16 = ("FFV1",)
+
+    def __init__(self,filename,codec,fps,shape,dtype=np.uint8):
+        fourcc = cv2.VideoWriter_fourcc(*codec)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = (shape[1],shape[0])
+        color = len(shape) == 3
+        self.bgra = color and shape[2] == 4
+        self.depth8 = self.dtype != np.uint8
+        if self.dtype == np.uint16 and not color and codec in self.DEPTH_16:
+            # lossless at full depth, other frames are stored as 8 bits
+            self.depth8 = False
+            params = [cv2.VIDEOWRITER_PROP_DEPTH,cv2.CV_16U,
+                      cv2.VIDEOWRITER_PROP_IS_COLOR,0]
+            self.writer = cv2.VideoWriter(filename,cv2.CAP_FFMPEG,fourcc,fps,
+                                          size,params)
+        else:
+            self.writer = cv2.VideoWriter(filename,fourcc,fps,size,color)
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self,image,t=None):
+        # OpenCV skips such frames with a logged warning only
+        if (image.shape != self.shape or image.dtype != self.dtype
+            or not self.writer.isOpened()):
+            return False
+        if self.depth8:
+            image = toDepth8(image)
+        if self.bgra:
+            image = cv2.cvtColor(image,cv2.COLOR_BGRA2BGR)
+        self.writer.write(image)
+        return True
+
+    def release(self):
+        self.writer.release()
+
+class PipeWriter:
+    """
+    Pipes raw frames into an external encoder process, ffmpeg, which
+    encodes them on its own threads. write() blocks while the pipe is full,
+    i.e. when the encoder falls behind.
+
+    Args:
+        filename: (str) Output filename, its extension selects the container.
+        fps: (int) Frame rate stored in the file.
+        shape: (tuple) Frame shape.
+        dtype: (str) Frame dtype.
+        args: (list) ffmpeg output options, e.g. the codec.
+    """
+    # ffmpeg pixel formats of the OpenCV layouts, by dtype and channels
+    PIX_FMTS = {("uint8",1):"gray",("uint8",3):"bgr24",("uint8",4):"bgra",
+                ("uint16",1):"gray16le",("uint16",3):"bgr48le",
+                ("uint16",4):"bgra64le"}
+    COMMAND = "ffmpeg"
+
+    def __init__(self,filename,fps,shape,dtype,args):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        channels = shape[2] if len(shape) == 3 else 1
+        pix_fmt = self.PIX_FMTS.get((np.dtype(dtype).name,channels))
+        self.process = None
+        if pix_fmt is None:
+            return
+        command = [self.COMMAND,"-loglevel","error","-y",
+                   "-f","rawvideo","-pix_fmt",pix_fmt,
+                   "-s","%dx%d" % (shape[1],shape[0]),"-r",str(fps),
+                   "-i","-"] + list(args) + [filename]
+        try:
+            self.process = subprocess.Popen(command,stdin=subprocess.PIPE)
+        except OSError:
+            self.process = None
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def write(self,image,t=None):
+        if (self.process is None or image.shape != self.shape
+            or image.dtype != self.dtype):
+            return False
+        try:
+            self.process.stdin.write(np.ascontiguousarray(image).data)
+        except (BrokenPipeError,ValueError):
+            # the encoder quit, the rest of the recording is lost
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process.wait()
+            self.process = None
+
+class ImageWriter:
+    """
+    Writes every frame to its own lossless image file (000000.png, ...) in a
+    directory, on a pool of threads: OpenCV releases the GIL while
+    compressing, so throughput scales with the workers.
+
+    Args:
+        directory: (str) Created if it does not exist.
+        ext: (str) Image file extension, selects the format.
+        params: (list) cv2.imwrite parameters.
+        workers: (int) Threads compressing images.
+    """
+    def __init__(self,directory,ext=".png",params=(),workers=None):
+        self.directory = directory
+        self.ext = ext
+        self.params = list(params)
+        workers = workers or max(1,min(4,os.cpu_count()))
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers,thread_name_prefix="images")
+        # two images per worker in flight, a copy each
+        self.slots = threading.Semaphore(2*workers)
+        self.nr = 0
+        self.ok = True
+        try:
+            os.makedirs(directory,exist_ok=True)
+        except OSError:
+            self.ok = False
+
+    def isOpened(self):
+        return self.ok
+
+    def write(self,image,t=None):
+        self.slots.acquire()
+        name = os.path.join(self.directory,"%06d%s" % (self.nr,self.ext))
+        self.nr += 1
+        self.pool.submit(self._write,name,image.copy())
+        # a failed image shows in the frames after it
+        return self.ok
+
+    def _write(self,name,image):
+        try:
+            if not cv2.imwrite(name,image,self.params):
+                self.ok = False
+        finally:
+            self.slots.release()
+
+    def release(self):
+        self.pool.shutdown()
+
+class PassthroughWriter:
+    """
+    Muxes frames that are already compressed (see mjpg.py) into an AVI as
+    they are, so recording costs no more than the disk writes.
+
+    Args:
+        filename: (str) Output filename, ending in .avi.
+        fps: (int) Frame rate stored in the file.
+        shape: (tuple) Shape of the decoded frames.
+        codec: (str) Codec of the frames.
+    """
+    def __init__(self,filename,fps,shape,codec="MJPG"):
+        self.avi = AviWriter(filename,fps,shape,codec)
+
+    def isOpened(self):
+        return self.avi.isOpened()
+
+    def write(self,data,t=None):
+        self.avi.writeFrame(data.tobytes())
+        return True
+
+    def release(self):
+        self.avi.release()
+
+class SharedFrames:
+    """
+    Ring of equally sized frame slots in shared memory.
+
+    Only slot indices travel between processes, the pixel data is copied once
+    into the slot by the producer and read in place by the consumer.
+
+    Args:
+        shape: (tuple) Shape of a single frame.
+        dtype: (str) Numpy dtype of a frame.
+        slots: (int) Number of frames that fit in the ring.
+        name: (str) Name of an existing segment to attach to. A new segment is
+            created if None.
+    """
+    def __init__(self,shape,dtype,slots,name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.frames = np.ndarray((slots,)+self.shape,self.dtype,
+                                 buffer=self.shm.buf)
+
+    def getSpec(self):
+        return [self.name,self.shape,self.dtype.str,self.slots]
+
+    def close(self):
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def _encoderMain(tasks,results):
+    """
+    Main loop of an encoder process.
+
+    Waits for a recording to be opened, then writes the shared memory slots it
+    receives until None arrives, handing every written slot back.
+    """
+    while True:
+        msg = tasks.get()
+        if msg is None:
+            break
+
+        spec,filename,codec,fps = msg
+        ring = SharedFrames(*spec[1:],name=spec[0])
+        writer = OpenCVWriter(filename,codec,fps,ring.shape,ring.dtype)
+        results.put(writer.isOpened())
+        while True:
+            slot = tasks.get()
+            if slot is None:
+                break
+            writer.write(ring.frames[slot])
+            results.put(slot)
+
+        writer.release()
+        ring.close()
+        results.put(None)
+
+class EncoderProcess:
+    """
+    Persistent encoder process, started ahead of recording so process start-up
+    does not cost frames. Serves one ProcessWriter at a time.
+    """
+    def __init__(self):
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_encoderMain,
+                                   args=(self.tasks,self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def isAlive(self):
+        return self.process.is_alive()
+
+    def quit(self):
+        if self.process.is_alive():
+            self.tasks.put(None)
+        self.process.join()
+
+class ProcessWriter:
+    """
+    Hands frames to an EncoderProcess through shared memory, keeping MJPG
+    encoding off the GIL shared with capture and display.
+
+    write() only copies the frame into a free slot. It blocks when all slots
+    are in use, i.e. when the encoder falls behind. If the encoder process
+    dies or does not answer within TIMEOUT seconds the writer closes, and
+    write() returns False from then on.
+
+    Args:
+        encoder: (EncoderProcess) Process doing the actual encoding.
+        filename: (str) Output filename.
+        codec: (str) Fourcc of the codec.
+        fps: (int) Frame rate stored in the file.
+        shape: (tuple) Frame shape.
+        dtype: (str) Frame dtype.
+        slots: (int) Number of shared memory slots.
+    """
+    TIMEOUT = 10.0
+
+    def __init__(self,encoder,filename,codec,fps,shape,dtype=np.uint8,
+                 slots=16):
+        self.encoder = encoder
+        self.ring = SharedFrames(shape,dtype,slots)
+        self.free = list(range(slots))
+        self.encoder.tasks.put([self.ring.getSpec(),filename,codec,fps])
+        try:
+            self.opened = self.getResult()
+        except queue.Empty:
+            self.opened = False
+
+    def isOpened(self):
+        return self.opened
+
+    def getResult(self):
+        """
+        Returns the next result of the encoder process. Raises queue.Empty
+        if it died or did not answer within TIMEOUT.
+        """
+        deadline = time.monotonic() + self.TIMEOUT
+        while True:
+            try:
+                return self.encoder.results.get(timeout=0.1)
+            except queue.Empty:
+                if (not self.encoder.isAlive()
+                    or time.monotonic() > deadline):
+                    raise
+
+    def write(self,image,t=None):
+        if (not self.opened or image.shape != self.ring.shape
+            or image.dtype != self.ring.dtype):
+            return False
+        if not self.free:
+            try:
+                self.free.append(self.getResult())
+            except queue.Empty:
+                # the encoder is gone, the rest of the recording is lost
+                self.opened = False
+                return False
+        slot = self.free.pop()
+        self.ring.frames[slot][...] = image
+        self.encoder.tasks.put(slot)
+        return True
+
+    def release(self):
+        # drain written slots until the encoder confirms the file is closed
+        self.encoder.tasks.put(None)
+        try:
+            while self.getResult() is not None:
+                pass
+        except queue.Empty:
+            pass
+        self.ring.close()
+
+def _segmentMain(tasks,results):
+    """
+    Main loop of a segment encoder process.
+
+    Compresses chunks of shared memory slots to JPEG and returns the encoded
+    chunk together with its number, so chunks can be reassembled in order.
+    """
+    ring = None
+    while True:
+        msg = tasks.get()
+        if msg is None:
+            break
+
+        if msg[0] == "open":
+            spec,quality = msg[1:]
+            ring = SharedFrames(*spec[1:],name=spec[0])
+            params = [cv2.IMWRITE_JPEG_QUALITY,quality]
+        elif msg[0] == "close":
+            ring.close()
+            ring = None
+            results.put(None)
+        else:
+            nr,slots = msg
+            # JPEG holds 8 bits, OpenCV would saturate deeper frames
+            data = [cv2.imencode(".jpg",toDepth8(ring.frames[s]),
+                                 params)[1].tobytes()
+                    for s in slots]
+            results.put([nr,slots,data])
+
+    if ring is not None:
+        ring.close()
+
+class EncoderPool:
+    """
+    Persistent pool of segment encoder processes, each with its own task
+    queue. Chunks are dealt round-robin, results come back on a shared queue.
+
+    Args:
+        workers: (int) Number of encoder processes.
+    """
+    def __init__(self,workers):
+        ctx = mp.get_context("spawn")
+        self.results = ctx.Queue()
+        self.tasks = []
+        self.processes = []
+        for i in range(workers):
+            tasks = ctx.Queue()
+            process = ctx.Process(target=_segmentMain,
+                                  args=(tasks,self.results),
+                                  daemon=True)
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+
+    def getWorkers(self):
+        return len(self.processes)
+
+    def isAlive(self):
+        return all(p.is_alive() for p in self.processes)
+
+    def quit(self):
+        for tasks,process in zip(self.tasks,self.processes):
+            if process.is_alive():
+                tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+class SegmentWriter:
+    """
+    Splits the frame stream into fixed-length chunks that are JPEG encoded
+    concurrently by an EncoderPool, and muxes them back in order into a single
+    MJPG AVI. Throughput scales with the number of workers until the copy into
+    shared memory or the disk becomes the bottleneck.
+
+    Args:
+        pool: (EncoderPool) Processes doing the encoding.
+        filename: (str) Output filename, ending in .avi.
+        fps: (int) Frame rate stored in the file.
+        shape: (tuple) Frame shape.
+        dtype: (str) Frame dtype.
+        chunk: (int) Number of frames per chunk.
+        quality: (int) JPEG quality.
+    """
+    def __init__(self,pool,filename,fps,shape,dtype=np.uint8,chunk=8,
+                 quality=95):
+        self.pool = pool
+        self.chunk = chunk
+        workers = pool.getWorkers()
+        # two chunks per worker: one being encoded, one being filled
+        slots = 2 * workers * chunk
+        self.ring = SharedFrames(shape,dtype,slots)
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.pending = []
+        self.nr = 0
+        self.avi = AviWriter(filename,fps,shape)
+        for tasks in pool.tasks:
+            tasks.put(["open",self.ring.getSpec(),quality])
+
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.start()
+
+    def isOpened(self):
+        return self.avi.isOpened()
+
+    def write(self,image,t=None):
+        if image.shape != self.ring.shape or image.dtype != self.ring.dtype:
+            return False
+        slot = self.free.get()
+        self.ring.frames[slot][...] = image
+        self.pending.append(slot)
+        if len(self.pending) == self.chunk:
+            self._dispatch()
+        return True
+
+    def _dispatch(self):
+        tasks = self.pool.tasks[self.nr % len(self.pool.tasks)]
+        tasks.put([self.nr,self.pending])
+        self.pending = []
+        self.nr += 1
+
+    def _collect(self):
+        done = {}
+        expected = 0
+        closed = 0
+        workers = self.pool.getWorkers()
+        while closed < workers:
+            msg = self.pool.results.get()
+            if msg is None:
+                closed += 1
+                continue
+
+            nr,slots,data = msg
+            for slot in slots:
+                self.free.put(slot)
+            done[nr] = data
+            # write every chunk that is next in line
+            while expected in done:
+                for frame in done.pop(expected):
+                    self.avi.writeFrame(frame)
+                expected += 1
+
+    def release(self):
+        if self.pending:
+            self._dispatch()
+        for tasks in self.pool.tasks:
+            tasks.put(["close"])
+        self.collector.join()
+        self.avi.release()
+        self.ring.close()
@@ -1,15 +1,21 @@
+import numpy as np
+
 from PyQt5.QtCore import QObject,Qt,QEvent,QSize,pyqtSignal
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (
     QMainWindow,
     QDockWidget,
+    QWidget,
+    QGridLayout,
+    QVBoxLayout,
     QLabel,
     QSizePolicy,
     QAction,
     QFrame,
     QComboBox,
     QLineEdit,
-    QMenu
+    QMenu,
+    QSlider
 )
 
     
@@ -18,10 +24,15 @@ class Gui(QMainWindow):
     The GUI window
     """
     opendevice = pyqtSignal(object,str,str)
+    closedevice = pyqtSignal(int)
     quitdevice = pyqtSignal()
     quitapp = pyqtSignal()
+    # Slot, width and height of a resized image label
+    resizeimage = pyqtSignal(int,int,int)
     
     __ICON_DIR__ = "../icons/"
+    # Stat index of the frame accounting, mirrored in the status bar
+    __QUEUE_STAT__ = 8
         
     def __init__(self,dev_clss):
         super(self.__class__, self).__init__()
@@ -49,35 +60,64 @@ class Gui(QMainWindow):
         # Create Dockwidget holding the device image and widgets
         self.dock2 = DockWidget()
         self.dock2.close.connect(self.quitDevice)
+        self.dock2.resized.connect(self.resizeimage)
         self.addDockWidget(Qt.RightDockWidgetArea,self.dock2)            
         self.setDockNestingEnabled(True)
-        # Create toolbar that will hold all widgets related to each device
-        self.toolbar = self.addToolBar("Device")
-        # Hide the dock and toolbar widget since there is no device initially
+        # Toolbars holding the widgets of each opened device, by slot
+        self.toolbars = {}
+        # Frame accounting of each opened device, by slot
+        self.queue_stats = {}
+        # Latency histograms of each opened device, by slot
+        self.latencies = {}
+        # Combo boxes of each opened device by title, by slot
+        self.combos = {}
+        # Hide the dock widget since there is no device initially
         self.dock2.hide()
-        self.toolbar.hide()
         
     def _createMenu(self,dev_clss):
         """
-        Creates the Menubar and all available devices
-        
-        TODO: 
-        - Dynamically update menubar. Just recorded videos are not seen and
-        the applications needs be restarted to see them.
+        Creates the Menubar with a submenu for every device class. The sources
+        themselves are added and removed by addSource/removeSource as they are
+        discovered, so the window does not wait for discovery.
         """
         self.menu = self.menuBar().addMenu("&Select Source")
+        self.source_menus = {}
+        self.source_actions = {}
+        # Open sources side by side instead of replacing the current ones
+        self.keep_action = self.createAction("Keep Open Sources")
+        self.keep_action.setCheckable(True)
+        self.menu.addAction(self.keep_action)
+        close = self.createAction("Close All Sources")
+        close.triggered.connect(self.quitDevice)
+        self.menu.addAction(close)
+        self.menu.addSeparator()
         
         for dev_cls in dev_clss:
             # add classname to menu
             icon = QIcon(self.__ICON_DIR__+"%s" % dev_cls.getClassIcon())
             menu = self.menu.addMenu(icon,dev_cls.getClassName())      
-            
-            # for every available device in each class add action
-            for name,path in dev_cls.getPaths():
-                action = self.createAction(name)
-                action.my_data = [dev_cls,name,path]
-                action.triggered.connect(self.openDevice)  
-                menu.addAction(action)
+            self.source_menus[dev_cls] = menu
+
+    def addSource(self,dev_cls,name,path):
+        """
+        Adds an available device to the menu of its class, sorted by name.
+        """
+        action = self.createAction(name)
+        action.my_data = [dev_cls,name,path]
+        action.triggered.connect(self.openDevice)  
+        menu = self.source_menus[dev_cls]
+        before = None
+        for other in menu.actions():
+            if other.text() > name:
+                before = other
+                break
+        menu.insertAction(before,action)
+        self.source_actions[(dev_cls,name,path)] = action
+
+    def removeSource(self,dev_cls,name,path):
+        action = self.source_actions.pop((dev_cls,name,path),None)
+        if action is not None:
+            self.source_menus[dev_cls].removeAction(action)
         
     def _createStatusBar(self):
         self.sizeLabel = QLabel()
@@ -110,18 +150,51 @@ class Gui(QMainWindow):
     def openDevice(self):
         data = self.sender().my_data
         self.opendevice.emit(*data)     
-        self.dock2.setTitle(0,data[1])
+
+    def keepSources(self):
+        return self.keep_action.isChecked()
+
+    def addDevice(self,slot,name,specs,latency=None):
+        """
+        Adds the tile and the toolbar of a newly opened device.
+
+        Args:
+            slot: (int) Slot of the device, used to address its tile.
+            name: (str) Name of the device.
+            specs: (list) Widget specs of the device and its recorder.
+            latency: (stats.Latency) Latency histograms of the device, the
+                paint stage is stamped here.
+        """
+        toolbar = self.addToolBar(name)
+        close = self.createAction("Close "+name)
+        close.triggered.connect(lambda: self.closedevice.emit(slot))
+        toolbar.addAction(close)
+        self.toolbars[slot] = toolbar
+        if latency is not None:
+            self.latencies[slot] = latency
+        self.combos[slot] = {}
+        self.addActions(toolbar,specs,self.combos[slot])
+        self.dock2.addTile(slot,name)
         self.dock2.show()
+
+    def removeDevice(self,slot):
+        toolbar = self.toolbars.pop(slot,None)
+        if toolbar is not None:
+            self.removeToolBar(toolbar)
+            toolbar.deleteLater()
+        self.dock2.removeTile(slot)
+        self.queue_stats.pop(slot,None)
+        self.latencies.pop(slot,None)
+        self.combos.pop(slot,None)
+        self.updateStatus()
         
     def quitDevice(self):
         self.quitdevice.emit()
-        self.toolbar.clear()
-        self.toolbar.hide()
+        for slot in list(self.toolbars):
+            self.removeDevice(slot)
         self.dock2.clear()
 
-    def addActions(self,specs):
-        self.toolbar.show()
-        
+    def addActions(self,toolbar,specs,combos=None):
         if specs is not None:
             for spec in specs:
                 title = spec[0]
@@ -133,30 +206,67 @@ class Gui(QMainWindow):
                     action = self.createAction(title,icon=icon)
                     action.my_data = func
                     action.triggered.connect(self.doCommand)
-                    self.toolbar.addAction(action) 
+                    toolbar.addAction(action) 
                 elif sort == "C":
                     items = spec[-1]
                     widget = QComboBox()
                     widget.addItems(items)
                     widget.my_data = func
                     widget.currentIndexChanged.connect(self.doCommand)
-                    self.toolbar.addWidget(widget)
+                    toolbar.addWidget(widget)
+                    if combos is not None:
+                        combos[title] = widget
                 elif sort == "T":
                     widget = QLineEdit()
                     widget.setText(spec[-1])
                     widget.my_data = func
                     l = lambda: self.doCommand(widget.text())
                     widget.textChanged.connect(l)
-                    self.toolbar.addWidget(widget)
+                    toolbar.addWidget(widget)
+                elif sort == "S":
+                    widget = QSlider(Qt.Horizontal)
+                    widget.setRange(0,max(spec[-1]-1,0))
+                    widget.setToolTip(title)
+                    widget.my_data = func
+                    widget.valueChanged.connect(self.doCommand)
+                    toolbar.addWidget(widget)
             
     def doCommand(self,data):
         self.sender().my_data(data)
 
-    def updateStat(self,stats):
-        self.dock2.updateStat(stats)
+    def setItems(self,slot,title,items,index):
+        """
+        Replaces the items of a combo box of a device, e.g. when its formats
+        changed, without calling its command.
+        """
+        widget = self.combos.get(slot,{}).get(title)
+        if widget is None:
+            return
+        widget.blockSignals(True)
+        widget.clear()
+        widget.addItems(items)
+        widget.setCurrentIndex(index)
+        widget.blockSignals(False)
+
+    def updateStat(self,slot,stats):
+        self.dock2.updateStat(slot,stats)
+        for index,text in stats:
+            if index == self.__QUEUE_STAT__:
+                self.queue_stats[slot] = text
+                self.updateStatus()
+
+    def updateStatus(self):
+        # frame accounting of all open sources
+        texts = ["%s: %s" % (self.toolbars[slot].windowTitle(),text)
+                 for slot,text in sorted(self.queue_stats.items())
+                 if slot in self.toolbars]
+        self.sizeLabel.setText("  |  ".join(texts))
         
-    def updateImage(self,pixmap):
-        self.dock2.updateImage(pixmap)
+    def updateImage(self,slot,pixmap,stamps=None):
+        self.dock2.updateImage(slot,pixmap)
+        latency = self.latencies.get(slot)
+        if latency is not None and stamps is not None:
+            latency.stamp(stamps,"paint")
         
     def sizeHint(self):
         return QSize(640,480)                      
@@ -166,47 +276,110 @@ class Gui(QMainWindow):
         event.accept()
 
 class DockWidget(QDockWidget):
-    
+    """
+    Dock holding one tile per opened device, arranged in a grid.
+    """
     close = pyqtSignal()
+    resized = pyqtSignal(int,int,int)
     
     def __init__(self):
         super(self.__class__, self).__init__()   
         
-        self.label = QLabel()
-        self.label.setMinimumSize(1,1)
-        self.setWidget(self.label) 
+        self.widget = QWidget()
+        self.grid = QGridLayout(self.widget)
+        self.grid.setContentsMargins(0,0,0,0)
+        self.setWidget(self.widget) 
         
         self.setFloating(False)
         self.setAllowedAreas(Qt.AllDockWidgetAreas)
 
         self.setSizePolicy(QSizePolicy.Minimum,QSizePolicy.Minimum)
-        self.default_title = None
+        self.tiles = {}
+        
+    def addTile(self,slot,name):
+        tile = Tile()
+        tile.setTitle(0,name)
+        tile.label.resized.connect(
+            lambda width,height: self.resized.emit(slot,width,height))
+        self.tiles[slot] = tile
+        self._arrange()
+
+    def removeTile(self,slot):
+        tile = self.tiles.pop(slot,None)
+        if tile is not None:
+            self.grid.removeWidget(tile)
+            tile.deleteLater()
+            self._arrange()
+
+    def _arrange(self):
+        for tile in self.tiles.values():
+            self.grid.removeWidget(tile)
+        cols = int(np.ceil(np.sqrt(len(self.tiles))))
+        for i,slot in enumerate(sorted(self.tiles)):
+            self.grid.addWidget(self.tiles[slot],i // cols,i % cols)
+        names = [self.tiles[s].title_list[0] for s in sorted(self.tiles)]
+        self.setWindowTitle(" | ".join(names))
         
+    def closeEvent(self,event):
+        self.close.emit()
+        event.accept()
+        
+    def updateStat(self,slot,stats):
+        if slot in self.tiles:
+            self.tiles[slot].updateStat(stats)
+        
+    def updateImage(self,slot,pixmap):
+        if slot in self.tiles:
+            self.tiles[slot].updateImage(pixmap)
+        
+    def clear(self):
+        for slot in list(self.tiles):
+            self.removeTile(slot)
+
+class Tile(QWidget):
+    """
+    Image and statistics of a single device.
+    """
+    def __init__(self):
+        super(self.__class__, self).__init__()   
+
+        self.label = ImageLabel()
+        self.label.setMinimumSize(1,1)
+        self.label.setAlignment(Qt.AlignCenter)
+        # tiles share the dock, the image must not push the layout around
+        self.label.setSizePolicy(QSizePolicy.Ignored,QSizePolicy.Ignored)
+        self.stat = QLabel()
+        self.stat.setWordWrap(True)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        layout.addWidget(self.label,1)
+        layout.addWidget(self.stat)
+
         self.title_list = []
         self.s = " || "
         
     def setTitle(self,index,title):
         if len(self.title_list) <= index:
-            self.title_list+=[" - "] * (index+1)
+            self.title_list += [" - "] * (index+1-len(self.title_list))
         
         self.title_list[index] = title            
-        self.setWindowTitle(self.s.join(self.title_list))
-        
-    def closeEvent(self,event):
-        self.close.emit()
-        event.accept()
-        
+        self.stat.setText(self.s.join(self.title_list))
+
     def updateStat(self,stats):
         for s in stats:
             self.setTitle(*s)   
         
     def updateImage(self,pixmap):
-        pixmap = pixmap.scaled(
-            self.label.size(),
-            Qt.KeepAspectRatio,Qt.SmoothTransformation
-        )
+        # already scaled to the label by the display thread
         self.label.setPixmap(pixmap)
-        
-    def clear(self):
-        self.label.clear()
-        
+
+class ImageLabel(QLabel):
+    """
+    Label reporting its size, so images can be scaled before they reach the
+    GUI thread.
+    """
+    resized = pyqtSignal(int,int)
+
+    def resizeEvent(self,event):
+        super(self.__class__, self).resizeEvent(event)
+        self.resized.emit(event.size().width(),event.size().height())
@@ -0,0 +1,273 @@
+"""
+Headless recording without Qt, for machines without a display.
+
+Run from the repository root:
+
+    python -m trec formats --device /dev/video2
+    python -m trec record --device /dev/video2 --format MJPG:1280x720@30 \
+        --duration 60 --encoder segments --output recordings
+
+Capture runs on a plain thread reading into a frame pool, the main thread
+encodes. There is no display path, so frames are only converted if the
+encoder needs it; with --passthrough MJPG frames are not even decoded.
+Stats are printed to stdout once per interval.
+"""
+import argparse
+import os
+import queue
+import signal
+import threading
+import time
+
+import cv2
+
+import mjpg
+import mono
+import v4l2
+from pool import FramePool
+from queues import FrameQueue
+from stats import RateMeter
+from recording import (
+    ENCODER_NAMES,
+    startEncoder,
+    recordingName,
+    openWriter,
+    RecordingMeta
+)
+
+RECORD_Q = 16
+
+def poolSize(queue_depth):
+    # Frames in flight: the queue, one being read and one being written
+    return queue_depth + 2
+
+class Capture(threading.Thread):
+    """
+    Reads frames of a V4L2 device into pooled buffers and offers them to
+    the record queue.
+
+    Args:
+        path: (str) Device node.
+        fff: (list) [fourcc,width,height,fps], or None for the default.
+        frame_pool: (FramePool) Buffers to read into.
+        record_queue: (FrameQueue) Queue popped by the recorder.
+        passthrough: (bool) Read MJPG frames compressed, see mjpg.py.
+    """
+    def __init__(self,path,fff,frame_pool,record_queue,passthrough=False):
+        super().__init__(daemon=True)
+        self.path = path
+        self.frame_pool = frame_pool
+        self.record_queue = record_queue
+        self.reader = cv2.VideoCapture(path)
+        if fff is not None:
+            v4l2.setFormat(self.reader,*fff)
+        self.FPS = int(self.reader.get(cv2.CAP_PROP_FPS)) or 30
+        fourcc = int(self.reader.get(cv2.CAP_PROP_FOURCC))
+        fourcc = "".join(chr(fourcc >> 8*i & 0xFF) for i in range(4))
+        self.codec = None
+        if passthrough and fourcc in mjpg.CODECS:
+            self.codec = fourcc
+            self.reader.set(cv2.CAP_PROP_CONVERT_RGB,0)
+        # mono frames are kept at their depth, not expanded to BGR
+        self.mono = fourcc if mono.isMono(fourcc) else None
+        if self.mono is not None:
+            self.reader.set(cv2.CAP_PROP_CONVERT_RGB,0)
+            self.width = int(self.reader.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self.height = int(self.reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = RateMeter("Capture")
+        self.failures = 0
+        self.seq = 0
+        self.running = True
+
+    def isOpened(self):
+        return self.reader.isOpened()
+
+    def run(self):
+        while self.running:
+            tb = time.monotonic()
+            if self.mono is not None:
+                frame = self.frame_pool.acquire()
+                retval,image = mono.read(self.reader,self.mono,self.width,
+                                         self.height,frame.image)
+            elif self.codec is None:
+                frame = self.frame_pool.acquire()
+                retval,image = self.reader.read(frame.image)
+            else:
+                # compressed frames are not pooled, their size varies
+                retval,image = self.reader.read()
+                codec = self.codec if mjpg.isCompressed(image) else None
+                frame = self.frame_pool.wrap(image,codec)
+            ta = time.monotonic()
+            if not retval:
+                frame.release()
+                self.failures += 1
+                continue
+            if frame.codec is None:
+                frame = self.frame_pool.adopt(frame,image)
+            frame.stamp("read",tb)
+            frame.stamp("capture",ta)
+            frame.seq = self.seq
+            self.seq += 1
+            self.fps.add(tb,ta)
+            self.record_queue.offer([ta,frame,self.FPS],ta)
+        self.reader.release()
+
+    def stop(self):
+        self.running = False
+        self.record_queue.setActive(False)
+        self.join()
+
+def listFormats(args):
+    devices = v4l2.listDevices()
+    paths = [args.device] if args.device else [p for n,p in devices]
+    for path in paths:
+        print(path)
+        fffs = v4l2.getFormats(path)
+        for key in sorted(fffs):
+            fourcc,width,height,fps = fffs[key]
+            print("  %s:%dx%d@%d" % (fourcc,width,height,fps))
+    return 0
+
+def nextItem(record_queue,stopped,deadline=None):
+    """
+    Returns the next queued item, or None once stopped is set or the
+    monotonic deadline passed.
+    """
+    while not stopped.is_set():
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        try:
+            return record_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def record(args):
+    fff = v4l2.parseFormat(args.format) if args.format else None
+    encoder = ENCODER_NAMES.index(args.encoder)
+    frame_pool = FramePool(poolSize(args.queue))
+    record_queue = FrameQueue(args.queue,args.policy,name="record")
+    capture = Capture(args.device,fff,frame_pool,record_queue,
+                      args.passthrough)
+    if not capture.isOpened():
+        print("Cannot open %s" % args.device)
+        return 1
+
+    # spawning encoder processes takes longer than a frame
+    process = startEncoder(encoder)
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT,lambda *a: stopped.set())
+    capture.start()
+
+    item = nextItem(record_queue,stopped)
+    if item is None:
+        capture.stop()
+        if process is not None:
+            process.quit()
+        return 1
+    ta,frame,fps = item
+    codec = frame.codec
+    if codec is not None:
+        shape = mjpg.imageShape(frame.image)
+        # written as captured, whatever the encoder
+        encoder = 0
+    else:
+        shape = frame.image.shape
+    dtype = frame.image.dtype
+    os.makedirs(args.output,exist_ok=True)
+    name = args.name or os.path.basename(args.device)
+    filename = recordingName(args.output,name,shape,fps,
+                             "_"+args.suffix if args.suffix else "",encoder)
+    meta = RecordingMeta(name,filename,encoder,fps,shape,dtype,codec)
+    writer = openWriter(encoder,process,filename,args.codec,fps,shape,dtype,
+                        codec)
+    if writer is None:
+        frame.release()
+        capture.stop()
+        if process is not None:
+            process.quit()
+        print("Cannot open writer for %s" % filename)
+        return 1
+
+    print("Recording %s to %s (%s)" % (args.device,filename,
+                                       meta.meta["encoder"]))
+    if meta.meta["stored_dtype"] != meta.meta["dtype"]:
+        print("The encoder stores %s frames as 8 bits, raw, ffv1, ffv1-pipe "
+              "and png keep them" % dtype)
+    latency = frame_pool.latency
+    write_fps = RateMeter("Write")
+    start = ta
+    deadline = start + args.duration if args.duration else None
+    next_stat = start + args.interval
+    while item is not None:
+        ta,frame,fps = item
+        written = writer.write(frame.image,ta,frame.seq)
+        frame.stamp("write")
+        frame.release()
+        meta.update(ta,written)
+
+        now = time.monotonic()
+        if now >= next_stat:
+            next_stat += args.interval
+            printStats(now-start,capture,write_fps,record_queue,latency)
+        tb = time.monotonic()
+        item = nextItem(record_queue,stopped,deadline)
+        write_fps.add(tb,time.monotonic())
+
+    capture.stop()
+    # frames captured before the stop belong to the recording
+    while not record_queue.empty():
+        ta,frame,fps = record_queue.get()
+        written = writer.write(frame.image,ta,frame.seq)
+        frame.stamp("write")
+        frame.release()
+        meta.update(ta,written)
+    writer.release()
+    if process is not None:
+        process.quit()
+
+    meta.setQueue(record_queue.getStats())
+    meta.save()
+    printStats(time.monotonic()-start,capture,write_fps,record_queue,latency)
+    print("Saved %d frames, metadata in %s" % (meta.meta["frames"],
+                                               meta.filename))
+    return 0
+
+def printStats(t,capture,write_fps,record_queue,latency):
+    cap_fps,cap_load = capture.fps.getRate()
+    wr_fps,wr_load = write_fps.getRate()
+    print("%7.1f s  capture %5.1f fps  write %5.1f fps (%5.1f %%)  %s  %s" % (
+        t,cap_fps,wr_fps,wr_load,record_queue.getStatString("queue"),
+        latency.getStatString(("Disk",))),flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m trec",
+                                     description="TREC headless recorder")
+    sub = parser.add_subparsers(dest="command",required=True)
+    fmt = sub.add_parser("formats",help="list devices and their formats")
+    fmt.add_argument("--device",default=None)
+    rec = sub.add_parser("record",help="record a V4L2 device")
+    rec.add_argument("--device",default="/dev/video0")
+    rec.add_argument("--format",default=None,
+                     help="FOURCC:WIDTHxHEIGHT@FPS, e.g. MJPG:1280x720@30")
+    rec.add_argument("--duration",default=None,type=float,
+                     help="seconds, until Ctrl-C if not given")
+    rec.add_argument("--encoder",default="thread",choices=ENCODER_NAMES)
+    rec.add_argument("--codec",default=None,
+                     help="fourcc of OpenCV encoders, default of the preset")
+    rec.add_argument("--passthrough",action="store_true",
+                     help="record MJPG frames as the camera compressed them")
+    rec.add_argument("--output",default="recordings")
+    rec.add_argument("--name",default=None,
+                     help="source name in the filename, default the device")
+    rec.add_argument("--suffix",default=None,help="filename add-on")
+    rec.add_argument("--policy",default=FrameQueue.POLICIES[0],
+                     choices=FrameQueue.POLICIES)
+    rec.add_argument("--queue",default=RECORD_Q,type=int,help="queue depth")
+    rec.add_argument("--interval",default=1.0,type=float,
+                     help="seconds between stats")
+    args = parser.parse_args(argv)
+
+    if args.command == "formats":
+        return listFormats(args)
+    return record(args)
@@ -1,15 +1,152 @@
 import sys
-import queue
 
 from PyQt5.QtCore import QObject,pyqtSlot
 from PyQt5.QtWidgets import QApplication
 
 from gui import Gui
 from record import RecordHandler
-from device import DeviceHandler,CameraDevice,VideoRecord
-from display import DisplayHandler
+from device import (
+    DeviceHandler,
+    DiscoveryHandler,
+    CaptureDevice,
+    CameraDevice,
+    VideoRecord,
+    RawRecord,
+    SyntheticDevice
+)
+from display import DisplayHandler,Display
+from analysis import Analyzer
+from pool import FramePool
+from stage import FrameStage
+from queues import FrameQueue
 
-MAX_Q = 5 # maximum queue size. 
+# Queue depth per path. A deeper record queue absorbs encoder hiccups, the
+# display only ever needs the latest frames.
+DISPLAY_Q = 3
+RECORD_Q = 8
+# Analysis copies a small view of the frame and releases it right away
+ANALYSIS_Q = 4
+# Selectable depths per path, the first is the default
+DEPTHS = {"Display":[DISPLAY_Q,1,2,4,8],
+          "Record":[RECORD_Q,2,4,16,32,64,128],
+          "Analysis":[ANALYSIS_Q,1,2,8,16]}
+
+def poolSize(depths):
+    """
+    Frames in flight: all queues, one being read, displayed, recorded and
+    analyzed each.
+    """
+    return sum(depths) + 4
+
+POOL_SIZE = poolSize([DISPLAY_Q,RECORD_Q,ANALYSIS_Q])
+
+class Pipeline:
+    """
+    Queues and threads of one opened source.
+
+    Every source gets its own capture thread, display thread, frame pool and,
+    for cameras, recorder, so several sources run side by side without sharing
+    a bottleneck. All capture timestamps use the system wide monotonic clock,
+    which makes recordings of different sources comparable afterwards.
+    """
+    def __init__(self,slot,gui,dev_cls,name,path,rec_name,device_classes):
+        self.recordable = issubclass(dev_cls,CaptureDevice)
+        # Queue pushed by Device, popped by Display
+        self.display_q = FrameQueue(DISPLAY_Q,name="display")
+        # Queue pushed by Device, popped by Recorder while it records
+        self.record_q = FrameQueue(RECORD_Q,active=False,name="record")
+        # Queue pushed by Device, popped by Analyzer
+        self.analysis_q = FrameQueue(ANALYSIS_Q,name="analysis")
+        # Preallocated frame buffers shared by all queues
+        self.frame_pool = FramePool(POOL_SIZE)
+        # Crop, binning and decimation per path, applied by capture devices
+        self.display_stage = FrameStage(self.frame_pool,"Display",DISPLAY_Q+2)
+        self.record_stage = FrameStage(self.frame_pool,"Record",RECORD_Q+2)
+        # Resized together when the depth of a path changes
+        self.queues = {"Display":self.display_q,"Record":self.record_q,
+                       "Analysis":self.analysis_q}
+        self.stages = {"Display":self.display_stage,
+                       "Record":self.record_stage}
+        self.analyzer = Analyzer(self.analysis_q)
+        self.analyzer.start()
+        self.display_h = DisplayHandler(
+            gui,self.display_q,slot,
+            self.record_q if self.recordable else None,
+            self.analyzer
+        )
+        self.device_h = DeviceHandler(
+            self.display_q,self.record_q,self.analysis_q,self.frame_pool,
+            device_classes,
+            [self.display_stage,self.record_stage] if self.recordable else None
+        )
+        self.record_h = RecordHandler(self.record_q,self.display_q,
+                                      self.analyzer,self.record_stage)
+        # Start new device in new thread 
+        self.device_h.setDevice(dev_cls,name,path)
+        # Cameras refresh their formats in the background
+        if dev_cls is CameraDevice:
+            self.device_h.device.updateItems.connect(
+                lambda title,items,index: gui.setItems(slot,title,items,index))
+        # Camera devices can be recorded, VideoDevices cannot
+        if self.recordable:
+            self.record_h.setRecorder(rec_name)  
+
+    def getGuiSpecs(self):
+        specs = self.device_h.getGuiSpecs() or []
+        specs += self.record_h.getGuiSpecs() or []
+        # What the device does when a consumer falls behind
+        specs += [["Display Policy",self.display_q.setPolicy,"C",0,10,1,1,
+                   FrameQueue.getPolicyNames("Display")]]
+        if self.recordable:
+            specs += [["Record Policy",self.record_q.setPolicy,"C",0,11,1,1,
+                       FrameQueue.getPolicyNames("Record")]]
+        # How many frames each path buffers before the policy applies
+        paths = ["Display","Record","Analysis"]
+        if not self.recordable:
+            paths.remove("Record")
+        for col,path in enumerate(paths,28):
+            specs += [[path + " Depth",
+                       lambda index,path=path: self.setDepth(path,index),
+                       "C",0,col,1,1,
+                       ["%s queue: %d" % (path,d) for d in DEPTHS[path]]]]
+        specs += [["Analysis",self.analyzer.setStep,"C",0,12,1,1,
+                   Analyzer.STEP_NAMES],
+                  ["Analysis ROI",self.analyzer.setROI,"T",0,27,1,1,
+                   "Analysis ROI x,y,w,h"]]
+        if self.recordable:
+            specs += self.display_stage.getGuiSpecs(19)
+            specs += self.record_stage.getGuiSpecs(22)
+        # How deeper and mono frames are mapped to the screen
+        specs += [["Levels",self.display_h.setLevels,"C",0,25,1,1,
+                   Display.getLevelNames()],
+                  ["Levels Window",self.display_h.setWindow,"T",0,26,1,1,
+                   "Levels low,high[,gamma]"]]
+        return specs
+
+    def setDepth(self,path,index):
+        """
+        Changes the queue depth of a path, "Display", "Record" or "Analysis"
+        (see DEPTHS), and sizes the frame pool, and the output buffers of the
+        stage of the path, to the frames then in flight.
+        """
+        depth = DEPTHS[path][index]
+        self.queues[path].setDepth(depth)
+        if path in self.stages:
+            self.stages[path].pool.setSize(depth + 2)
+        self.frame_pool.setSize(
+            poolSize([q.maxsize for q in self.queues.values()]))
+
+    def getLatency(self):
+        """
+        Returns the latency percentiles of every stage, see stats.Latency.
+        """
+        return self.frame_pool.latency.getStats()
+
+    def quit(self):
+        self.record_h.quitRecorder()
+        self.device_h.quitDevice()
+        self.display_h.quitDisplay()
+        self.analyzer.quit()
 
 class TREC(QObject):    
     """
@@ -18,28 +155,28 @@ class TREC(QObject):
     This GUI application enables camera capturing and recording of all devices 
     supported by Video4Linux (V4L2) device drivers. Multiple resolutions and 
     codecs can be chosen for capturing. Multiple threads enable a responsive GUI
-    and minimizes latency for capturing, recording and displaying.
+    and minimizes latency for capturing, recording and displaying. Several 
+    sources can be opened at the same time, each with its own pipeline.
     """
     def __init__(self):                             
         super(self.__class__,self).__init__()        
         """
-        Creates queues, thread handlers and connects them.
+        Creates the GUI and discovery handler and connects them.
         """
-        # Queue pushed by Device, popped by Display
-        self.display_q = queue.Queue(maxsize=MAX_Q)
-        # Queue pushed by Device, popped by Recorder
-        self.record_q = queue.Queue(maxsize=MAX_Q)
         # Devices. Can be expanded by adding new device created in device.py
-        self.devices = [CameraDevice, VideoRecord]  
-        # Thread handlers for GUI,display,device,record
+        self.devices = [CameraDevice, VideoRecord, RawRecord, SyntheticDevice]
+        # Open sources by slot
+        self.pipelines = {}
+        # Thread handlers for GUI and discovery, pipelines have their own
         self.gui = Gui(self.devices)
-        self.display_h = DisplayHandler(self.gui,self.display_q)
-        self.device_h = DeviceHandler(self.display_q,self.record_q,self.devices)
-        self.record_h = RecordHandler(self.record_q,self.display_q)
+        # Fills the source menu in the background and keeps it up to date
+        self.discovery_h = DiscoveryHandler(self.gui,self.devices)
         # Connect GUI signals with slots. 
         self.gui.opendevice.connect(self._openDevice)
+        self.gui.closedevice.connect(self._closeDevice)
         self.gui.quitdevice.connect(self._quitDevice)
         self.gui.quitapp.connect(self._quitApp)
+        self.gui.resizeimage.connect(self._resizeImage)
         
     @pyqtSlot(object,str,str)
     def _openDevice(self,dev_cls,name,path):
@@ -51,25 +188,50 @@ class TREC(QObject):
             name: (str) The name of the device.
             path: (str) Path to device
         """
-        # Close device that is opened first, if any
-        self.gui.quitDevice()
-        # Start new device in new thread 
-        self.device_h.setDevice(dev_cls,name,path)
+        # Close devices that are opened first, unless they are kept
+        if not self.gui.keepSources():
+            self.gui.quitDevice()
+        slot = 0
+        while slot in self.pipelines:
+            slot += 1
+        # Identical cameras would otherwise record to the same filename
+        names = [p.device_h.device.dev_name for p in self.pipelines.values()
+                 if p.recordable]
+        rec_name = name if name not in names else "%s_%d" % (name,slot)
+        pipeline = Pipeline(slot,self.gui,dev_cls,name,path,rec_name,
+                            self.devices)
+        self.pipelines[slot] = pipeline
         # Get/Set all widget specs for creating device specific GUI widgets
-        self.gui.addActions(self.device_h.getGuiSpecs())     
-        # Camera devices can be recorded, VideoDevices cannot
-        if dev_cls == CameraDevice:
-            self.record_h.setRecorder(name)  
-            self.gui.addActions(self.record_h.getGuiSpecs())
+        self.gui.addDevice(slot,name,pipeline.getGuiSpecs(),
+                           pipeline.frame_pool.latency)
         
+    @pyqtSlot(int)
+    def _closeDevice(self,slot):
+        """
+        Slot initiated by GUI to close a single device
+        """
+        pipeline = self.pipelines.pop(slot,None)
+        if pipeline is not None:
+            pipeline.quit()
+        self.gui.removeDevice(slot)
+        
+    @pyqtSlot(int,int,int)
+    def _resizeImage(self,slot,width,height):
+        """
+        Slot initiated by GUI when the image of a device changed size
+        """
+        pipeline = self.pipelines.get(slot)
+        if pipeline is not None:
+            pipeline.display_h.setSize(width,height)
+
     @pyqtSlot()
     def _quitDevice(self):
 
         """
-        Slot initiated by GUI to quit device
+        Slot initiated by GUI to quit all devices
         """
-        self.record_h.quitRecorder()
-        self.device_h.quitDevice()
+        for slot in list(self.pipelines):
+            self.pipelines.pop(slot).quit()
 
     @pyqtSlot()
     def _quitApp(self):
@@ -78,7 +240,7 @@ class TREC(QObject):
         Slot initiated by GUI to quit application
         """
         self._quitDevice()
-        self.display_h.quitDisplay()
+        self.discovery_h.quitDiscovery()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)   
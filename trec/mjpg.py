@@ -0,0 +1,71 @@
+"""
+Compressed MJPG frames, passed from the camera to the recording undecoded.
+
+A V4L2 camera delivering MJPG hands over complete JPEG images. With
+CAP_PROP_CONVERT_RGB off OpenCV returns them as they are, a 1xN uint8 array,
+which is muxed into the recording without re-encoding (encoder.
+PassthroughWriter). Such frames carry their codec (pool.Frame.codec), and only
+the stages that need pixels decode them, at the scale they need: libjpeg
+decodes at 1/2, 1/4 and 1/8 scale for a fraction of the cost.
+"""
+import cv2
+import numpy as np
+
+# Codecs of frames that can be passed through
+CODECS = ("MJPG",)
+# Reduced decoding, scale -> (color,grayscale) flags of cv2.imdecode
+REDUCED = {1:(cv2.IMREAD_COLOR,cv2.IMREAD_GRAYSCALE),
+           2:(cv2.IMREAD_REDUCED_COLOR_2,cv2.IMREAD_REDUCED_GRAYSCALE_2),
+           4:(cv2.IMREAD_REDUCED_COLOR_4,cv2.IMREAD_REDUCED_GRAYSCALE_4),
+           8:(cv2.IMREAD_REDUCED_COLOR_8,cv2.IMREAD_REDUCED_GRAYSCALE_8)}
+# Start of frame markers, the others in 0xC0-0xCF are tables
+SOF = set(range(0xC0,0xD0)) - {0xC4,0xC8,0xCC}
+
+def isCompressed(image):
+    """
+    Returns whether a read returned a JPEG image rather than pixels, backends
+    that cannot pass MJPG through decode it anyway.
+    """
+    return (image is not None and image.dtype == np.uint8
+            and image.size > 2 and image.shape[0] == 1
+            and image.flat[0] == 0xFF and image.flat[1] == 0xD8)
+
+def imageShape(data):
+    """
+    Returns the shape of the decoded image from the JPEG header, (height,
+    width,3) or (height,width) for grayscale, or None if there is no header.
+    """
+    data = np.asarray(data).reshape(-1)
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = int(data[i+1])
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        size = int(data[i+2]) << 8 | int(data[i+3])
+        if marker in SOF:
+            height = int(data[i+5]) << 8 | int(data[i+6])
+            width = int(data[i+7]) << 8 | int(data[i+8])
+            if data[i+9] == 1:
+                return (height,width)
+            return (height,width,3)
+        i += 2 + size
+    return None
+
+def decode(data,step=1,gray=False):
+    """
+    Decodes a compressed frame scaled down by the largest of 1, 2, 4 or 8 not
+    above step. Returns the image and that scale, the image is None if the
+    frame is corrupt.
+
+    Args:
+        data: (np.ndarray) Compressed frame.
+        step: (int) Frame pixels per decoded pixel that suffice.
+        gray: (bool) Decode the luminance only.
+    """
+    scale = max(s for s in REDUCED if s <= max(step,1))
+    image = cv2.imdecode(np.asarray(data).reshape(-1),REDUCED[scale][gray])
+    return image,scale
@@ -0,0 +1,67 @@
+"""
+Monochrome sensor formats, 8-bit GREY and 10/16-bit Y10/Y16.
+
+Scientific cameras deliver a single channel of up to 16 bits. With
+CAP_PROP_CONVERT_RGB on OpenCV expands such frames to 8-bit BGR, three times
+the bytes and deeper ones cut to 8 bits, so they are read with it off and
+kept as 2D uint8 or uint16 frames all the way: queues, display (windowed
+through a lookup table, see display.Display.window()) and lossless
+recording (recording.keepsDepth()). Y10 keeps its 10 bits in the low bits
+of uint16.
+"""
+import numpy as np
+
+# V4L2 fourcc -> dtype of the frames, significant bits
+FORMATS = {"GREY":("uint8",8),
+           "Y10 ":("uint16",10),
+           "Y16 ":("uint16",16)}
+
+def isMono(fourcc):
+    return fourcc in FORMATS
+
+def getBits(fourcc):
+    return FORMATS[fourcc][1]
+
+def unpack(raw,fourcc,width,height,out=None):
+    """
+    Returns a frame read with CONVERT_RGB off as a 2D image of the dtype of
+    the format, in out if it fits. OpenCV returns the buffer of some formats
+    as it is, a 1xN byte array. None if raw holds no whole frame.
+
+    Args:
+        raw: (np.ndarray) Image returned by cv2.VideoCapture.read().
+        fourcc: (str) Format, a key of FORMATS.
+        width: (int) Frame width.
+        height: (int) Frame height.
+        out: (np.ndarray) Buffer of a previous frame.
+    """
+    dtype = np.dtype(FORMATS[fourcc][0])
+    if raw.shape == (height,width) and raw.dtype == dtype:
+        return raw
+    if raw.ndim == 3:
+        # expanded to BGR after all, the channels are equal
+        image = raw[:,:,0]
+        if raw.dtype != dtype:
+            image = image.astype(dtype)
+    else:
+        data = np.ascontiguousarray(raw).reshape(-1).view(np.uint8)
+        size = width * height * dtype.itemsize
+        if data.size < size:
+            return None
+        # V4L2 words are little-endian
+        image = data[:size].view(dtype.newbyteorder("<")).reshape(height,width)
+    if out is not None and out.shape == image.shape and out.dtype == dtype:
+        np.copyto(out,image)
+        return out
+    return image.astype(dtype,copy=True)
+
+def read(reader,fourcc,width,height,out=None):
+    """
+    Reads a frame of a mono format, returns whether that succeeded and the
+    image, see unpack().
+    """
+    retval,raw = reader.read(out)
+    if not retval or raw is None:
+        return False,None
+    image = unpack(raw,fourcc,width,height,out)
+    return image is not None,image
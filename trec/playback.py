@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+class Pacer:
+    """
+    Paces playback against a monotonic clock.
+
+    wait() sleeps until the next frame is due at the native frame rate times
+    the speed multiplier. Playback that falls behind more than a few frames
+    (slow decode, seek) is resynchronised instead of bursting to catch up.
+    A speed of None disables pacing, the benchmark mode of reading as fast as
+    possible.
+
+    Args:
+        fps: (float) Native frame rate of the recording.
+        speed: (float) Playback speed multiplier, or None for unthrottled.
+    """
+    # GUI choices, the first one is the default
+    SPEEDS = [["1x",1.0],["0.25x",0.25],["0.5x",0.5],["2x",2.0],["4x",4.0],
+              ["8x",8.0],["Unthrottled",None]]
+    MAX_LAG = 4
+
+    def __init__(self,fps,speed=1.0):
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.speed = speed
+        self.reset()
+
+    @classmethod
+    def getSpeedNames(cls):
+        return [name for name,speed in cls.SPEEDS]
+
+    def setSpeed(self,index):
+        self.speed = self.SPEEDS[index][1]
+        self.reset()
+
+    def reset(self):
+        self.next = None
+
+    def wait(self,interval=None):
+        """
+        Sleeps until the current frame is due.
+
+        Args:
+            interval: (float) Recorded time to the next frame in seconds. The
+                nominal frame period is used if None.
+        """
+        if self.speed is None:
+            return
+
+        now = time.monotonic()
+        # reset() may be called from another thread at any time
+        due = self.next
+        if due is None:
+            due = now
+        period = (interval if interval is not None else 1.0/self.fps)
+        period /= self.speed
+        delay = due - now
+        if delay > 0:
+            time.sleep(delay)
+        elif -delay > self.MAX_LAG * period:
+            due = now
+        self.next = due + period
+
+class ReadAhead:
+    """
+    Decodes frames ahead of delivery on its own thread into a bounded buffer,
+    so decode hiccups (large keyframes, disk stalls) are absorbed instead of
+    showing up as stutter.
+
+    Frames are tagged with a generation number. flush() (on seek) bumps the
+    generation so frames decoded before it are dropped. Call flush() while
+    holding the same lock that is passed in, so a frame is never tagged with
+    the wrong generation.
+
+    Args:
+        read: (callable) Returns the next pooled frame, or None at the end.
+        depth: (int) Number of frames decoded ahead.
+        lock: (threading.Lock) Lock guarding the reader.
+    """
+    # GUI choices, the first one is the default. A depth of 0 turns the
+    # read-ahead off and the device decodes each frame inline.
+    DEPTHS = [["Read-ahead: 8",8],["Read-ahead: off",0],["Read-ahead: 2",2],
+              ["Read-ahead: 4",4],["Read-ahead: 16",16],["Read-ahead: 32",32]]
+
+    def __init__(self,read,depth,lock):
+        self.read = read
+        self.depth = depth
+        self.lock = lock
+        self.buffer = queue.Queue(maxsize=depth)
+        self.generation = 0
+        self.underruns = 0
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def getDepthNames(cls):
+        return [name for name,depth in cls.DEPTHS]
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._loop,daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while self.running:
+            with self.lock:
+                generation = self.generation
+                frame = self.read()
+            if frame is None:
+                continue
+            while self.running:
+                try:
+                    self.buffer.put([generation,frame],timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            else:
+                frame.release()
+
+    def get(self,timeout=0.1):
+        """
+        Returns the next buffered frame, or None after timeout. An empty
+        buffer at the time of the request counts as an underrun.
+        """
+        if self.buffer.empty():
+            self.underruns += 1
+        while True:
+            try:
+                generation,frame = self.buffer.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if generation == self.generation:
+                return frame
+            frame.release()
+
+    def flush(self):
+        self.generation += 1
+        while True:
+            try:
+                generation,frame = self.buffer.get_nowait()
+            except queue.Empty:
+                break
+            frame.release()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def getStatString(self):
+        return "Buffer %d/%d, %d underruns" % (
+            self.buffer.qsize(),self.depth,self.underruns)
@@ -0,0 +1,200 @@
+import threading
+
+import numpy as np
+
+from stats import Latency
+
+class Frame:
+    """
+    Image buffer handed out by a FramePool.
+
+    Every consumer that receives a frame owns one reference and has to call
+    release() when it is done with the image. The buffer goes back to the pool
+    as soon as the last reference is released.
+
+    Stages the frame passes are stamped with stamp(), which feeds the latency
+    histograms of its pool.
+
+    codec is None for pixels, or the codec of a compressed image passed
+    through from the camera (see mjpg.py). seq is the number of the frame at
+    its source, if the source counts frames.
+    """
+    __slots__ = ("pool","image","refs","stamps","codec","seq")
+
+    def __init__(self,pool,image,codec=None):
+        self.pool = pool
+        self.image = image
+        self.refs = 1
+        self.stamps = {}
+        self.codec = codec
+        self.seq = None
+
+    def stamp(self,stage,t=None):
+        return self.pool.latency.stamp(self.stamps,stage,t)
+
+    def retain(self,n=1):
+        with self.pool.lock:
+            self.refs += n
+        return self
+
+    def release(self):
+        self.pool.release(self)
+
+class FramePool:
+    """
+    Fixed-size pool of preallocated frame buffers.
+
+    Devices read directly into the buffers of acquired frames, so capture is
+    allocation free once the pool is sized for the current format. A miss
+    (no free buffer or a format change) falls back to a fresh allocation and is
+    counted, which makes steady-state behaviour observable through getStats().
+    The buffers of the previous format are kept, so switching back to it
+    reuses them.
+
+    Args:
+        size: (int) Number of preallocated buffers.
+    """
+    def __init__(self,size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.shape = None
+        self.dtype = None
+        self.free = []
+        # (shape,dtype,free buffers) of the previous format
+        self.spare = (None,None,[])
+        self.latency = Latency()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.allocs = 0
+            self.released = 0
+        self.latency.clear()
+
+    def setSize(self,size):
+        """
+        Changes the number of pooled buffers, e.g. when a consumer holds on to
+        more frames at once. Surplus free buffers are dropped.
+        """
+        with self.lock:
+            self.size = size
+            del self.free[size:]
+            del self.spare[2][size:]
+            if self.shape is not None:
+                self._fill()
+
+    def _fill(self):
+        while len(self.free) < self.size:
+            self.free.append(np.empty(self.shape,self.dtype))
+            self.allocs += 1
+
+    def _configure(self,shape,dtype):
+        # the buffers of the previous format are kept aside, switching back
+        # and forth between two formats does not allocate again
+        spare = self.spare
+        self.spare = (self.shape,self.dtype,self.free)
+        self.shape = shape
+        self.dtype = dtype
+        if spare[0] == shape and spare[1] == dtype:
+            self.free = spare[2]
+        else:
+            self.free = []
+        self._fill()
+
+    def acquire(self):
+        """
+        Returns a frame holding a free buffer of the current format, or a frame
+        without buffer (image is None) if none is available. Readers fill it
+        and hand the result to adopt().
+        """
+        with self.lock:
+            if self.free:
+                self.hits += 1
+                return Frame(self,self.free.pop())
+
+            self.misses += 1
+            return Frame(self,None)
+
+    def adopt(self,frame,image):
+        """
+        Attaches the image a reader returned to the frame. If the reader had
+        to allocate (first frame or format change) the pool is resized to the
+        new format so following reads are allocation free again.
+        """
+        if image is frame.image:
+            return frame
+
+        with self.lock:
+            self.allocs += 1
+            if image.shape != self.shape or image.dtype != self.dtype:
+                self._configure(image.shape,image.dtype)
+                # the buffer of the previous format is kept as a spare
+                if (frame.image is not None
+                    and len(self.spare[2]) < self.size
+                    and frame.image.shape == self.spare[0]
+                    and frame.image.dtype == self.spare[1]):
+                    self.spare[2].append(frame.image)
+
+        frame.image = image
+        return frame
+
+    def wrap(self,image,codec=None):
+        """
+        Returns a frame of an image the pool did not allocate, e.g. a
+        compressed image of varying size. It is not pooled when released.
+        """
+        return Frame(self,image,codec)
+
+    def release(self,frame):
+        with self.lock:
+            frame.refs -= 1
+            if frame.refs > 0:
+                return
+
+            self.released += 1
+            image = frame.image
+            frame.image = None
+            if image is None:
+                return
+            if (len(self.free) < self.size
+                and image.shape == self.shape and image.dtype == self.dtype):
+                self.free.append(image)
+            elif (len(self.spare[2]) < self.size
+                  and image.shape == self.spare[0]
+                  and image.dtype == self.spare[1]):
+                # frames still in flight when the format changed
+                self.spare[2].append(image)
+
+    def getStats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size":self.size,
+                    "free":len(self.free),
+                    "hits":self.hits,
+                    "misses":self.misses,
+                    "allocs":self.allocs,
+                    "hit_rate":self.hits / total if total else 0.0}
+
+    def getStatString(self):
+        s = self.getStats()
+        return "Pool: %d/%d free, %05.1f %% hit" % (
+            s["free"],s["size"],s["hit_rate"]*100)
+
+def releaseQueue(data_queue,index):
+    """
+    Empties a queue of [.., frame, ..] items and releases their frames.
+
+    Args:
+        data_queue: (queue.Queue) Queue to be emptied.
+        index: (int) Position of the frame in each queued item.
+    """
+    with data_queue.mutex:
+        items = list(data_queue.queue)
+        data_queue.queue.clear()
+        data_queue.not_full.notify_all()
+
+    for item in items:
+        if item is not None and isinstance(item[index],Frame):
+            item[index].release()
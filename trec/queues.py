@@ -0,0 +1,162 @@
+import collections
+import queue
+import threading
+
+from pool import Frame
+
+class FrameQueue(queue.Queue):
+    """
+    Bounded frame queue between a device and one consumer with a selectable
+    backpressure policy and exact frame accounting.
+
+    The device calls offer() instead of put(). What happens when the queue is
+    full depends on the policy:
+
+        Drop newest: the offered frame is dropped.
+        Drop oldest: the oldest queued frame is dropped.
+        Latest only: all queued frames are dropped, only the newest is kept.
+        Block:       the device waits until the consumer takes a frame.
+
+    Frames offered while the consumer is inactive (e.g. a recorder that is not
+    recording) are discarded without counting. Dropped frames are released
+    back to their pool and the capture time of the offer that caused the drop
+    is kept.
+
+    Args:
+        maxsize: (int) Queue depth.
+        policy: (str) One of POLICIES.
+        index: (int) Position of the frame in the queued items.
+        active: (bool) Whether the consumer takes frames from the start.
+        name: (str) Prefix of the enqueue/dequeue stamps of the frames, see
+            stats.Latency. Frames are not stamped if None.
+    """
+    POLICIES = ["Drop newest","Drop oldest","Latest only","Block"]
+    # Drop timestamps kept per queue
+    MAX_DROP_TIMES = 100000
+
+    def __init__(self,maxsize,policy="Drop newest",index=1,active=True,
+                 name=None):
+        super().__init__(maxsize)
+        self.index = index
+        self.name = name
+        self.policy = policy
+        self.active = active
+        self.stat_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.stat_lock:
+            self.produced = 0
+            self.delivered = 0
+            self.dropped = 0
+            self.drop_times = collections.deque(maxlen=self.MAX_DROP_TIMES)
+
+    @classmethod
+    def getPolicyNames(cls,prefix):
+        return ["%s: %s" % (prefix,p) for p in cls.POLICIES]
+
+    def setPolicy(self,index):
+        self.policy = self.POLICIES[index]
+
+    def setDepth(self,depth):
+        """
+        Changes the queue depth. Frames queued beyond a smaller depth are
+        kept until they are taken.
+        """
+        with self.mutex:
+            self.maxsize = depth
+            self.not_full.notify_all()
+
+    def setActive(self,active):
+        self.active = active
+
+    def _drop(self,item,t):
+        with self.stat_lock:
+            self.dropped += 1
+            self.drop_times.append(t)
+        item[self.index].release()
+
+    def offer(self,item,t):
+        """
+        Offers a frame item to the consumer, applying the policy when full.
+
+        Args:
+            item: (list) Item holding a Frame at position index.
+            t: (float) Capture time, recorded if the frame is dropped.
+        """
+        if not self.active:
+            item[self.index].release()
+            return
+        with self.stat_lock:
+            self.produced += 1
+        if self.name is not None:
+            item[self.index].stamp(self.name+"_enqueue")
+
+        if self.policy == "Block":
+            while self.active:
+                try:
+                    self.put(item,timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            item[self.index].release()
+            return
+
+        dropped = []
+        with self.mutex:
+            if self.policy in ("Drop oldest","Latest only"):
+                # control items (stop markers, recorder stats) are never evicted
+                frames = [x for x in self.queue if self._isFrame(x)]
+                if self.policy == "Drop oldest":
+                    frames = frames[:max(0,self._qsize()-self.maxsize+1)]
+                if frames:
+                    evict = set(map(id,frames))
+                    kept = [x for x in self.queue if id(x) not in evict]
+                    self.queue.clear()
+                    self.queue.extend(kept)
+                    dropped += frames
+            if self._qsize() >= self.maxsize:
+                dropped.append(item)
+            else:
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+
+        for old in dropped:
+            self._drop(old,t)
+
+    def _isFrame(self,item):
+        return item is not None and isinstance(item[self.index],Frame)
+
+    def get(self,block=True,timeout=None):
+        item = super().get(block,timeout)
+        if self._isFrame(item):
+            with self.stat_lock:
+                self.delivered += 1
+            if self.name is not None:
+                item[self.index].stamp(self.name+"_dequeue")
+        return item
+
+    def getStats(self,since=None):
+        """
+        Returns produced/delivered/dropped counts and drop times, optionally
+        relative to an earlier getStats() result.
+        """
+        with self.stat_lock:
+            stats = {"policy":self.policy,
+                     "depth":self.maxsize,
+                     "produced":self.produced,
+                     "delivered":self.delivered,
+                     "dropped":self.dropped,
+                     "drop_times":list(self.drop_times)}
+        if since is not None:
+            for key in ("produced","delivered","dropped"):
+                stats[key] -= since[key]
+            dropped = stats["dropped"]
+            stats["drop_times"] = stats["drop_times"][-dropped:] if dropped else []
+        return stats
+
+    def getStatString(self,name):
+        with self.stat_lock:
+            return "%s: %d/%d/%d" % (name,self.produced,self.delivered,
+                                     self.dropped)
@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+
+from sidecar import TimeIndex
+
+MAGIC = b"TRECRAW1"
+# Fixed header size, frames start page aligned after it
+HEADER = 4096
+
+def _writeHeader(file,shape,dtype,fps,count):
+    meta = json.dumps({"shape":list(shape),"dtype":np.dtype(dtype).str,
+                       "fps":fps,"count":count}).encode()
+    file.seek(0)
+    file.write((MAGIC + meta).ljust(HEADER,b" "))
+
+def readHeader(filename):
+    with open(filename,"rb") as f:
+        data = f.read(HEADER)
+    if not data.startswith(MAGIC):
+        raise ValueError("Not a raw recording: %s" % filename)
+    return json.loads(data[len(MAGIC):].decode())
+
+class RawWriter:
+    """
+    Writes frames without any encoding into a memory-mapped file.
+
+    The file is a fixed size header (shape, dtype, fps, frame count) followed
+    by the frames back to back. Space is preallocated in blocks and mapped, so
+    writing a frame is a single memory copy. Capture timestamps go into a
+    sidecar, like those of every recording. This trades disk space for CPU:
+    recording keeps up with the sensor as long as the disk does.
+
+    Args:
+        filename: (str) Output filename, ending in .raw.
+        fps: (int) Nominal frame rate.
+        shape: (tuple) Frame shape.
+        dtype: (str) Frame dtype.
+        block: (int) Number of frames preallocated at once.
+    """
+    def __init__(self,filename,fps,shape,dtype=np.uint8,block=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fps = fps
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        # about two seconds of frames per block
+        self.block = block or max(16,int(2*fps))
+        self.count = 0
+        self.capacity = 0
+        self.maps = []
+        self.file = open(filename,"w+b")
+        _writeHeader(self.file,self.shape,self.dtype,fps,0)
+
+    def _grow(self):
+        start = HEADER + self.capacity * self.frame_bytes
+        size = self.block * self.frame_bytes
+        self.file.truncate(start + size)
+        if hasattr(os,"posix_fallocate"):
+            try:
+                os.posix_fallocate(self.file.fileno(),start,size)
+            except OSError:
+                pass
+        mm = np.memmap(self.file,self.dtype,"r+",start,
+                       (self.block,)+self.shape)
+        # only the block being filled stays mapped
+        self.maps = [mm]
+        self.capacity += self.block
+
+    def isOpened(self):
+        return self.file is not None
+
+    def write(self,image,t=None):
+        # a frame of another dtype would be cast into the file
+        if (image.shape != self.shape or image.dtype != self.dtype
+            or self.file is None):
+            return False
+        if self.count == self.capacity:
+            self._grow()
+        self.maps[-1][self.count % self.block] = image
+        self.count += 1
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        for mm in self.maps:
+            mm.flush()
+        self.maps = []
+        self.file.truncate(HEADER + self.count * self.frame_bytes)
+        _writeHeader(self.file,self.shape,self.dtype,self.fps,self.count)
+        self.file.close()
+        self.file = None
+
+class RawReader:
+    """
+    Memory-mapped read access to a raw recording with O(1) random access.
+
+    Recordings that were not closed properly are read up to the last frame
+    that was completely written.
+
+    Args:
+        filename: (str) Raw recording filename.
+    """
+    def __init__(self,filename):
+        meta = readHeader(filename)
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.fps = meta["fps"]
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        count = meta["count"]
+        if TimeIndex.exists(filename):
+            self.times = TimeIndex(filename)
+            if count == 0:
+                count = len(self.times)
+        else:
+            self.times = None
+        size = (os.path.getsize(filename) - HEADER) // frame_bytes
+        self.count = min(count,size) if count else size
+        if self.count:
+            self.frames = np.memmap(filename,self.dtype,"r",HEADER,
+                                    (self.count,)+self.shape)
+        else:
+            self.frames = np.empty((0,)+self.shape,self.dtype)
+
+    def __len__(self):
+        return self.count
+
+    def read(self,nr):
+        return self.frames[nr]
+
+    def release(self):
+        self.frames = None
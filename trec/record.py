@@ -1,5 +1,7 @@
 import os
+import queue
 import struct
+import threading
 
 import cv2
 
@@ -10,11 +12,31 @@ from PyQt5.QtGui import *
 import time
 import numpy as np
 
+import mjpg
+from pool import releaseQueue
+from recording import (
+    ENCODERS,
+    startEncoder,
+    testEncoder,
+    keepsDepth,
+    recordingName,
+    openWriter,
+    frameFormat,
+    PreRoll,
+    RecordingMeta
+)
+from state import StateMachine,STOPPED,RUNNING,QUIT
+from stats import RateMeter
+from trigger import Trigger
+
 class RecordHandler:
-    def __init__(self,record_queue,display_queue):
+    def __init__(self,record_queue,display_queue,analyzer=None,
+                 record_stage=None):
         
         self.record_queue = record_queue
         self.display_queue = display_queue
+        self.analyzer = analyzer
+        self.record_stage = record_stage
         self.recorder = None
         
         self.mutex = QMutex()
@@ -25,7 +47,9 @@ class RecordHandler:
                                  self.record_queue,
                                  self.display_queue,
                                  self.mutex,
-                                 self.wait)        
+                                 self.wait,
+                                 self.analyzer,
+                                 self.record_stage)        
         
         self.thread = QThread()
         self.recorder.moveToThread(self.thread)       
@@ -46,30 +70,57 @@ class RecordHandler:
               
             
 class Recorder(QObject):
-    def __init__(self,device_name,record_queue,display_queue,mutex,wait):
+    def __init__(self,device_name,record_queue,display_queue,mutex,wait,
+                 analyzer=None,record_stage=None):
         super(self.__class__, self).__init__()
 
         self.device_name = device_name
         self.record_queue= record_queue
         self.display_queue = display_queue
-        self.mutex = mutex
-        self.wait = wait
+        # Writes the metrics of the recorded frames next to the recording
+        self.analyzer = analyzer
+        # Started and stopped without blocking the GUI
+        self.state = StateMachine(mutex,wait)
         
-        self.codec = "MJPG"
-        self.ext = '.avi'
+        # Encoder preset, see recording.PRESETS
+        self.encoders = ENCODERS
+        self.encoder = 0
+        self.encoder_process = None
+        # Self-benchmarks by encoder and format, at the format of the frames
+        # leaving the record stage (stage.FrameStage)
+        self.record_stage = record_stage
+        self.encoder_tests = {}
+        self.source_fps = None
+        self.warning = ""
         self.dir = "../recordings/"
         self.name = "Recorder"
         self.dev_name = device_name 
             
-        nr = 50        
-        
-        self.fps = np.zeros((2,nr))
+        self.fps = RateMeter(self.name)
         self.save_name = ""
+        # Frames before Start, filled while not recording
+        self.pre_roll = PreRoll(PreRoll.SECONDS[0],PreRoll.BUDGETS[0]*2**20)
+        # Records clips of events instead of everything if it has a detector
+        self.trigger = Trigger(analyzer)
+        self.start_time = None
 
     def getGuiSpecs(self):
         r = [["Start Recording",self.START,"A",0,6,1,1,"rec.svg"],
              ["Stop Recording",self.STOP,"A",0,7,1,1,"stop-2.svg"],
-             ["Save String",self.setString,"T",0,8,1,1,"Record Filename Add-on"]
+             ["Save String",self.setString,"T",0,8,1,1,"Record Filename Add-on"],
+             ["Encoder",self.setEncoder,"C",0,9,1,1,self.encoders],
+             ["Pre-roll",self.setPreRoll,"C",0,13,1,1,
+              ["Pre-roll: Off"] + ["Pre-roll: %d s" % s
+                                   for s in PreRoll.SECONDS[1:]]],
+             ["Pre-roll Memory",self.setPreRollBudget,"C",0,14,1,1,
+              ["Pre-roll memory: %d MB" % b for b in PreRoll.BUDGETS]],
+             ["Pre-roll Store",self.setPreRollStore,"C",0,15,1,1,
+              ["Pre-roll: Raw","Pre-roll: JPEG"]],
+             ["Trigger",self.trigger.setDetector,"C",0,16,1,1,Trigger.NAMES],
+             ["Trigger Threshold",self.setThreshold,"T",0,17,1,1,
+              "Trigger Threshold"],
+             ["Post-roll",self.setPostRoll,"C",0,18,1,1,
+              ["Post-roll: %d s" % s for s in Trigger.POST_ROLLS]]
              ]   
 
         return r           
@@ -77,90 +128,435 @@ class Recorder(QObject):
     def setString(self,text):
         self.save_name = "_"+text
 
+    def setEncoder(self,index):
+        self.encoder = index
+        # start encoder processes now, spawning takes longer than a frame
+        if self.state.state != RUNNING:
+            self.startEncoder()
+            self.testEncoder()
+
+    def testEncoder(self):
+        """
+        Measures in the background the fps the selected encoder sustains at
+        the format of the source, see recording.testEncoder().
+        """
+        stage = self.record_stage
+        if stage is None or stage.shape is None:
+            return
+        key = (self.encoder,stage.shape,np.dtype(stage.dtype).str)
+        if key not in self.encoder_tests:
+            threading.Thread(target=self._testEncoder,args=key,
+                             daemon=True).start()
+        else:
+            self.putStat(self.getTestString(self.encoder_tests[key]),0)
+
+    def _testEncoder(self,encoder,shape,dtype):
+        self.putStat("Testing %s at %dx%d ..." % (
+            ENCODERS[encoder],shape[1],shape[0]),0)
+        result = testEncoder(encoder,shape,dtype)
+        self.encoder_tests[(encoder,shape,dtype)] = result
+        if encoder == self.encoder and self.state.state != RUNNING:
+            self.putStat(self.getTestString(result),0)
+
+    def getTestString(self,result):
+        text = "%s: %.0f fps at %dx%d, %.2f MB/frame" % (
+            result["encoder"],result["fps"],result["shape"][1],
+            result["shape"][0],result["bytes"] / 2**20)
+        if not result["fps"]:
+            text = "%s: not available" % result["encoder"]
+        elif self.source_fps and result["fps"] < self.source_fps:
+            text += ", too slow for %d fps!" % self.source_fps
+        return text
+
+    def startEncoder(self):
+        self.encoder_process = startEncoder(self.encoder,self.encoder_process)
+
+    def quitEncoder(self):
+        if self.encoder_process is not None:
+            self.encoder_process.quit()
+            self.encoder_process = None
+
+    def setPreRoll(self,index):
+        self.pre_roll.seconds = PreRoll.SECONDS[index]
+        # starts or stops filling the ring
+        self.state.wake()
+
+    def setPreRollBudget(self,index):
+        self.pre_roll.budget = PreRoll.BUDGETS[index] * 2**20
+
+    def setPreRollStore(self,index):
+        self.pre_roll.compress = index == 1
+
+    def setThreshold(self,text):
+        # the detector default until a number is entered
+        try:
+            self.trigger.setThreshold(float(text))
+        except ValueError:
+            self.trigger.setThreshold(None)
+
+    def setPostRoll(self,index):
+        self.trigger.setPostRoll(Trigger.POST_ROLLS[index])
+
     def START(self,state):
-        if not self.run:
-            self.wait.wakeOne()
-            while not self.run:
-                time.sleep(0.01)
+        if self.state.target != RUNNING:
+            self.start_time = time.monotonic()
+            self.state.request(RUNNING)
         
     def STOP(self,state):
-        if self.run:
-            self.record_queue.put([0,None,0])
-            while self.run:
-                time.sleep(0.01)
+        if self.state.target == RUNNING:
+            # frames captured from now on are not part of the recording
+            self.record_queue.setActive(False)
+            if self.analyzer is not None:
+                self.analyzer.stopLog(time.monotonic())
+            # the end of the recording, after the frames queued before. If
+            # the queue is full the recorder ends when it is drained, see
+            # getItem(), the GUI does not wait for it
+            self.state.request(STOPPED)
+            try:
+                self.record_queue.put_nowait([0,None,0])
+            except queue.Full:
+                pass
         
     def QUIT(self):
-        self.quit = True
-        self.START(0)
-        self.STOP(0)  
-        
-    def setupWriter(self,source_name):
-        with self.record_queue.mutex:
-            self.record_queue.queue.clear()
-               
-        ta,image,fps = self.record_queue.get() 
-        if image is None:
-            return None
+        self.STOP(0)
+        self.state.request(QUIT)
+
+    def waitStart(self):
+        """
+        Waits for START or QUIT, filling the pre-roll ring meanwhile if it is
+        enabled, and returns the state entered.
+        """
+        while True:
+            if self.pre_roll.seconds and not self.state.pending():
+                self.fillPreRoll()
+            state = self.state.next()
+            if state != STOPPED:
+                return state
+
+    def getItem(self,timeout=None):
+        """
+        Returns the next [capture time, frame, fps] of the record queue, the
+        frame None at the end of the recording, once STOP was requested and
+        the frames queued before are taken. Raises queue.Empty if there is
+        no frame within timeout seconds, None waits for one.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = 0.1
+            if deadline is not None:
+                wait = min(max(deadline - time.monotonic(),0),wait)
+            try:
+                return self.record_queue.get(timeout=wait)
+            except queue.Empty:
+                # the frames offered after STOP are not queued
+                if self.state.target != RUNNING:
+                    return [0,None,0]
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def flushQueue(self):
+        """
+        Releases the frames queued before the recording. The end of a
+        recording stopped meanwhile is kept.
+        """
+        releaseQueue(self.record_queue,1)
+        if self.state.target != RUNNING:
+            self.record_queue.put([0,None,0])
+
+    def fillPreRoll(self):
+        self.record_queue.setActive(True)
+        shown = 0.0
+        while self.pre_roll.seconds and not self.state.pending():
+            try:
+                ta,frame,fps = self.record_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if frame is None:
+                continue
+            self.pre_roll.add(ta,frame.image,fps,codec=frame.codec,
+                              seq=frame.seq)
+            frame.release()
+            self.source_fps = fps
+            if ta - shown > 0.5:
+                shown = ta
+                self.putStat(self.pre_roll.getStatString(),0)
+
+        if not self.pre_roll.seconds or self.state.target == QUIT:
+            self.record_queue.setActive(False)
+            releaseQueue(self.record_queue,1)
+            self.pre_roll.clear()
+            self.putStat(self.pre_roll.getStatString(),0)
+
+    def putStat(self,text,nr):
+        if not self.display_queue.full():
+            self.display_queue.put([text,self.record_queue.qsize(),nr])
         
-        shape = image.shape
-        fourcc = cv2.VideoWriter_fourcc(*self.codec)
-        t = time.strftime("_D%Y-%m-%d_T%H%M%S%z")
-        s = "_R"+str(shape[1])+"x"+str(shape[0])
-        f = "_F"+str(fps)
-        filename = self.dir+source_name+t+s+f+self.save_name+self.ext
-        writer = cv2.VideoWriter(filename,fourcc,fps,(shape[1],shape[0]))
+    def setupWriter(self,source_name,suffix=""):
+        """
+        Opens the writer for the frames of the pre-roll ring followed by the
+        frames of the record queue.
+        """
+        self.first = None
+        self.stopped = False
+        if not self.pre_roll:
+            self.flushQueue()
+            self.record_queue.setActive(True)
+        # frame accounting of this recording starts now
+        self.queue_stats = self.record_queue.getStats()
+        if self.pre_roll:
+            ta,fps = self.pre_roll.items[0][0],self.pre_roll.items[0][2]
+            fmt = self.pre_roll.getFormat()
+        else:
+            ta,frame,fps = self.getItem()
+            if frame is None:
+                return None
+            self.first = [ta,frame.image,frame,frame.seq,fps,frame.codec]
+            fmt = frameFormat(frame.image,frame.codec)
+        self.source_name = source_name
+        self.suffix = suffix
+        self.part = 1
+        writer = self.openFile(ta,fps,fmt)
+        if self.pre_roll.seconds:
+            self.meta.setPreRoll(len(self.pre_roll),self.start_time)
+        if writer is None and self.first is not None:
+            self.first[2].release()
+        return writer
+
+    def openFile(self,ta,fps,fmt):
+        """
+        Opens the writer of the next file of the recording, for frames of a
+        format (see recording.frameFormat()) captured from ta on. Files after
+        the first of a recording are numbered, _P02 and up.
+        """
+        codec,shape,dtype = fmt
+        self.format = fmt
+        self.source_fps = fps
+        suffix = self.suffix
+        if self.part > 1:
+            suffix += "_P%02d" % self.part
+        # compressed frames are muxed as they are, whatever the encoder
+        encoder = self.encoder if codec is None else 0
+        os.makedirs(self.dir,exist_ok=True)
+        filename = recordingName(self.dir,self.source_name,shape,fps,
+                                 self.save_name+suffix,encoder)
+        # Written next to the recording when it stops
+        self.meta = RecordingMeta(self.dev_name,filename,self.encoder,fps,
+                                  shape,dtype,codec)
+        # warns when the self-benchmark showed the encoder cannot keep up
+        self.warning = ""
+        test = self.encoder_tests.get((encoder,tuple(shape),
+                                       np.dtype(dtype).str))
+        if codec is None and test is not None:
+            self.meta.meta["encoder_test"] = test
+            if test["fps"] < fps:
+                self.warning = ", encoder sustains %.0f fps!" % test["fps"]
+        if codec is None and not keepsDepth(self.encoder,shape,dtype):
+            self.warning += ", stored as 8 bits!"
+        if self.record_stage is not None:
+            self.meta.meta["stage"] = self.record_stage.getMeta()
+        if self.analyzer is not None:
+            self.meta.setMetrics(self.analyzer.startLog(filename,ta))
         
-        if writer.isOpened():
+        self.startEncoder()
+        return openWriter(self.encoder,self.encoder_process,filename,
+                          None,fps,shape,dtype,codec)
+
+    def switchFile(self,writer,ta,image,fps,codec):
+        """
+        Returns the writer of the frame, a new file if its format differs
+        from that of the file of writer (the format of the source was
+        switched), which is closed then. None if the new file cannot be
+        opened.
+        """
+        fmt = frameFormat(image,codec)
+        # a compressed frame without header is written as it is
+        if fmt == self.format or fmt[1] is None:
             return writer
-        else:
-            return None
+        writer.release()
+        self.meta.setQueue(self.record_queue.getStats(self.queue_stats))
+        trigger = self.meta.meta.get("trigger")
+        if trigger is not None:
+            trigger["end"] = self.meta.meta["last"]
+        self.meta.save()
+        if self.analyzer is not None:
+            # the metrics of each file cover its frames
+            self.analyzer.stopLog(self.meta.meta["last"])
+        self.queue_stats = self.record_queue.getStats()
+        self.part += 1
+        writer = self.openFile(ta,fps,fmt)
+        if writer is None:
+            if self.analyzer is not None:
+                self.analyzer.stopLog(None)
+        elif trigger is not None:
+            # the clip goes on in the new file
+            self.meta.setTrigger(trigger,trigger["start"])
+        return writer
+
+    def nextItem(self):
+        """
+        Returns the next [capture time, image, frame, sequence number, fps,
+        codec] to write, frame is None for frames of the pre-roll ring, or
+        None when the recording stopped.
+
+        While the ring is not empty, frames arriving meanwhile are added to
+        it within its budget, so the recording stays in order while it
+        catches up. Frames that do not fit are left to the queue policy.
+        """
+        if self.first is not None:
+            item,self.first = self.first,None
+            return item
+
+        if not self.pre_roll:
+            if self.stopped:
+                return None
+            ta,frame,fps = self.getItem()
+            if frame is None:
+                return None
+            return [ta,frame.image,frame,frame.seq,fps,frame.codec]
+
+        while not self.stopped and not self.pre_roll.full():
+            try:
+                ta,frame,fps = self.record_queue.get_nowait()
+            except queue.Empty:
+                break
+            if frame is None:
+                self.stopped = True
+                break
+            self.pre_roll.add(ta,frame.image,fps,evict=False,
+                              codec=frame.codec,seq=frame.seq)
+            frame.release()
+        ta,image,fps,seq,codec = self.pre_roll.pop()
+        return [ta,image,None,seq,fps,codec]
         
     def loop(self):   
         self.clear()
-        self.quit = False
-        self.run = False
-        while not self.quit:
-            self.mutex.lock()
-            self.wait.wait(self.mutex)
-            self.mutex.unlock()  
-            self.run = True  
-            writer = self.setupWriter(self.dev_name)
-            if writer:       
-                nr = 1
-                while True:
-                    tb = time.time()
-                    tia, image,fps = self.record_queue.get()  
-                    if image is None:
-                        break
- 
-                    ta = time.time()           
-                    s = self.record_queue.qsize()
-
-                    writer.write(image)
-                    fps_str = self.updateFPS(self.name,self.fps,tb,ta)
-                        
-                    if not self.display_queue.full():
-                        self.display_queue.put([fps_str,s,nr])  
-                        
-                    nr+=1
-                    
-                writer.release()
+        while self.waitStart() == RUNNING:
+            if self.trigger.detector is not None:
+                self.recordClips()
+            else:
+                self.recordContinuous()
+            
+            self.record_queue.setActive(False)
+            releaseQueue(self.record_queue,1)
+            self.pre_roll.clear()
+        self.quitEncoder()
+
+    def recordContinuous(self):
+        writer = self.setupWriter(self.dev_name)
+        if not writer:
+            # nothing to record, back to stopped
+            self.state.request(STOPPED)
+            return
+        nr = 1
+        tb = time.monotonic()
+        item = self.nextItem()
+        while item is not None:
+            ta = time.monotonic()
+            tia,image,frame,seq,fps,codec = item
+            writer = self.switchFile(writer,tia,image,fps,codec)
+            if writer is None:
+                if frame is not None:
+                    frame.release()
+                self.state.request(STOPPED)
+                return
+            written = writer.write(image,tia,seq)
+            if frame is not None:
+                frame.stamp("write")
+                frame.release()
+            self.meta.update(tia,written)
+            fps_str = self.fps.update(tb,ta) + self.warning
+            if self.pre_roll:
+                fps_str += ", %d behind" % len(self.pre_roll)
+            self.putStat(fps_str,nr)
+            nr+=1
+            tb = time.monotonic()
+            item = self.nextItem()
             
-            self.run = False
-    
-    def updateFPS(self,name,avg_list, time_before, time_after):
-        mean_total = np.mean(np.diff(avg_list[0,:]))
-        mean_max = np.mean(avg_list[0,1:]-avg_list[1,:-1])
-        cur_fps = 1.0 / mean_total
-        max_fps = 1.0 / mean_max
-        percent = cur_fps / max_fps * 100
-        avg_list[:,:-1] = avg_list[:,1:]
-        avg_list[1,-1] = time_after
-        avg_list[0,-1] = time_before
-
-        return "%s: %05.1f fps (%05.1f %%)" % (name,cur_fps,percent)
-    
+        writer.release()
+        self.record_queue.setActive(False)
+        self.meta.setQueue(self.record_queue.getStats(self.queue_stats))
+        self.meta.save()
+
+    def recordClips(self):
+        """
+        Writes a clip per trigger event until STOP, see trigger.Trigger.
+
+        Every frame passes the pre-roll ring. Between clips it holds the
+        frames before an event, during a clip the frames not written yet,
+        so the detector sees every frame in time while the writer lags.
+        """
+        if not self.pre_roll:
+            self.flushQueue()
+        self.record_queue.setActive(True)
+        self.trigger.reset()
+        clips = 0
+        writer = None
+        # capture time the open clip ends, None while it is active
+        end = None
+        stopped = False
+        shown = 0.0
+        tb = time.monotonic()
+        while not stopped or writer is not None:
+            # take every frame that arrived, waiting only without a backlog
+            wait = writer is None or not self.pre_roll
+            while not stopped:
+                try:
+                    item = self.getItem(0.1 if wait else 0)
+                except queue.Empty:
+                    break
+                wait = False
+                ta,frame,fps = item
+                if frame is None:
+                    stopped = True
+                    break
+                active = self.trigger.update(ta,frame.image,frame.codec)
+                if not self.pre_roll.add(ta,frame.image,fps,
+                                         evict=writer is None,
+                                         codec=frame.codec,seq=frame.seq):
+                    self.meta.meta["trigger"]["dropped"] += 1
+                frame.release()
+                if writer is None and active:
+                    clips += 1
+                    self.start_time = ta
+                    writer = self.setupWriter(self.dev_name,"_C%03d" % clips)
+                    self.meta.setTrigger(self.trigger.getMeta(),ta)
+                    end = None
+                elif writer is not None and not active and end is None:
+                    end = self.trigger.last + self.trigger.post_roll
+                elif writer is None and ta - shown > 0.5:
+                    shown = ta
+                    self.putStat("%s, %d clips" % (
+                        self.trigger.getStatString(),clips),0)
+
+            if writer is None:
+                continue
+            if self.pre_roll and (end is None
+                                  or self.pre_roll.items[0][0] <= end):
+                tia,image,fps,seq,codec = self.pre_roll.pop()
+                ta = time.monotonic()
+                writer = self.switchFile(writer,tia,image,fps,codec)
+                if writer is None:
+                    # the clip ends, its next format cannot be written
+                    end = None
+                    continue
+                self.meta.update(tia,writer.write(image,tia,seq))
+                fps_str = self.fps.update(tb,ta) + self.warning
+                tb = time.monotonic()
+                self.putStat("%s, clip %d, %d behind" % (
+                    fps_str,clips,len(self.pre_roll)),self.meta.meta["frames"])
+            elif end is not None or stopped:
+                # the rest of the ring is the pre-roll of the next clip
+                writer.release()
+                if end is None:
+                    end = self.meta.meta["last"]
+                if self.analyzer is not None:
+                    self.analyzer.stopLog(end)
+                self.meta.meta["trigger"]["end"] = end
+                self.meta.setQueue(
+                    self.record_queue.getStats(self.queue_stats))
+                self.meta.save()
+                writer = None
+                end = None
+
     def clear(self):
-        l = len(self.fps[0,:])
-        self.fps[0,:] = range(l)
-        self.fps[1,:].fill(0)
\ No newline at end of file
+        self.fps.clear()
\ No newline at end of file
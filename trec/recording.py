@@ -0,0 +1,396 @@
+import collections
+import json
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from encoder import (
+    OpenCVWriter,
+    EncoderProcess,
+    ProcessWriter,
+    EncoderPool,
+    SegmentWriter,
+    PipeWriter,
+    ImageWriter,
+    PassthroughWriter
+)
+import mjpg
+from raw import RawReader,RawWriter
+from sidecar import TimedWriter,sidecarName
+from synthetic import makeFrames
+
+# Encoder presets: GUI name, command line name, backend, options, extension.
+# Backends: "thread" encodes with OpenCV in the recording thread, "process"
+# in an encoder process, "segments" to JPEG on a pool of processes, "raw"
+# writes memory-mapped frames, "pipe" pipes raw frames into ffmpeg and
+# "images" writes an image per frame into a directory. Options are the
+# OpenCV fourcc, the ffmpeg output options or the cv2.imwrite parameters.
+PRESETS = [["Encode: Thread","thread","thread","MJPG",".avi"],
+           ["Encode: Process","process","process","MJPG",".avi"],
+           ["Encode: Segments","segments","segments",None,".avi"],
+           ["Raw: Memory-mapped","raw","raw",None,".raw"],
+           ["OpenCV: MPEG-4 (compact)","mpeg4","thread","mp4v",".mp4"],
+           ["OpenCV: HuffYUV (lossless)","huffyuv","thread","HFYU",".avi"],
+           ["OpenCV: FFV1 (lossless)","ffv1","thread","FFV1",".mkv"],
+           ["FFmpeg: H.264 fast","x264-fast","pipe",
+            ["-c:v","libx264","-preset","ultrafast","-crf","20",
+             "-pix_fmt","yuv420p"],".mp4"],
+           ["FFmpeg: H.264 compact","x264","pipe",
+            ["-c:v","libx264","-preset","medium","-crf","23",
+             "-pix_fmt","yuv420p"],".mp4"],
+           ["FFmpeg: FFV1 (lossless)","ffv1-pipe","pipe",
+            ["-c:v","ffv1","-level","3","-slices","16","-threads","0"],".mkv"],
+           ["Images: PNG (lossless)","png","images",
+            [cv2.IMWRITE_PNG_COMPRESSION,1],".png"]]
+ENCODERS = [p[0] for p in PRESETS]
+# Command line names of the encoders
+ENCODER_NAMES = [p[1] for p in PRESETS]
+RAW = 3
+# Encoders storing 16-bit frames without loss, OpenCV's FFV1 single channel
+# frames only
+DEPTH_16 = ["raw","ffv1","ffv1-pipe","png"]
+# Encoder processes started ahead of recording, by backend
+BACKEND_CLS = {"process":EncoderProcess,"segments":EncoderPool}
+# Segment encoders, leave a core for capture and one for display
+SEGMENT_WORKERS = max(1,os.cpu_count()-2)
+
+def startEncoder(encoder,process=None):
+    """
+    Returns the encoder process(es) an encoder needs, reusing process if it
+    is of the right kind and alive, otherwise quitting it.
+
+    Args:
+        encoder: (int) Index into ENCODERS.
+        process: (EncoderProcess/EncoderPool) Currently running encoder.
+    """
+    cls = BACKEND_CLS.get(PRESETS[encoder][2])
+    if process is not None and type(process) is cls and process.isAlive():
+        return process
+
+    if process is not None:
+        process.quit()
+    if cls is EncoderPool:
+        return EncoderPool(SEGMENT_WORKERS)
+    elif cls is not None:
+        return cls()
+    return None
+
+def recordingName(directory,source_name,shape,fps,save_name="",encoder=0,
+                  ext=None):
+    """
+    Returns the filename of a recording, with the extension of the encoder
+    unless ext is given. Image sequences are a directory without extension.
+    """
+    t = time.strftime("_D%Y-%m-%d_T%H%M%S%z")
+    s = "_R"+str(shape[1])+"x"+str(shape[0])
+    f = "_F"+str(fps)
+    if ext is None:
+        ext = "" if PRESETS[encoder][2] == "images" else PRESETS[encoder][4]
+    return os.path.join(directory,source_name+t+s+f+save_name+ext)
+
+def openWriter(encoder,process,filename,codec,fps,shape,dtype,
+               passthrough=None):
+    """
+    Opens the writer of an encoder, or returns None if it cannot be opened.
+    Every writer also writes the timestamp sidecar (sidecar.TimedWriter), its
+    write() takes the capture time and sequence number of the frame.
+
+    Args:
+        encoder: (int) Index into ENCODERS.
+        process: Encoder process(es) from startEncoder().
+        codec: (str) Fourcc of OpenCV encoders, None for that of the preset.
+        passthrough: (str) Codec of compressed frames, written as they are
+            whatever the encoder.
+    """
+    name,cli,backend,options,ext = PRESETS[encoder]
+    if codec is None:
+        codec = options
+    if passthrough is not None:
+        writer = PassthroughWriter(filename,fps,shape,passthrough)
+    elif backend == "process":
+        writer = ProcessWriter(process,filename,codec,fps,shape,dtype)
+    elif backend == "segments":
+        writer = SegmentWriter(process,filename,fps,shape,dtype)
+    elif backend == "raw":
+        writer = RawWriter(filename,fps,shape,dtype)
+    elif backend == "pipe":
+        writer = PipeWriter(filename,fps,shape,dtype,options)
+    elif backend == "images":
+        writer = ImageWriter(filename,ext,options)
+    else:
+        writer = OpenCVWriter(filename,codec,fps,shape,dtype)
+
+    if writer.isOpened():
+        return TimedWriter(writer,filename)
+    writer.release()
+    return None
+
+def keepsDepth(encoder,shape,dtype):
+    """
+    Returns whether an encoder stores frames of shape and dtype at their
+    depth. The others store deeper frames as 8 bits, their most significant
+    byte (encoder.toDepth8()).
+    """
+    if np.dtype(dtype).itemsize == 1:
+        return True
+    cli = PRESETS[encoder][1]
+    if cli == "ffv1":
+        return len(shape) == 2 and np.dtype(dtype) == np.uint16
+    return cli in DEPTH_16
+
+def countFrames(filename):
+    """
+    Returns the number of frames a recording really holds, decoding video
+    files to the end: a writer may drop frames it cannot store.
+    """
+    if os.path.isdir(filename):
+        return len([name for name in os.listdir(filename)
+                    if not name.startswith(".")])
+    if filename.endswith(".raw"):
+        return len(RawReader(filename))
+    reader = cv2.VideoCapture(filename)
+    nr = 0
+    while reader.grab():
+        nr += 1
+    reader.release()
+    return nr
+
+def frameFormat(image,codec=None):
+    """
+    Returns the format of a frame as a recording stores it, (codec, shape,
+    dtype). A file holds frames of a single format. The shape of a frame
+    passed through compressed (codec) is read from its header, it is None if
+    there is none.
+    """
+    shape = mjpg.imageShape(image) if codec else image.shape
+    return (codec,shape,image.dtype)
+
+def testEncoder(encoder,shape,dtype,seconds=1.0):
+    """
+    Self-benchmark of an encoder preset: encodes synthetic frames of a
+    format into a temporary file for about seconds, with encoder processes
+    of its own.
+
+    Returns:
+        (dict) Sustained fps of the frames really stored, 0 if the encoder
+            cannot be opened or stores none, and bytes per frame.
+    """
+    frames = makeFrames(tuple(shape),4,dtype=dtype)
+    process = startEncoder(encoder)
+    result = {"encoder":ENCODERS[encoder],"shape":list(shape),
+              "dtype":np.dtype(dtype).str,"fps":0.0,"bytes":0}
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = recordingName(tmp,"test",shape,30,encoder=encoder)
+        writer = openWriter(encoder,process,filename,None,30,shape,dtype)
+        if writer is not None:
+            nr = 0
+            t = time.monotonic()
+            # a few frames at least, lossless 4K frames take long
+            while nr < 3 or time.monotonic() - t < seconds:
+                writer.write(frames[nr % len(frames)])
+                nr += 1
+            writer.release()
+            t = time.monotonic() - t
+            size = sum(os.path.getsize(os.path.join(root,name))
+                       for root,dirs,names in os.walk(tmp) for name in names)
+            written = countFrames(filename)
+            result["fps"] = written / t
+            result["bytes"] = size // max(written,1)
+    if process is not None:
+        process.quit()
+    return result
+
+class PreRoll:
+    """
+    Ring of the frames captured before a recording starts, so the recording
+    includes what made the operator press Start.
+
+    Frames are stored as copies, or JPEG compressed to keep the memory per
+    second predictable at high resolutions. Frames JPEG cannot hold (not
+    uint8, or 4 channels) are always copied, frames passed through
+    compressed are kept as they are. Before a recording frames older
+    than seconds and frames over the memory budget are evicted, oldest first.
+    While a recording catches up with the ring, frames are only added within
+    the budget and nothing is evicted, frames of a switched format included.
+    Otherwise a format switch empties the ring.
+
+    Args:
+        seconds: (float) Length of the ring, 0 disables it.
+        budget: (int) Memory budget in bytes.
+        compress: (bool) Store frames as JPEG.
+    """
+    SECONDS = [0,1,2,5,10]
+    BUDGETS = [256,512,1024,2048]
+    QUALITY = 95
+
+    def __init__(self,seconds=0,budget=512*2**20,compress=False):
+        self.seconds = seconds
+        self.budget = budget
+        self.compress = compress
+        self.clear()
+
+    def clear(self):
+        # [capture time, image or JPEG buffer, fps, compressed, sequence nr,
+        # format (see frameFormat)]
+        self.items = collections.deque()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return self.nbytes >= self.budget
+
+    def add(self,t,image,fps,evict=True,codec=None,seq=None):
+        """
+        Stores a frame, returns False if it did not fit in the budget.
+
+        Args:
+            t: (float) Capture time.
+            image: (np.ndarray) Frame, copied or compressed.
+            fps: (int) Frame rate of the recording.
+            evict: (bool) Make room by evicting the oldest frames.
+            codec: (str) Codec of a frame passed through compressed, it is
+                stored as it is.
+            seq: (int) Sequence number of the frame at the source.
+        """
+        if not evict and self.full():
+            return False
+        fmt = frameFormat(image,codec)
+        if evict and self.items and fmt != self.items[-1][5]:
+            # frames of the previous format would start another file
+            self.clear()
+        compressed = (codec is None and self.compress
+                      and image.dtype == np.uint8
+                      and (image.ndim == 2 or image.shape[2] == 3))
+        if compressed:
+            data = cv2.imencode(".jpg",image,
+                                [cv2.IMWRITE_JPEG_QUALITY,self.QUALITY])[1]
+        else:
+            data = image.copy()
+        self.items.append([t,data,fps,compressed,seq,fmt])
+        self.nbytes += data.nbytes
+        if evict:
+            while self.items and (self.full()
+                                  or t - self.items[0][0] > self.seconds):
+                self.nbytes -= self.items.popleft()[1].nbytes
+        return True
+
+    def getFormat(self):
+        """
+        Returns the format of the oldest frame, see frameFormat().
+        """
+        return self.items[0][5]
+
+    def pop(self):
+        """
+        Returns the oldest frame as [capture time, image, fps, sequence
+        number, codec], the image still compressed if it was passed through.
+        """
+        t,data,fps,compressed,seq,fmt = self.items.popleft()
+        self.nbytes -= data.nbytes
+        if compressed:
+            data = cv2.imdecode(data,cv2.IMREAD_UNCHANGED)
+        return [t,data,fps,seq,fmt[0]]
+
+    def getStats(self):
+        span = self.items[-1][0] - self.items[0][0] if self.items else 0.0
+        return {"frames":len(self.items),
+                "seconds":span,
+                "bytes":self.nbytes,
+                "budget":self.budget,
+                "compressed":self.compress}
+
+    def getStatString(self):
+        s = self.getStats()
+        return "Pre-roll: %.1f s, %d frames, %d/%d MB" % (
+            s["seconds"],s["frames"],s["bytes"] // 2**20,s["budget"] // 2**20)
+
+class RecordingMeta:
+    """
+    Metadata written next to a recording as <recording>.json when it stops.
+
+    first and last are capture timestamps on the monotonic clock shared by
+    all devices, so recordings of different cameras can be aligned.
+    passthrough is the codec of frames recorded as the camera compressed
+    them, instead of the encoder.
+    """
+    def __init__(self,device,filename,encoder,fps,shape,dtype,
+                 passthrough=None):
+        self.filename = filename + ".json"
+        # dtype of the frames in the file, deeper ones may be cut to 8 bits
+        stored = dtype
+        if passthrough is not None:
+            encoder = "Passthrough: " + passthrough
+        else:
+            if not keepsDepth(encoder,shape,dtype):
+                stored = np.uint8
+            encoder = ENCODERS[encoder]
+        self.meta = {"device":device,
+                     "file":os.path.basename(filename),
+                     "encoder":encoder,
+                     "fps":fps,
+                     "shape":list(shape),
+                     "dtype":np.dtype(dtype).str,
+                     "stored_dtype":np.dtype(stored).str,
+                     "clock":"monotonic",
+                     "times":os.path.basename(sidecarName(filename)),
+                     "wall_minus_monotonic":time.time()-time.monotonic(),
+                     "first":None,
+                     "last":None,
+                     "frames":0,
+                     "unwritten":0}
+
+    def update(self,t,written=True):
+        """
+        Counts a frame captured at t, written is False if the writer did not
+        store it (e.g. the encoder quit), those are counted apart.
+        """
+        if not written:
+            self.meta["unwritten"] += 1
+            return
+        if self.meta["first"] is None:
+            self.meta["first"] = t
+        self.meta["last"] = t
+        self.meta["frames"] += 1
+
+    def setQueue(self,stats):
+        """
+        Adds the frame accounting of the record queue (FrameQueue.getStats()):
+        frames the device produced, the recorder got, the policy dropped (with
+        the capture times of the drops) and those still queued at the stop.
+        """
+        stats = dict(stats)
+        stats["queued_at_stop"] = (stats["produced"] - stats["delivered"]
+                                   - stats["dropped"])
+        self.meta["record_queue"] = stats
+
+    def setPreRoll(self,frames,start):
+        """
+        Adds the number of frames taken from the pre-roll ring and the time
+        Start was pressed, frames captured before it come from the ring.
+        """
+        self.meta["pre_roll"] = {"frames":frames,"start":start}
+
+    def setTrigger(self,trigger,start):
+        """
+        Adds the trigger settings (trigger.Trigger.getMeta()) of a clip and
+        the capture time of the frame that triggered it. end is the capture
+        time the clip ended, dropped the frames that did not fit the ring
+        while the writer caught up.
+        """
+        self.meta["trigger"] = dict(trigger,start=start,end=None,dropped=0)
+
+    def setMetrics(self,filename):
+        """
+        Names the per-frame analysis results (analysis.Analyzer.startLog()),
+        rows keyed by the capture time of the frames.
+        """
+        self.meta["metrics"] = os.path.basename(filename)
+
+    def save(self):
+        with open(self.filename,"w") as f:
+            json.dump(self.meta,f,indent=1)
@@ -0,0 +1,117 @@
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"TRECTIME"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+# One record per frame: sequence number and capture timestamp in seconds
+RECORD = np.dtype([("seq","<u8"),("t","<f8")])
+
+def sidecarName(filename):
+    return filename + ".times"
+
+class TimeWriter:
+    """
+    Appends per-frame sequence numbers and capture timestamps to a compact
+    binary sidecar next to a recording, 16 bytes per frame. The sequence
+    number is that of the frame at the source, so gaps show dropped frames.
+
+    Args:
+        filename: (str) Filename of the recording the sidecar belongs to.
+    """
+    def __init__(self,filename):
+        self.file = open(sidecarName(filename),"wb")
+        self.file.write(HEADER.pack(MAGIC,VERSION,RECORD.itemsize))
+        self.count = 0
+
+    def write(self,seq,t):
+        """
+        Args:
+            seq: (int) Sequence number, the frame number in the file if None.
+            t: (float) Capture time.
+        """
+        if seq is None:
+            seq = self.count
+        self.file.write(struct.pack("<Qd",seq,t))
+        self.count += 1
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class TimedWriter:
+    """
+    Writer of any encoder (with the isOpened/write/release interface of
+    cv2.VideoWriter) that also writes the timestamp sidecar.
+
+    Args:
+        writer: Writer of the frames.
+        filename: (str) Filename of the recording.
+    """
+    def __init__(self,writer,filename):
+        self.writer = writer
+        self.times = TimeWriter(filename)
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self,image,t=None,seq=None):
+        """
+        Writes a frame, and its timestamp if the writer stored it, so the
+        sidecar lines up with the frames in the file. Returns whether the
+        frame was stored.
+        """
+        if not self.writer.write(image,t):
+            return False
+        self.times.write(seq,t if t is not None else 0.0)
+        return True
+
+    def release(self):
+        self.writer.release()
+        self.times.release()
+
+class TimeIndex:
+    """
+    Read access to a timestamp sidecar written by TimeWriter.
+
+    Args:
+        filename: (str) Filename of the recording the sidecar belongs to.
+    """
+    def __init__(self,filename):
+        name = sidecarName(filename)
+        with open(name,"rb") as f:
+            magic,version,size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != RECORD.itemsize:
+            raise ValueError("Not a timestamp sidecar: %s" % name)
+
+        # a partly written last record is ignored
+        count = (os.path.getsize(name) - HEADER.size) // RECORD.itemsize
+        records = np.fromfile(name,RECORD,count,offset=HEADER.size)
+        self.seq = records["seq"]
+        self.t = records["t"]
+
+    @classmethod
+    def exists(cls,filename):
+        return os.path.exists(sidecarName(filename))
+
+    def __len__(self):
+        return len(self.t)
+
+    def find(self,t):
+        """
+        Returns the number of the last frame captured at or before t, the
+        first frame if t is before it. A binary search.
+        """
+        return max(int(np.searchsorted(self.t,t,side="right")) - 1,0)
+
+    def interval(self,nr):
+        """
+        Returns the recorded time from frame nr to the next, None for the
+        last frame.
+        """
+        if nr < 0 or nr + 1 >= len(self.t):
+            return None
+        return float(self.t[nr+1] - self.t[nr])
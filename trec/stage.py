@@ -0,0 +1,170 @@
+"""
+Capture-side crop, binning and decimation of the frames of one path.
+
+Often only a small region of the frame matters, e.g. around the melt pool.
+A stage sits right after the read in the capture thread and reduces the
+frames of the display or record path before they are queued, so the queue,
+the consumer and, for the record path, the encoder only handle what is
+kept: a crop to 1/4 of the area or 2x2 binning moves and encodes 1/4 of the
+bytes, keeping every 3rd frame 1/3.
+
+Frames the stage changes are copied into the buffers of its own pool and
+the source frame goes back to the device pool right away. Compressed frames
+(see mjpg.py) cannot be cropped without decoding them, they are only
+decimated.
+"""
+import cv2
+import numpy as np
+
+from pool import FramePool
+
+def parseROI(text):
+    """
+    Returns the region of text, "x,y,width,height" in frame pixels, or None
+    if text is no such region (e.g. empty).
+    """
+    try:
+        x,y,width,height = (int(v) for v in text.split(","))
+    except ValueError:
+        return None
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        return None
+    return (x,y,width,height)
+
+class FrameStage:
+    """
+    Crop, binning and decimation of one path. The settings may be changed
+    from the GUI thread while frames pass.
+
+    Args:
+        frame_pool: (FramePool) Pool of the source frames, the latency
+            histograms of which the output frames stamp.
+        name: (str) Name of the path in the GUI specs.
+        size: (int) Output buffers, the frames in flight on the path.
+    """
+    BINNINGS = [1,2,4]
+    DECIMATIONS = [1,2,3,5,10]
+
+    def __init__(self,frame_pool,name="",size=4):
+        self.name = name
+        self.pool = FramePool(size)
+        # output frames stamp the latency histograms of the source
+        self.pool.latency = frame_pool.latency
+        self.roi = None
+        self.binning = 1
+        self.decimation = 1
+        # Format of the last frame passed, for encoder self-benchmarks
+        self.shape = None
+        self.dtype = None
+
+    def getGuiSpecs(self,col):
+        n = self.name
+        return [["%s ROI" % n,self.setROI,"T",0,col,1,1,
+                 "%s ROI x,y,w,h" % n],
+                ["%s Binning" % n,self.setBinning,"C",0,col+1,1,1,
+                 ["%s binning: %dx%d" % (n,b,b) for b in self.BINNINGS]],
+                ["%s Decimation" % n,self.setDecimation,"C",0,col+2,1,1,
+                 ["%s: every frame" % n] + ["%s: 1 in %d frames" % (n,d)
+                                            for d in self.DECIMATIONS[1:]]]]
+
+    def setROI(self,text):
+        """
+        Crops to text, "x,y,width,height" in frame pixels, or passes the whole
+        frame if text is no such region (e.g. empty), see parseROI(). Regions
+        beyond the frame are clipped to it.
+        """
+        self.roi = parseROI(text)
+
+    def setBinning(self,index):
+        self.binning = self.BINNINGS[index]
+
+    def setDecimation(self,index):
+        self.decimation = self.DECIMATIONS[index]
+
+    def getRate(self,fps):
+        """
+        Returns the frame rate of the path at a source rate of fps.
+        """
+        if fps % self.decimation:
+            return fps / self.decimation
+        return fps // self.decimation
+
+    def getMeta(self):
+        return {"roi":self.roi,"binning":self.binning,
+                "decimation":self.decimation}
+
+    def offer(self,data_queue,item,t):
+        """
+        Offers item to data_queue with its frame passed through the stage.
+        Frames the consumer discards anyway are not processed, only their
+        format is kept.
+
+        Args:
+            data_queue: (FrameQueue) Queue of the path.
+            item: (list) Item holding a Frame at position data_queue.index.
+            t: (float) Capture time.
+        """
+        if data_queue.active:
+            frame = self.apply(item[data_queue.index])
+            if frame is None:
+                return
+            item[data_queue.index] = frame
+        else:
+            self.crop(item[data_queue.index],self.roi,self.binning)
+        data_queue.offer(item,t)
+
+    def crop(self,frame,roi,binning):
+        """
+        Returns the view of frame to be binned, None if the frame is passed
+        as it is, and sets the format of the output.
+        """
+        image = frame.image
+        if frame.codec is None and (roi is not None or binning > 1):
+            view = image
+            if roi is not None:
+                x,y,width,height = roi
+                view = view[y:y+height,x:x+width]
+            # whole bins only
+            height = view.shape[0] // binning * binning
+            width = view.shape[1] // binning * binning
+            # a region outside the frame passes it as it is
+            if height and width:
+                self.shape = ((height // binning,width // binning)
+                              + view.shape[2:])
+                self.dtype = view.dtype
+                return view[:height,:width]
+        self.shape,self.dtype = image.shape,image.dtype
+        return None
+
+    def apply(self,frame):
+        """
+        Returns the frame of the path: frame itself if the stage leaves it as
+        it is, a reduced copy, or None if it is decimated. Takes over the
+        reference of the caller to frame.
+        """
+        # may be changed from the GUI thread meanwhile
+        roi,binning,decimation = self.roi,self.binning,self.decimation
+        if decimation > 1 and frame.seq is not None and frame.seq % decimation:
+            frame.release()
+            return None
+        image = self.crop(frame,roi,binning)
+        if image is None:
+            return frame
+
+        out = self.pool.acquire()
+        if binning > 1:
+            # area interpolation at an integer factor averages the bins
+            size = (image.shape[1] // binning,image.shape[0] // binning)
+            result = cv2.resize(image,size,out.image,
+                                interpolation=cv2.INTER_AREA)
+        elif (out.image is not None and out.image.shape == image.shape
+              and out.image.dtype == image.dtype):
+            np.copyto(out.image,image)
+            result = out.image
+        else:
+            result = image.copy()
+        out = self.pool.adopt(out,result)
+        out.stamps = dict(frame.stamps)
+        out.seq = frame.seq
+        frame.release()
+        return out
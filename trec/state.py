@@ -0,0 +1,131 @@
+"""
+State machine of the device and recorder threads.
+
+A thread is STOPPED, RUNNING or QUIT, which is final. Other threads, the GUI
+in particular, request a state or post commands and return at once. The
+thread takes them up between two frames while it runs and blocks on a
+condition variable while it is stopped, so nobody polls or sleeps. Every
+state the thread enters is signalled on the same condition, waitFor()
+blocks until one is reached.
+"""
+import collections
+import time
+
+STOPPED = "Stopped"
+RUNNING = "Running"
+QUIT = "Quit"
+
+def _nothing():
+    pass
+
+class StateMachine:
+    """
+    State and commands of one thread.
+
+    Args:
+        mutex: (QMutex) Mutex of the condition variable.
+        wait: (QWaitCondition) Condition variable, signalled on every
+            request, command and state change.
+    """
+    def __init__(self,mutex,wait):
+        self.mutex = mutex
+        self.cond = wait
+        # State the thread is in, and the one it is asked for
+        self.state = STOPPED
+        self.target = STOPPED
+        # [function,args] to be run in the thread
+        self.commands = collections.deque()
+
+    def request(self,target):
+        """
+        Asks the thread to enter target, without waiting for it.
+        """
+        self.mutex.lock()
+        if self.target != QUIT:
+            self.target = target
+        self.cond.wakeAll()
+        self.mutex.unlock()
+
+    def post(self,func,*args):
+        """
+        Runs func(*args) in the thread, between two frames or while it is
+        stopped, without waiting for it.
+        """
+        self.mutex.lock()
+        self.commands.append([func,args])
+        self.cond.wakeAll()
+        self.mutex.unlock()
+
+    def wake(self):
+        """
+        Makes a stopped thread go through its loop once, e.g. to take up a
+        changed setting.
+        """
+        self.post(_nothing)
+
+    def pending(self):
+        """
+        Returns whether the thread is asked for another state or has
+        commands to run. Does not lock, it is cheap enough for every frame.
+        """
+        return self.target != self.state or bool(self.commands)
+
+    def stopping(self):
+        """
+        Called by the running thread between frames. Runs the posted commands
+        and returns whether the thread has to leave RUNNING.
+        """
+        if self.commands:
+            self.runCommands()
+        return self.target != RUNNING
+
+    def next(self):
+        """
+        Called by the thread when it is not running. Enters the requested
+        state, blocks while that is STOPPED and nothing is posted, runs the
+        posted commands and returns the state.
+        """
+        self.mutex.lock()
+        self._enter(self.target)
+        while self.state == STOPPED and not self.commands:
+            self.cond.wait(self.mutex)
+            self._enter(self.target)
+        self.mutex.unlock()
+        self.runCommands()
+        return self.state
+
+    def runCommands(self):
+        while True:
+            self.mutex.lock()
+            command = self.commands.popleft() if self.commands else None
+            self.mutex.unlock()
+            if command is None:
+                return
+            func,args = command
+            func(*args)
+
+    def _enter(self,state):
+        # called with the mutex held
+        if state != self.state:
+            self.state = state
+            self.cond.wakeAll()
+
+    def waitFor(self,state,timeout=None):
+        """
+        Blocks until the thread is in state, returns whether it got there
+        within timeout seconds (None waits without limit).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.mutex.lock()
+        try:
+            while self.state != state:
+                if deadline is None:
+                    self.cond.wait(self.mutex)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(self.mutex,max(int(remaining*1000),1))
+            return True
+        finally:
+            self.mutex.unlock()
@@ -0,0 +1,236 @@
+import collections
+import math
+import time
+
+class Histogram:
+    """
+    Streaming latency histogram with logarithmic buckets.
+
+    add() is O(1) and allocation free: the bucket index is computed from the
+    logarithm of the value. Buckets are BINS per factor of two wide, so
+    percentiles are accurate to about 4 % of the value, from 1 us up to
+    about 100 s. The maximum is exact.
+    """
+    LOW = 1e-6
+    BINS = 8
+    SIZE = 27 * BINS
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.max = 0.0
+
+    def add(self,value):
+        if value > self.LOW:
+            index = int(math.log2(value / self.LOW) * self.BINS)
+            if index >= self.SIZE:
+                index = self.SIZE - 1
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self,p):
+        """
+        Returns the value below which p percent of the values fall, taken as
+        the centre of the bucket it falls in.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        total = 0
+        for index,n in enumerate(self.counts):
+            total += n
+            if total >= rank and n:
+                if index == self.SIZE - 1:
+                    # the last bucket holds everything above the range
+                    return self.max
+                value = self.LOW * 2 ** ((index + 0.5) / self.BINS)
+                return min(value,self.max)
+        return self.max
+
+    def getStats(self):
+        return {"count":self.count,
+                "p50":self.percentile(50),
+                "p95":self.percentile(95),
+                "p99":self.percentile(99),
+                "max":self.max}
+
+class Latency:
+    """
+    Per-stage latency histograms of the frames of one pipeline.
+
+    Frames carry a dict of monotonic timestamps, one per stage they passed
+    (see Frame.stamp()). Stamping a stage adds the spans ending at it to
+    their histograms, so the cost per stage is a dict update and a few
+    histogram adds. Every span has a single writing thread.
+
+    Stages:
+        read, capture: start and end of reading the frame from the device
+        display_enqueue, display_dequeue: display queue
+        convert: converted for display
+        paint: handed to the screen in the GUI thread
+        record_enqueue, record_dequeue: record queue
+        write: handed to the writer
+        analyzed: metrics computed, see analysis.Analyzer
+    """
+    # Span name, start stage and end stage
+    SPANS = [["Capture","read","capture"],
+             ["Display queue","display_enqueue","display_dequeue"],
+             ["Convert","display_dequeue","convert"],
+             ["Paint","convert","paint"],
+             ["Screen","capture","paint"],
+             ["Record queue","record_enqueue","record_dequeue"],
+             ["Write","record_dequeue","write"],
+             ["Disk","capture","write"],
+             ["Analysis","capture","analyzed"]]
+
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+        self.ends = {}
+        for name,start,end in self.SPANS:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+            self.ends.setdefault(end,[]).append([start,histogram])
+
+    def clear(self):
+        for histogram in self.histograms.values():
+            histogram.clear()
+
+    def stamp(self,stamps,stage,t=None):
+        """
+        Stamps stage with t (now if None) and adds the spans ending at it.
+
+        Args:
+            stamps: (dict) Stage -> timestamp of one frame.
+            stage: (str) Stage the frame just passed.
+            t: (float) Monotonic timestamp.
+        """
+        if t is None:
+            t = time.monotonic()
+        stamps[stage] = t
+        for start,histogram in self.ends.get(stage,()):
+            if start in stamps:
+                histogram.add(t - stamps[start])
+        return t
+
+    def getStats(self):
+        """
+        Returns span name -> count, p50, p95, p99 and max in seconds.
+        """
+        return {name:h.getStats() for name,h in self.histograms.items()}
+
+    def getStatString(self,names=("Screen","Disk")):
+        texts = []
+        for name in names:
+            histogram = self.histograms[name]
+            if histogram.count:
+                s = histogram.getStats()
+                texts.append("%s %.1f/%.1f/%.1f/%.1f" % (
+                    name,s["p50"]*1e3,s["p95"]*1e3,s["p99"]*1e3,s["max"]*1e3))
+        return "Latency p50/p95/p99/max ms: " + (", ".join(texts) or "-")
+
+class RateMeter:
+    """
+    Frame rate and load of a loop over the last nr iterations, updated in
+    O(1) with running sums.
+
+    add() and update() take the time before and after the blocking part of an
+    iteration (reading a frame, waiting on a queue). The load is the share
+    of time spent outside of it, 100 % means the loop cannot go faster.
+    update() also returns the rate as string.
+
+    Args:
+        name: (str) Shown in front of the rate.
+        nr: (int) Number of iterations averaged.
+    """
+    def __init__(self,name,nr=50):
+        self.name = name
+        self.nr = nr
+        self.clear()
+
+    def clear(self):
+        self.before = collections.deque()
+        self.after = collections.deque()
+        self.sum_before = 0.0
+        self.sum_after = 0.0
+
+    def add(self,time_before,time_after):
+        self.before.append(time_before)
+        self.after.append(time_after)
+        self.sum_before += time_before
+        self.sum_after += time_after
+        if len(self.before) > self.nr:
+            self.sum_before -= self.before.popleft()
+            self.sum_after -= self.after.popleft()
+
+    def getRate(self):
+        """
+        Returns the frame rate and the load in percent.
+        """
+        n = len(self.before) - 1
+        if n < 1:
+            return 0.0,0.0
+        period = (self.before[-1] - self.before[0]) / n
+        # from the end of one blocking call to the start of the next
+        busy = ((self.sum_before - self.before[0])
+                - (self.sum_after - self.after[-1])) / n
+        if period <= 0:
+            return 0.0,0.0
+        return 1.0 / period,busy / period * 100
+
+    def getStatString(self):
+        cur_fps,percent = self.getRate()
+        return "%s: %05.1f fps (%05.1f %%)" % (self.name,cur_fps,percent)
+
+    def update(self,time_before,time_after):
+        self.add(time_before,time_after)
+        return self.getStatString()
+
+class SwitchTimer:
+    """
+    Latency of format switches: from the request to the first frame of the
+    new format, kept per pair of formats (cold and repeated switches differ,
+    see pool.FramePool and v4l2.setFormat()).
+    """
+    def __init__(self):
+        self.times = collections.defaultdict(list)
+        self.pending = None
+        self.last = None
+
+    def start(self,old,new,t):
+        self.pending = (old,new,t)
+
+    def done(self,t):
+        """
+        Called with the capture time of every frame, records the switch on
+        the first frame after one.
+        """
+        if self.pending is None:
+            return
+        old,new,t_request = self.pending
+        self.pending = None
+        self.last = t - t_request
+        self.times[(old,new)].append(self.last)
+
+    def getStats(self):
+        """
+        Returns {(old,new):[first,median of the repeats,count]} in seconds,
+        the median is None before a repeat.
+        """
+        stats = {}
+        for key,values in self.times.items():
+            repeats = sorted(values[1:])
+            median = repeats[len(repeats)//2] if repeats else None
+            stats[key] = [values[0],median,len(values)]
+        return stats
+
+    def getStatString(self):
+        if self.last is None:
+            return ""
+        return ", switched in %.0f ms" % (self.last * 1000)
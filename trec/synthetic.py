@@ -0,0 +1,100 @@
+import cv2
+import numpy as np
+
+from playback import Pacer
+
+# Selectable formats: width, height, channels, dtype, fps (0 is unthrottled)
+FORMATS = [[640,480,3,"uint8",30],
+           [1280,720,3,"uint8",30],
+           [1280,720,3,"uint8",60],
+           [1920,1080,3,"uint8",30],
+           [1920,1080,3,"uint8",60],
+           [1920,1080,3,"uint8",120],
+           [1280,1024,3,"uint16",60],
+           [1280,720,3,"uint8",0],
+           [1280,1024,1,"uint8",60],
+           [1280,1024,1,"uint16",60]]
+
+def formatName(width,height,channels,dtype,fps):
+    rate = fps if fps else "max"
+    return "%d ch %s - %4d x %4d - %4s" % (channels,dtype,width,height,rate)
+
+def makeFrames(shape,nr=8,seed=0,dtype=np.uint8):
+    """
+    Creates a few test frames: a moving gradient with some noise, which
+    compresses like a real camera image rather than like pure noise.
+    """
+    dtype = np.dtype(dtype)
+    rng = np.random.default_rng(seed)
+    y,x = np.mgrid[0:shape[0],0:shape[1]]
+    frames = []
+    for i in range(nr):
+        base = ((x + y + i*16) % 256).astype(np.uint8)
+        noise = rng.integers(0,16,shape,dtype=np.uint8)
+        if len(shape) == 3:
+            base = base[:,:,None]
+        image = (base + noise).astype(dtype)
+        if dtype.itemsize > 1:
+            # use the full range of wider types
+            image *= 257
+        frames.append(image)
+    return frames
+
+class SyntheticCapture:
+    """
+    Generates frames like a camera, with the read interface of
+    cv2.VideoCapture.
+
+    A few frames are generated up front and copied into the buffer passed to
+    read(), so a read costs one copy, like a driver handing over a buffer.
+    Reads are paced to the frame rate; a slow consumer makes the generator
+    skip ahead instead of bursting, as a sensor would.
+
+    Args:
+        width: (int) Frame width.
+        height: (int) Frame height.
+        channels: (int) Number of channels, 1 gives 2D frames.
+        dtype: (str) Frame dtype.
+        fps: (float) Frame rate, 0 or None reads as fast as possible.
+        codec: (str) "MJPG" returns JPEG compressed frames, like a camera
+            read with CAP_PROP_CONVERT_RGB off (uint8 frames only).
+    """
+    PATTERNS = 8
+
+    def __init__(self,width,height,channels=3,dtype="uint8",fps=30,
+                 codec=None):
+        if channels == 1:
+            self.shape = (height,width)
+        else:
+            self.shape = (height,width,channels)
+        self.dtype = np.dtype(dtype)
+        self.fps = fps
+        self.patterns = makeFrames(self.shape,self.PATTERNS,dtype=self.dtype)
+        self.codec = codec if self.dtype == np.uint8 else None
+        if self.codec is not None:
+            self.patterns = [cv2.imencode(".jpg",p)[1].reshape(1,-1)
+                             for p in self.patterns]
+        self.pacer = Pacer(fps,1.0 if fps else None)
+        self.nr = 0
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self,image=None):
+        if not self.opened:
+            return False,image
+        self.pacer.wait()
+        pattern = self.patterns[self.nr % self.PATTERNS]
+        self.nr += 1
+        if self.codec is not None:
+            # compressed frames differ in size, the driver returns new ones
+            return True,pattern.copy()
+        if (image is None or image.shape != self.shape
+            or image.dtype != self.dtype):
+            return True,pattern.copy()
+        np.copyto(image,pattern)
+        return True,image
+
+    def release(self):
+        self.opened = False
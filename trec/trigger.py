@@ -0,0 +1,236 @@
+"""
+Event triggers for recording only the intervals that matter.
+
+A detector reduces a frame to a single value, the trigger compares it with a
+threshold and adds a post-roll, so a clip runs from the first active frame
+until post_roll seconds after the last one. The seconds before the first
+active frame come from the pre-roll ring of the recorder.
+
+Detectors run in the recorder thread on every frame, so they work on a
+downsampled view and cost well below a millisecond per frame.
+"""
+import cv2
+import numpy as np
+
+import mjpg
+from analysis import toGray,Focus as FocusMetric,MeltPool as MeltPoolMetric
+
+class Detector:
+    """
+    Base class of the detectors. Subclasses set NAME, UNIT and DEFAULT, the
+    threshold used when none is given, and implement measure().
+    """
+    NAME = ""
+    UNIT = ""
+    DEFAULT = 0.0
+    # Frame pixels per analyzed pixel
+    STEP = 8
+
+    def reset(self):
+        pass
+
+    def view(self,image,codec=None):
+        """
+        Returns the downsampled luminance of a frame, None if a compressed
+        frame is corrupt.
+        """
+        step = self.STEP
+        if codec is not None:
+            # decoded at a reduced scale, the rest is resized
+            gray,scale = mjpg.decode(image,step,gray=True)
+            if gray is None or scale == step:
+                return gray
+            step //= scale
+        else:
+            gray = toGray(image)
+        size = (max(gray.shape[1]//step,1),max(gray.shape[0]//step,1))
+        return cv2.resize(gray,size,interpolation=cv2.INTER_NEAREST)
+
+    def range(self,image):
+        if np.issubdtype(image.dtype,np.integer):
+            return float(np.iinfo(image.dtype).max)
+        return 1.0
+
+    def measure(self,image,codec=None):
+        """
+        Returns the value of a frame, None if there is none yet.
+
+        Args:
+            image: (np.ndarray) Frame.
+            codec: (str) Codec of a compressed frame, see mjpg.py.
+        """
+        raise NotImplementedError
+
+class Motion(Detector):
+    """
+    Mean absolute difference to the previous frame, in % of the range.
+    """
+    NAME = "Motion"
+    UNIT = "%"
+    DEFAULT = 2.0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+
+    def measure(self,image,codec=None):
+        gray = self.view(image,codec)
+        if gray is None:
+            return None
+        previous = self.previous
+        self.previous = gray
+        if previous is None or previous.shape != gray.shape:
+            return None
+        return cv2.mean(cv2.absdiff(gray,previous))[0] / self.range(gray) * 100
+
+class Intensity(Detector):
+    """
+    Mean luminance in % of the range.
+    """
+    NAME = "Intensity"
+    UNIT = "%"
+    DEFAULT = 50.0
+
+    def measure(self,image,codec=None):
+        gray = self.view(image,codec)
+        if gray is None:
+            return None
+        return cv2.mean(gray)[0] / self.range(gray) * 100
+
+class MetricDetector(Detector):
+    """
+    Value of a metric plugin of the analysis stage (analysis.Metric),
+    computed for the frame under test within the region of interest of the
+    analyzer. The analysis stage itself lags behind and may skip frames,
+    and may be off.
+    """
+    METRIC = None
+    KEY = ""
+    # The default step of the analyzer, so the values match those shown
+    STEP = 4
+
+    def __init__(self,analyzer=None):
+        self.analyzer = analyzer
+        self.metric = self.METRIC()
+
+    def measure(self,image,codec=None):
+        gray = self.view(image,codec)
+        if gray is None:
+            return None
+        origin = (0,0)
+        # may be changed from the GUI thread meanwhile
+        roi = self.analyzer.roi if self.analyzer is not None else None
+        if roi is not None:
+            x,y,width,height = roi
+            step = self.STEP
+            crop = gray[y//step:(y+height)//step,x//step:(x+width)//step]
+            # a region outside the frame measures the whole frame
+            if crop.size:
+                gray = crop
+                origin = (x,y)
+        values = self.metric.compute(gray,self.STEP,origin)
+        return values[self.metric.KEYS.index(self.KEY)]
+
+class MeltPoolArea(MetricDetector):
+    NAME = "Melt pool"
+    UNIT = "px"
+    DEFAULT = 100.0
+    METRIC = MeltPoolMetric
+    KEY = "melt_area"
+
+class Focus(MetricDetector):
+    NAME = "Focus"
+    UNIT = ""
+    DEFAULT = 1000.0
+    METRIC = FocusMetric
+    KEY = "focus"
+
+class Trigger:
+    """
+    Decides per frame whether it belongs to a clip.
+
+    Args:
+        analyzer: (analysis.Analyzer) Source of the metric detectors.
+    """
+    DETECTORS = [None,Motion,Intensity,MeltPoolArea,Focus]
+    NAMES = ["Trigger: Off (continuous)","Trigger: Motion",
+             "Trigger: Intensity","Trigger: Melt pool","Trigger: Focus"]
+    POST_ROLLS = [1,2,5,10]
+
+    def __init__(self,analyzer=None):
+        self.analyzer = analyzer
+        self.detector = None
+        self.threshold = None
+        self.post_roll = self.POST_ROLLS[0]
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self.last = None
+        self.value = None
+        if self.detector is not None:
+            self.detector.reset()
+
+    def setDetector(self,index):
+        cls = self.DETECTORS[index]
+        if cls is None:
+            self.detector = None
+        elif issubclass(cls,MetricDetector):
+            self.detector = cls(self.analyzer)
+        else:
+            self.detector = cls()
+        self.reset()
+
+    def setThreshold(self,threshold):
+        """
+        Sets the threshold in the unit of the detector, None for its default.
+        """
+        self.threshold = threshold
+
+    def setPostRoll(self,seconds):
+        self.post_roll = seconds
+
+    def getThreshold(self,detector):
+        if self.threshold is None:
+            return detector.DEFAULT
+        return self.threshold
+
+    def update(self,t,image,codec=None):
+        """
+        Returns whether the frame captured at t belongs to a clip: the
+        detector is above the threshold, or was within the post-roll.
+        Without detector every frame does. codec is that of a compressed
+        frame.
+        """
+        # may be changed from the GUI thread meanwhile
+        detector = self.detector
+        if detector is None:
+            self.last = t
+            self.value = None
+        else:
+            self.value = detector.measure(image,codec)
+            if (self.value is not None
+                and self.value > self.getThreshold(detector)):
+                self.last = t
+        self.active = self.last is not None and t - self.last <= self.post_roll
+        return self.active
+
+    def getMeta(self):
+        detector = self.detector
+        if detector is None:
+            return {"detector":None,"post_roll":self.post_roll}
+        return {"detector":detector.NAME,
+                "threshold":self.getThreshold(detector),
+                "unit":detector.UNIT,
+                "post_roll":self.post_roll}
+
+    def getStatString(self):
+        detector = self.detector
+        if detector is None:
+            return "Trigger: Off"
+        value = "-" if self.value is None else "%.1f" % self.value
+        return "Trigger %s: %s/%g %s" % (detector.NAME,value,
+                                         self.getThreshold(detector),
+                                         detector.UNIT)
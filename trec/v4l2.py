@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import subprocess
+import threading
+
+import cv2
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME",os.path.expanduser("~/.cache")),"trec")
+CACHE_FILE = os.path.join(CACHE_DIR,"v4l2.json")
+
+_lock = threading.Lock()
+
+def formatKey(fourcc,width,height,fps):
+    return "%4s - %4s x %4s - %4s" % (fourcc,width,height,fps)
+
+def parseFormatsExt(text):
+    """
+    Parses the output of 'v4l2-ctl --list-formats-ext' in a single pass.
+
+    Only discrete frame sizes and intervals are listed, frame rates are
+    truncated to whole frames per second. Both the current layout
+    ("[0]: 'MJPG' (Motion-JPEG, compressed)") and the one of older v4l2-ctl
+    versions ("Pixel Format: 'MJPG' (compressed)") are understood.
+
+    Args:
+        text: (str) Output of v4l2-ctl.
+
+    Returns:
+        (dict) Format string -> [fourcc,width,height,fps]
+    """
+    fffs = {}
+    fourcc = None
+    size = None
+    for line in text.splitlines():
+        line = line.strip()
+        m = re.match(r"(?:\[\d+\]:|Pixel Format:)\s*'(.{4})'",line)
+        if m:
+            fourcc = m.group(1)
+            size = None
+            continue
+
+        m = re.match(r"Size:\s*Discrete\s+(\d+)x(\d+)",line)
+        if m:
+            size = (m.group(1),m.group(2))
+            continue
+        if line.startswith("Size:"):
+            size = None
+            continue
+
+        m = re.match(r"Interval:\s*Discrete\s+\S+\s+\(([\d.]+)\s*fps\)",line)
+        if m and fourcc is not None and size is not None:
+            fps = m.group(1).split(".")[0]
+            width,height = size
+            key = formatKey(fourcc,width,height,fps)
+            fffs[key] = [fourcc,int(width),int(height),int(fps)]
+
+    return fffs
+
+def parseDevices(text):
+    """
+    Parses the output of 'v4l2-ctl --list-devices'.
+
+    Returns:
+        (list) [name,path] of the first device node of every device.
+    """
+    paths = []
+    for device in text.strip().split("\n\n"):
+        lines = [l.strip() for l in device.split("\n") if l.strip()]
+        if len(lines) < 2:
+            continue
+        name = lines[0].split(" (")[0].rstrip(":").strip()
+        paths.append([name,lines[1]])
+    return paths
+
+def listDevices():
+    try:
+        text = subprocess.run(["v4l2-ctl","--list-devices"],
+                              capture_output=True,text=True).stdout
+    except OSError:
+        return []
+    return parseDevices(text)
+
+def enumerateFormats(path):
+    """
+    Lists all discrete format/size/fps combinations of a device with one
+    v4l2-ctl call.
+    """
+    try:
+        text = subprocess.run(["v4l2-ctl","--device="+path,
+                               "--list-formats-ext"],
+                              capture_output=True,text=True).stdout
+    except OSError:
+        return {}
+    return parseFormatsExt(text)
+
+def deviceIdentity(path):
+    """
+    Identifies the physical device behind a device node, so the cache survives
+    a camera showing up under another /dev/videoN. Falls back to the path.
+    """
+    sysfs = "/sys/class/video4linux/" + os.path.basename(path)
+    parts = []
+    try:
+        with open(sysfs+"/name") as f:
+            parts.append(f.read().strip())
+        device = os.path.realpath(sysfs+"/device")
+        parts.append(os.path.basename(device))
+        for attr in ("idVendor","idProduct","serial"):
+            name = os.path.join(os.path.dirname(device),attr)
+            if os.path.exists(name):
+                with open(name) as f:
+                    parts.append(f.read().strip())
+    except OSError:
+        return path
+    return "|".join(parts)
+
+def parseFormat(text):
+    """
+    Parses a format given as FOURCC:WIDTHxHEIGHT@FPS, e.g. MJPG:1280x720@30.
+    Fourccs shorter than 4 characters are padded with spaces, e.g. Y10.
+
+    Returns:
+        (list) [fourcc,width,height,fps]
+    """
+    m = re.match(r"^(\S{1,4}) ?:(\d+)x(\d+)@(\d+)$",text.strip())
+    if not m:
+        raise ValueError("Format must look like MJPG:1280x720@30: %s" % text)
+    return [m.group(1).ljust(4),int(m.group(2)),int(m.group(3)),
+            int(m.group(4))]
+
+def setFormat(reader,fourcc,width,height,fps,current=None):
+    """
+    Configures a cv2.VideoCapture of a V4L2 device. Every property set makes
+    the driver stop and restart streaming, so with the current format given
+    as [fourcc,width,height,fps] only the properties that differ are set.
+    """
+    if current is None:
+        current = [None,None,None,None]
+    if width != current[1]:
+        reader.set(cv2.CAP_PROP_FRAME_WIDTH,width)
+    if height != current[2]:
+        reader.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
+    if fourcc != current[0]:
+        reader.set(cv2.CAP_PROP_FOURCC,cv2.VideoWriter.fourcc(*fourcc))
+    if fps != current[3]:
+        reader.set(cv2.CAP_PROP_FPS,fps)
+
+def _readCache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def _writeCache(identity,fffs):
+    with _lock:
+        cache = _readCache()
+        cache[identity] = fffs
+        os.makedirs(CACHE_DIR,exist_ok=True)
+        tmp = CACHE_FILE + ".tmp"
+        with open(tmp,"w") as f:
+            json.dump(cache,f)
+        os.replace(tmp,CACHE_FILE)
+
+def _refresh(path,identity,cached,callback):
+    fffs = enumerateFormats(path)
+    if fffs and fffs != cached:
+        _writeCache(identity,fffs)
+        if callback is not None:
+            callback(fffs)
+
+def getFormats(path,callback=None):
+    """
+    Returns the formats of a device. A cached enumeration is returned right
+    away and refreshed in the background, otherwise the device is enumerated
+    and the result cached.
+
+    Args:
+        path: (str) Device node, e.g. /dev/video0.
+        callback: (callable) Called with the new formats if the background
+            refresh finds they changed.
+    """
+    identity = deviceIdentity(path)
+    cached = _readCache().get(identity)
+    if cached:
+        threading.Thread(target=_refresh,daemon=True,
+                         args=(path,identity,cached,callback)).start()
+        return cached
+
+    fffs = enumerateFormats(path)
+    if fffs:
+        _writeCache(identity,fffs)
+    return fffs